@@ -0,0 +1,149 @@
+"""
+Event payload sizes and latency of the pipeline with the message content in
+every event, and with claim check (common/blobstore.py), for large emails.
+
+    python -m benchmarks.bench_claim_check --sizes 2000,20000,200000 --messages 20
+
+The services run in-process behind the local broker of benchmarks/pipeline.py
+(the multi-hop pipeline). Each message is an email of about `--size`
+characters: a short request followed by a long quoted reply chain, which the
+stages strip before prompting the LLM but which travels in every event
+unless the content is passed by reference.
+
+With claim check the intake service stores each content in a `--backend`
+blob store under a temporary directory, and every stage that reads the
+content fetches it. The fetch cache is off, as each stage would run in its
+own pod, so every stage pays for its fetch. The report shows the payload
+bytes the Broker carried per message, the end-to-end latency, and the blob
+fetches per message with their average time.
+"""
+import argparse
+import importlib
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from benchmarks import fake_postgres
+from benchmarks.pipeline import INTAKE_PACKAGE, Broker, load_triggers, replay, select_triggers
+from benchmarks.stub_llm import start_stub_server
+from benchmarks.util import configure_llm_env, latency_summary, print_table
+
+REQUESTS = [
+    "I was charged twice for invoice INV-{n}. Please refund the second payment.",
+    "The Gizmo-X stopped working after the last update, ticket {n}. Can someone help?",
+    "I cannot log in to the website since yesterday, my account number is {n}.",
+]
+
+
+def make_email(index, size, rng):
+    """A request of a few lines followed by a quoted reply chain, about `size` characters long."""
+    lines = [
+        "Hello support team,", "",
+        rng.choice(REQUESTS).format(n=rng.randint(10000, 99999)), "",
+        f"Best regards,\nCustomer {index}\ncustomer{index}@example.com", "",
+        f"On Mon, 3 Mar 2025 at 10:{index % 60:02d}, Support <support@example.com> wrote:",
+    ]
+    length = sum(len(line) + 1 for line in lines)
+    while length < size:
+        line = "> " + " ".join(rng.choice(["thanks", "for", "your", "message", "we", "will", "look", "into",
+                                           "the", "invoice", "account", "update", "soon", "regards"])
+                               for _ in range(12))
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+def measure(broker, intake_app, contents, args, store):
+    """Replays the contents and returns the measurements of one run."""
+    broker.subscribe(select_triggers(load_triggers(), "multi-hop"))
+    before = store.stats() if store else None
+    submitted, intake_latencies = {}, []
+    replay(intake_app, contents, args.rate, args.clients, submitted, intake_latencies, broker.failures)
+    deadline = time.perf_counter() + args.drain_seconds
+    while time.perf_counter() < deadline:
+        with broker.lock:
+            if all(message_id in broker.finished for message_id in submitted):
+                break
+        time.sleep(0.05)
+    with broker.lock:
+        end_to_end = [broker.finished[m] - t for m, t in submitted.items() if m in broker.finished]
+        payload_bytes = sum(broker.payload_bytes.values())
+        failed = sum(broker.failures.values())
+    completed = max(1, len(end_to_end))
+    fetches, fetch_ms = 0.0, "-"
+    if store:
+        after = store.stats()
+        count = after["fetched"] - before["fetched"]
+        fetches = count / completed
+        if count:
+            fetch_ms = ((after["fetch_ms_avg"] * after["fetched"] - before["fetch_ms_avg"] * before["fetched"])
+                        / count)
+    summary = latency_summary(end_to_end)
+    return {
+        "completed": len(end_to_end), "failed": failed, "payload_bytes": payload_bytes / completed,
+        "p50_ms": summary["p50_ms"], "p99_ms": summary["p99_ms"], "fetches": fetches, "fetch_ms": fetch_ms,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="2000,20000,200000", help="Email sizes in characters")
+    parser.add_argument("--messages", type=int, default=20, help="Messages per size and variant")
+    parser.add_argument("--rate", type=float, default=20.0, help="Messages per second sent to intake")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Stub LLM latency")
+    parser.add_argument("--backend", choices=("filesystem", "sqlite"), default="filesystem", help="BLOB_STORE_BACKEND")
+    parser.add_argument("--min-bytes", type=int, default=4096, help="BLOB_STORE_MIN_BYTES")
+    parser.add_argument("--drain-seconds", type=float, default=60.0)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="claim-check-")
+    os.environ["BLOB_STORE_BACKEND"] = args.backend
+    os.environ["BLOB_STORE_PATH"] = os.path.join(directory, "blobs" if args.backend == "filesystem" else "blobs.sqlite3")
+    os.environ["BLOB_STORE_MIN_BYTES"] = str(args.min_bytes)
+    os.environ["BLOB_STORE_CACHE_SIZE"] = "0"
+    db = fake_postgres.install(query_latency_ms=1.0)
+    server, base_url = start_stub_server(
+        latency_ms=args.latency_ms,
+        field_choices={"email_address": db.emails(), "route": ["support", "finance", "website"]},
+    )
+    configure_llm_env(base_url)
+    os.environ["LLM_CACHE_BACKEND"] = "none"
+    os.environ["IDEMPOTENCY_BACKEND"] = "none"
+    for name in ("DB_HOST", "DB_NAME", "DB_USER", "DB_PASSWORD"):
+        os.environ.setdefault(name, "benchmark")
+    broker = Broker(64)
+    ingress, sink_url = broker.serve()
+    os.environ["K_SINK"] = sink_url
+    logging.disable(logging.WARNING)
+    # Imported after the environment is set up.
+    intake = importlib.import_module(f"{INTAKE_PACKAGE}.app")
+    store = intake.content_store
+
+    rng = random.Random(11)
+    rows = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        contents = [make_email(i, size, rng) for i in range(args.messages)]
+        inline = None
+        for variant, content_store in (("inline", None), ("claim check", store)):
+            intake.content_store = content_store
+            result = measure(broker, intake.app, contents, args, content_store)
+            inline = inline or result["payload_bytes"]
+            rows.append([size, variant, f"{result['completed']}/{args.messages}", result["payload_bytes"],
+                         100.0 * result["payload_bytes"] / inline, result["p50_ms"], result["p99_ms"],
+                         result["fetches"], result["fetch_ms"], result["failed"]])
+
+    print(f"{args.messages} messages per size at {args.rate}/s, stub LLM latency {args.latency_ms} ms, "
+          f"blob store '{args.backend}' without a fetch cache, contents of {args.min_bytes} bytes or more by reference")
+    print_table(["email_chars", "content", "completed", "payload_bytes", "payload_%", "e2e_p50_ms", "e2e_p99_ms",
+                 "fetches", "fetch_ms", "failed"], rows)
+    ingress.shutdown()
+    server.shutdown()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Cost of reading and writing an OuterWrapper payload in a service hop, comparing
+the dict-based path with the bytes-based codec in models/codec.py.
+
+    python -m benchmarks.bench_codec --iterations 2000
+
+The old path is `OuterWrapper(**request.get_json())` and
+`jsonify(wrapper.model_dump(mode='json'))`; the new one is
+`decode_wrapper(request.get_data())` and `wrapper_response(wrapper)`. Both run
+inside a Flask app context, and the response body is produced in full.
+"""
+import argparse
+import json
+import timeit
+
+from flask import Flask, jsonify
+
+from benchmarks.util import print_table
+from models import OuterWrapper, StructuredObject
+from models.codec import decode_wrapper, wrapper_response
+
+SENTENCE = "Hello, I was charged twice for my Gizmo-X subscription this month and would like a refund. "
+
+
+def make_payload(content_chars, errors):
+    """A JSON payload as it looks after the router: structured, routed, with `errors` error entries."""
+    wrapper = OuterWrapper(
+        message_id="bench-message",
+        content=(SENTENCE * (content_chars // len(SENTENCE) + 1))[:content_chars],
+        metadata={"source": "benchmark"},
+        structured=StructuredObject(
+            reason="Billing issue", sentiment="negative", company_id="C-123", company_name="Global Tech Inc.",
+            customer_name="John Smith", country="USA", email_address="john.smith@globaltech.com",
+            phone="1-800-555-1234", product_name="Gizmo-X", escalate=False,
+        ),
+        route={"route": "finance", "reason": "Refund request", "escalation_required": False},
+        error=[f"guardian:check-failed:{i}" for i in range(errors)],
+    )
+    return wrapper.model_dump_json().encode()
+
+
+CASES = {
+    "small": make_payload(content_chars=300, errors=0),
+    "large-content": make_payload(content_chars=100_000, errors=0),
+    "long-errors": make_payload(content_chars=300, errors=1_000),
+}
+
+
+def old_path(body):
+    wrapper = OuterWrapper(**json.loads(body))
+    return jsonify(wrapper.model_dump(mode='json')).get_data()
+
+
+def new_path(body):
+    wrapper = decode_wrapper(body)
+    return wrapper_response(wrapper).get_data()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    rows = []
+    with app.app_context():
+        for name, body in CASES.items():
+            # Both paths must produce the same payload.
+            assert json.loads(old_path(body)) == json.loads(new_path(body))
+            old_us = min(timeit.repeat(lambda: old_path(body), number=args.iterations, repeat=3)) / args.iterations * 1e6
+            new_us = min(timeit.repeat(lambda: new_path(body), number=args.iterations, repeat=3)) / args.iterations * 1e6
+            rows.append([name, len(body), old_us, new_us, old_us / new_us])
+
+    print_table(["payload", "bytes", "old_us", "new_us", "speedup"], rows)
+
+
+if __name__ == "__main__":
+    main()
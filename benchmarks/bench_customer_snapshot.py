@@ -0,0 +1,70 @@
+"""
+Loading cost and memory footprint of the customer snapshot index.
+
+    python -m benchmarks.bench_customer_snapshot --customers 1000000
+
+Synthetic rows are streamed into `CustomerSnapshot.load_rows` the same way a
+server-side cursor would deliver them, so no database is needed. Reports load
+time, accounted bytes per row, growth of the process RSS, and lookup latency.
+"""
+import argparse
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from svc_customer_lookup.snapshot import CustomerSnapshot
+
+COUNTRIES = ["USA", "Germany", "France", "Japan", "Brazil", "India", "Canada", "Spain", "Italy", "Mexico"]
+
+
+def synthetic_rows(count, companies):
+    started = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    for i in range(count):
+        yield (
+            f"Contact.{i}@Customer{i % companies}.example.com",
+            f"C-{i}",
+            f"Company {i % companies}",
+            f"Contact {i}",
+            COUNTRIES[i % len(COUNTRIES)],
+            f"1-800-{i:07d}",
+            started + timedelta(seconds=i),
+        )
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--customers", type=int, default=1_000_000)
+    parser.add_argument("--companies", type=int, default=50_000)
+    parser.add_argument("--lookups", type=int, default=200_000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    snapshot = CustomerSnapshot(conn_string=None)
+    rss_before = rss_bytes()
+    snapshot.load_rows(synthetic_rows(args.customers, args.companies))
+    rss_after = rss_bytes()
+
+    emails = [f"  contact.{random.randrange(args.customers)}@customer{i % args.companies}.EXAMPLE.com "
+              for i in range(args.lookups)]
+    started = time.perf_counter()
+    for email in emails:
+        snapshot.find_by_email(email)
+    lookup_seconds = time.perf_counter() - started
+
+    memory = snapshot.memory
+    print(f"customers:            {memory['rows']}")
+    print(f"load time:            {snapshot.load_seconds:.2f} s")
+    print(f"accounted memory:     {memory['bytes'] / 1024 / 1024:.1f} MiB ({memory['bytes_per_row']:.0f} bytes/row)")
+    print(f"RSS growth:           {(rss_after - rss_before) / 1024 / 1024:.1f} MiB")
+    print(f"lookup latency:       {lookup_seconds / args.lookups * 1e9:.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Guardian latency and token cost as the harm list grows, comparing sequential
+and concurrent per-harm checks with the single-call multi-label mode.
+
+    python -m benchmarks.bench_guardian --latency-ms 200 --iterations 20
+
+Each iteration runs `MessageProcessor.process` on one clean message against
+the stub LLM server; p50/p99 latency, LLM calls and prompt tokens per message
+are reported per harm-list size and mode.
+"""
+import argparse
+import logging
+import time
+
+from benchmarks.stub_llm import start_stub_server
+from benchmarks.util import configure_llm_env, latency_summary, print_table
+from models import OuterWrapper
+
+SAMPLE_CONTENT = (
+    "Hello, my name is Jane Doe. I am locked out of my account for the Gizmo-X product. "
+    "My email is jane.doe@example.com."
+)
+
+
+def run(processor, iterations):
+    latencies = []
+    for i in range(iterations):
+        message = OuterWrapper(message_id=f"bench-{i}", content=SAMPLE_CONTENT)
+        started = time.perf_counter()
+        processor.process(message)
+        latencies.append(time.perf_counter() - started)
+        assert not message.error, message.error
+    return latency_summary(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--jitter-ms", type=float, default=50.0)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--harm-counts", default="1,3,6,12")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, reply="No")
+    configure_llm_env(base_url)
+    logging.disable(logging.WARNING)
+
+    # Imported after the environment points at the stub server.
+    from svc_guardian_processor.app import (
+        HARMS_TO_CHECK, GUARDIAN_MODE_PER_HARM, GUARDIAN_MODE_MULTI_LABEL, MessageProcessor
+    )
+
+    stats = server.RequestHandlerClass.stats
+    rows = []
+    for count in [int(c) for c in args.harm_counts.split(",")]:
+        harms = (HARMS_TO_CHECK + [f"harm_{i}" for i in range(count)])[:count]
+        variants = (
+            ("sequential", GUARDIAN_MODE_PER_HARM, 1),
+            ("concurrent", GUARDIAN_MODE_PER_HARM, count),
+            ("multi-label", GUARDIAN_MODE_MULTI_LABEL, 1),
+        )
+        for name, mode, concurrency in variants:
+            processor = MessageProcessor(harms=harms, concurrency=concurrency, mode=mode)
+            stats.reset()
+            summary = run(processor, args.iterations)
+            usage = stats.snapshot()
+            rows.append([
+                count, name, summary["p50_ms"], summary["p99_ms"],
+                usage["requests"] / args.iterations, usage["prompt_tokens"] / args.iterations,
+            ])
+
+    print(f"Stub LLM latency: {args.latency_ms} ms (+ up to {args.jitter_ms} ms jitter)")
+    print_table(["harms", "mode", "p50_ms", "p99_ms", "calls/msg", "prompt_tokens/msg"], rows)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
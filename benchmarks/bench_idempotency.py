@@ -0,0 +1,95 @@
+"""
+Redelivered events at the router: answered again by the LLM, or from the
+idempotency store.
+
+    python -m benchmarks.bench_idempotency --messages 200 --latency-ms 200
+
+Delivers every message to svc_router through its Flask app, then delivers
+them all again, as the Broker does when a reply got lost. It reports the
+latency of first deliveries and redeliveries, the LLM calls the
+redeliveries made and whether they were answered with the same Ce-Id, without
+a store and with the memory and SQLite backends. The LLM response cache is
+off, so without a store every redelivery goes to the LLM.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+from benchmarks.stub_llm import start_stub_server
+from benchmarks.util import configure_llm_env, latency_summary, print_table
+from common.idempotency import IdempotencyStore
+from common.llm_cache import MemoryBackend, SQLiteBackend
+from models import OuterWrapper
+
+CONTENTS = [
+    "I was charged twice for my subscription, please refund one payment.",
+    "The login page of your website shows an error.",
+    "My Gizmo-X does not turn on anymore.",
+]
+
+
+def deliver(client, events):
+    latencies, ce_ids = [], []
+    for message_id, body in events:
+        headers = {"Ce-Type": "com.example.triage.customer.found", "Ce-Id": str(uuid.uuid4()),
+                   "Ce-Subject": message_id, "Ce-Source": "bench", "Ce-Specversion": "1.0"}
+        started = time.perf_counter()
+        response = client.post("/", data=body, headers=headers, content_type="application/json")
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.get_data(as_text=True)
+        ce_ids.append(response.headers.get("Ce-Id"))
+    return latencies, ce_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Stub LLM latency")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency_ms=args.latency_ms)
+    stub_stats = server.RequestHandlerClass.stats
+    configure_llm_env(base_url)
+    os.environ["ROUTER_SEMANTIC_CACHE_PATH"] = ""
+    logging.disable(logging.WARNING)
+    # Imported after the environment points at the stub server.
+    import svc_router.app as app_module
+    # Only the idempotency store: the LLM response cache would answer the repeated contents.
+    app_module.processor.cache.backend = None
+    client = app_module.app.test_client()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        backends = {
+            "none": None,
+            "memory": MemoryBackend(10000, 600.0),
+            "sqlite": SQLiteBackend(os.path.join(tmp, "idempotency.sqlite3"), 10000, 600.0, table="idempotency"),
+        }
+        for name, backend in backends.items():
+            app_module.idempotency = IdempotencyStore("router", backend)
+            events = []
+            for i in range(args.messages):
+                message_id = str(uuid.uuid4())
+                wrapper = OuterWrapper(message_id=message_id, content=CONTENTS[i % len(CONTENTS)])
+                events.append((message_id, wrapper.model_dump_json()))
+
+            first, first_ids = deliver(client, events)
+            stub_stats.reset()
+            again, again_ids = deliver(client, events)
+            llm_calls = stub_stats.snapshot()["requests"]
+            same_ids = sum(a == b for a, b in zip(first_ids, again_ids))
+            first_summary, again_summary = latency_summary(first), latency_summary(again)
+            rows.append([name, first_summary["p50_ms"], again_summary["p50_ms"] * 1000, again_summary["p99_ms"] * 1000,
+                         llm_calls, f"{same_ids}/{len(events)}", app_module.idempotency.stats()["duplicates"]])
+
+    print(f"svc_router, {args.messages} messages delivered twice, stub LLM latency {args.latency_ms} ms")
+    print_table(["store", "first_p50_ms", "redelivery_p50_us", "redelivery_p99_us", "llm_calls", "same_ce_id",
+                 "suppressed"], rows)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
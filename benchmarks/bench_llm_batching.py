@@ -0,0 +1,115 @@
+"""
+Throughput of the guardian and the router with and without micro-batching of
+their LLM prompts (common/llm_batcher.py).
+
+    python -m benchmarks.bench_llm_batching --messages 200 --clients 16 --slots 2
+
+`--clients` threads process distinct messages through each service's
+MessageProcessor, like the concurrent requests of a gevent worker. The stub
+LLM server runs `--slots` requests at a time and queues the others, like a
+local inference server with a fixed number of parallel sequences, and answers
+a multi-prompt /completions call in one pass (plus `--batch-ms` per extra
+prompt), as vLLM does. The guardian checks its harms in per-harm mode, all
+at once; the LLM response cache is off.
+
+It reports messages per second, latency per message, the HTTP requests the
+server received and the average batch size, without batching and in the
+"parallel" and "completions" modes.
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+import uuid
+
+from benchmarks.stub_llm import start_stub_server
+from benchmarks.util import configure_llm_env, latency_summary, print_table
+from common.llm_batcher import LLM_BATCH_MODE_COMPLETIONS, LLM_BATCH_MODE_PARALLEL, LLMBatcher
+from models import OuterWrapper
+
+ROUTER_REPLY = '{"route": "finance", "reason": "A billing question.", "escalation_required": false}'
+
+
+def run(process, messages, clients):
+    """Processes the messages from `clients` threads; returns (elapsed seconds, latencies, errors)."""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    pending = list(messages)
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                message = pending.pop()
+            started = time.perf_counter()
+            result = process(message)
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                errors.extend(e for e in result.error if not e.startswith("guardian:detected"))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - started, latencies, errors
+
+
+def make_messages(count):
+    return [OuterWrapper(message_id=str(uuid.uuid4()),
+                         content=f"Message {i}: I was charged twice for invoice {uuid.uuid4().hex[:8]}.")
+            for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=16, help="Messages processed at once")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Stub LLM latency per request")
+    parser.add_argument("--slots", type=int, default=2, help="Requests the stub runs at a time")
+    parser.add_argument("--batch-ms", type=float, default=5.0, help="Stub time per extra prompt of a batch")
+    parser.add_argument("--window-ms", type=float, default=10.0, help="LLM_BATCH_WINDOW_MS")
+    parser.add_argument("--max-batch-size", type=int, default=16, help="LLM_BATCH_MAX_SIZE")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency_ms=args.latency_ms, slots=args.slots, batch_ms=args.batch_ms)
+    stub_stats = server.RequestHandlerClass.stats
+    configure_llm_env(base_url)
+    os.environ["ROUTER_SEMANTIC_CACHE_PATH"] = ""
+    logging.disable(logging.WARNING)
+    # Imported after the environment points at the stub server.
+    import svc_guardian_processor.app as guardian_app
+    import svc_router.app as router_app
+
+    services = {
+        "guardian": (lambda: guardian_app.MessageProcessor(concurrency=len(guardian_app.HARMS_TO_CHECK)), "No"),
+        "router": (router_app.MessageProcessor, ROUTER_REPLY),
+    }
+    rows = []
+    for service, (make_processor, reply) in services.items():
+        server.RequestHandlerClass.config.reply = reply
+        for mode in ("none", LLM_BATCH_MODE_PARALLEL, LLM_BATCH_MODE_COMPLETIONS):
+            processor = make_processor()
+            processor.cache.backend = None
+            if mode != "none":
+                processor.batcher = LLMBatcher(processor.client, "stub-model", mode=mode, window_ms=args.window_ms,
+                                               max_batch_size=args.max_batch_size, name=service)
+            stub_stats.reset()
+            elapsed, latencies, errors = run(processor.process, make_messages(args.messages), args.clients)
+            summary = latency_summary(latencies)
+            batcher_stats = processor.batcher.stats() if processor.batcher else None
+            rows.append([service, mode, args.messages / elapsed, summary["p50_ms"], summary["p99_ms"],
+                         stub_stats.snapshot()["received"],
+                         batcher_stats["avg_batch_size"] if batcher_stats else "-", len(errors)])
+
+    print(f"{args.messages} messages from {args.clients} clients, stub LLM latency {args.latency_ms} ms with "
+          f"{args.slots} slot(s) and {args.batch_ms} ms per extra prompt, window {args.window_ms} ms")
+    print_table(["service", "batching", "msgs_per_s", "p50_ms", "p99_ms", "llm_requests", "avg_batch", "errors"], rows)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+The resilience layers of the LLM client (common/llm_resilience.py) against a
+stub LLM server with injected faults.
+
+    python -m benchmarks.bench_llm_resilience --threads 8 --phase-seconds 3
+
+Four scenarios, each run with the plain client (explicit timeouts and the
+OpenAI client's retries only) and with the layer under test:
+
+- outage: the server answers every request with a 500, then stops answering
+  within the read timeout, then recovers. The circuit breaker turns the
+  failures from seconds of retries into immediate errors, spares the server
+  the retries, and closes again after the recovery.
+- overload: the server answers 429 beyond `--capacity` requests in flight.
+  The adaptive limit settles near the capacity instead of provoking 429s.
+- tail: a few requests are much slower than the rest. Hedging after the p95
+  latency cuts the tail for a few percent more requests.
+- fallback: the primary server fails every request, and a fallback server
+  answers them.
+
+The layers are built here with explicit settings; the services build the same
+stack from the LLM_* environment variables in common/llm.py.
+"""
+import argparse
+import logging
+import threading
+import time
+
+import httpx
+import openai
+
+from benchmarks.stub_llm import start_stub_server
+from benchmarks.util import latency_summary, print_table
+from common.llm_resilience import (
+    AdaptiveConcurrencyTransport, CircuitBreakerTransport, FallbackTransport, HedgingTransport,
+)
+from common.llm_telemetry import InstrumentedTransport
+
+MESSAGES = [{"role": "user", "content": "Is this message harmful? I was charged twice for my subscription."}]
+
+
+def make_client(base_url, read_timeout, max_retries=2, breaker_failures=0, breaker_reset_seconds=1.0,
+                adaptive_max=0, hedge_percentile=0.0, fallback_url=None):
+    """An OpenAI client on the same stack of layers as common/llm.py's create_http_client."""
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=100)
+    layers = []
+
+    def chain(target):
+        transport = InstrumentedTransport(httpx.HTTPTransport(limits=limits))
+        if hedge_percentile:
+            transport = HedgingTransport(transport, target, percentile=hedge_percentile)
+            layers.append(transport)
+        if adaptive_max:
+            transport = AdaptiveConcurrencyTransport(transport, target, adaptive_max, admission_timeout=read_timeout)
+            layers.append(transport)
+        if breaker_failures:
+            transport = CircuitBreakerTransport(transport, target, breaker_failures, breaker_reset_seconds)
+            layers.append(transport)
+        return transport
+
+    transport = chain("primary")
+    if fallback_url:
+        transport = FallbackTransport(transport, chain("fallback"), base_url, fallback_url)
+        layers.append(transport)
+    client = openai.OpenAI(
+        api_key="not-needed", base_url=base_url, http_client=httpx.Client(transport=transport),
+        timeout=httpx.Timeout(read_timeout, connect=1.0), max_retries=max_retries,
+    )
+    return client, layers
+
+
+def drive(client, threads, seconds):
+    """Calls the LLM from `threads` threads for `seconds`; returns (ok, latency) per call."""
+    results = []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + seconds
+
+    def worker():
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                client.chat.completions.create(model="stub-model", messages=MESSAGES)
+                ok = True
+            except openai.APIError:
+                ok = False
+            with lock:
+                results.append((ok, time.perf_counter() - started))
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return results
+
+
+def summarize(scenario, variant, phase, results, seconds, received, extra):
+    ok = [latency for good, latency in results if good]
+    failed = [latency for good, latency in results if not good]
+    return [scenario, variant, phase, len(ok), len(failed), len(ok) / seconds,
+            latency_summary(ok)["p50_ms"] if ok else "-", latency_summary(ok)["p99_ms"] if ok else "-",
+            latency_summary(failed)["p50_ms"] if failed else "-", received, extra]
+
+
+def configure(server, **settings):
+    for name, value in settings.items():
+        setattr(server.RequestHandlerClass.config, name, value)
+
+
+def received(server):
+    with server.RequestHandlerClass.stats.lock:
+        return server.RequestHandlerClass.stats.received
+
+
+def run_phases(scenario, variant, server, client, layers, phases, threads, seconds):
+    rows = []
+    for phase, settings in phases:
+        configure(server, **settings)
+        before = received(server)
+        results = drive(client, threads, seconds)
+        state = ", ".join(f"{k}={v}" for layer in layers for k, v in layer.stats().items()
+                          if k in ("state", "limit", "hedged", "fallbacks", "rejected"))
+        rows.append(summarize(scenario, variant, phase, results, seconds, received(server) - before, state or "-"))
+    return rows
+
+
+def outage(args, rows):
+    server, base_url = start_stub_server(latency_ms=args.latency_ms)
+    healthy = {"error_rate": 0.0, "latency_ms": args.latency_ms}
+    phases = [("healthy", healthy), ("500s", {"error_rate": 1.0}),
+              ("hanging", {"error_rate": 0.0, "latency_ms": args.read_timeout * 3000}), ("recovered", healthy)]
+    for variant, kwargs in [("plain", {}), ("breaker", {"breaker_failures": 5})]:
+        client, layers = make_client(base_url, args.read_timeout, **kwargs)
+        rows += run_phases("outage", variant, server, client, layers, phases, args.threads, args.phase_seconds)
+    server.shutdown()
+
+
+def overload(args, rows):
+    server, base_url = start_stub_server(latency_ms=args.latency_ms, capacity=args.capacity)
+    threads = args.capacity * 4
+    for variant, kwargs in [("plain", {}), ("adaptive", {"adaptive_max": threads})]:
+        client, layers = make_client(base_url, args.read_timeout, **kwargs)
+        rows += run_phases(f"overload x{threads}", variant, server, client, layers, [("capacity", {})],
+                           threads, args.phase_seconds * 2)
+    server.shutdown()
+
+
+def tail(args, rows):
+    server, base_url = start_stub_server(latency_ms=args.latency_ms, jitter_ms=args.latency_ms / 5,
+                                         slow_rate=0.03, slow_ms=args.latency_ms * 10)
+    for variant, kwargs in [("plain", {}), ("hedged p95", {"hedge_percentile": 95.0})]:
+        client, layers = make_client(base_url, args.read_timeout, **kwargs)
+        rows += run_phases("tail", variant, server, client, layers, [("3% slow", {})],
+                           args.threads, args.phase_seconds * 2)
+    server.shutdown()
+
+
+def fallback(args, rows):
+    primary, primary_url = start_stub_server(latency_ms=args.latency_ms, error_rate=1.0)
+    secondary, secondary_url = start_stub_server(latency_ms=args.latency_ms)
+    for variant, kwargs in [("plain", {}), ("fallback", {"fallback_url": secondary_url, "breaker_failures": 5})]:
+        client, layers = make_client(primary_url, args.read_timeout, **kwargs)
+        rows += run_phases("fallback", variant, primary, client, layers, [("primary 500s", {})],
+                           args.threads, args.phase_seconds)
+    primary.shutdown()
+    secondary.shutdown()
+
+
+SCENARIOS = {"outage": outage, "overload": overload, "tail": tail, "fallback": fallback}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8, help="Threads calling the LLM at once")
+    parser.add_argument("--phase-seconds", type=float, default=3.0)
+    parser.add_argument("--latency-ms", type=float, default=100.0, help="Stub LLM latency")
+    parser.add_argument("--read-timeout", type=float, default=1.0, help="Read timeout of the client, in seconds")
+    parser.add_argument("--capacity", type=int, default=4, help="Requests the overloaded stub serves at once")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated subset of " + ", ".join(SCENARIOS))
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    rows = []
+    for name in args.scenarios.split(","):
+        SCENARIOS[name](args, rows)
+    print(f"{args.threads} threads, stub LLM latency {args.latency_ms} ms, read timeout {args.read_timeout}s, "
+          f"OpenAI client retries 2")
+    print_table(["scenario", "client", "phase", "ok", "failed", "ok_per_s", "ok_p50_ms", "ok_p99_ms",
+                 "failed_p50_ms", "server_requests", "layers"], rows)
+
+
+if __name__ == "__main__":
+    main()
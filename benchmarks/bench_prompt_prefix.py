@@ -0,0 +1,112 @@
+"""
+Share of the prompt tokens a prefix-caching LLM server can reuse, per prompt
+template of common/prompts.py.
+
+    python -m benchmarks.bench_prompt_prefix --messages 50
+
+Each message goes through the guardian (per-harm checks, one after the
+other), the router and the structure processor, against the stub LLM server,
+which reports the prompt tokens its simulated prefix cache would have served
+(`cached_tokens`). The guardian runs with version 1 of its per-harm prompt,
+where the harm name comes first and no two checks of a message share a
+prefix, and with version 2, where a fixed system prompt and the message come
+first and only the short question about the harm differs.
+
+The messages are distinct emails of a few hundred characters; the LLM
+response cache is off, so every check reaches the server.
+"""
+import argparse
+import logging
+import random
+import uuid
+
+from benchmarks.stub_llm import start_stub_server
+from benchmarks.util import configure_llm_env, print_table
+from models import OuterWrapper
+
+ROUTER_REPLY = '{"route": "finance", "reason": "A billing question.", "escalation_required": false}'
+
+ISSUES = [
+    "I was charged twice for invoice {ref} and would like a refund of the second payment.",
+    "The Gizmo-X I ordered ({ref}) stops responding after the latest firmware update, even after a reset.",
+    "I cannot log in to the website since the password reset email for account {ref} never arrives.",
+    "Please send me the receipt for order {ref}; the download link in my account page is broken.",
+]
+
+
+def make_messages(count, seed=7):
+    """Distinct support emails of a few hundred characters."""
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        ref = uuid.UUID(int=rng.getrandbits(128)).hex[:10]
+        issue = rng.choice(ISSUES).format(ref=ref)
+        content = (
+            f"Hello support team,\n\n{issue} I have been a customer for {rng.randint(1, 12)} years and this is the "
+            f"first time something like this happens. I already tried the steps in your help center, without "
+            f"success. Could you please look into it as soon as possible?\n\nBest regards,\nCustomer {i} "
+            f"(customer{i}@example.com, +1 555 01{i:02d})"
+        )
+        messages.append(OuterWrapper(message_id=str(uuid.uuid4()), content=content))
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="Stub LLM latency")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency_ms=args.latency_ms)
+    stub_stats = server.RequestHandlerClass.stats
+    configure_llm_env(base_url)
+    logging.disable(logging.WARNING)
+    # Imported after the environment points at the stub server.
+    from common.llm_telemetry import call_stats
+    from common.prompts import get_prompt
+    import svc_guardian_processor.app as guardian_app
+    import svc_router.app as router_app
+    import svc_structure_processor.app as structure_app
+
+    def guardian(version):
+        processor = guardian_app.MessageProcessor(concurrency=1, mode=guardian_app.GUARDIAN_MODE_PER_HARM)
+        processor.harm_prompt = get_prompt("guardian.harm", version)
+        return processor
+
+    variants = [
+        ("guardian", lambda: guardian(1), "No"),
+        ("guardian", lambda: guardian(2), "No"),
+        ("router", router_app.MessageProcessor, ROUTER_REPLY),
+        ("structure", structure_app.MessageProcessor, "stub"),
+    ]
+    rows = []
+    for service, make_processor, reply in variants:
+        processor = make_processor()
+        processor.cache.backend = None
+        template = (processor.harm_prompt if service == "guardian" else processor.prompt).id
+        server.RequestHandlerClass.config.reply = reply
+        # A fresh prefix cache per variant, and the same messages for all of them.
+        stub_stats.reset()
+        errors = 0
+        for message in make_messages(args.messages):
+            result = processor.process(message)
+            errors += len([e for e in result.error if not e.startswith("guardian:detected")])
+        snapshot = stub_stats.snapshot()
+        prompt_tokens, cached_tokens = snapshot["prompt_tokens"], snapshot["cached_tokens"]
+        rows.append([service, template, snapshot["requests"], prompt_tokens / args.messages,
+                     cached_tokens / args.messages, 100.0 * cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+                     (prompt_tokens - cached_tokens) / args.messages, errors])
+
+    print(f"{args.messages} messages; tokens per message as counted by the stub LLM's prefix cache")
+    print_table(["service", "template", "llm_calls", "prompt_tokens", "cached_tokens", "cached_%",
+                 "uncached_tokens", "errors"], rows)
+    print("\nAs recorded by the services' LLM telemetry (GET /stats, llm_calls.templates):")
+    print_table(["template", "calls", "prompt_tokens", "cached_tokens", "cached_%"],
+                [[template, totals["calls"], totals["prompt_tokens"], totals["cached_tokens"],
+                  100.0 * totals["cached_share"]]
+                 for template, totals in call_stats.stats()["templates"].items()])
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
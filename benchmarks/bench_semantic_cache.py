@@ -0,0 +1,144 @@
+"""
+Semantic cache of the router: hit rate and wrong hits per similarity
+threshold, and the routing latency with and without the cache.
+
+    python -m benchmarks.bench_semantic_cache --latency-ms 300 --thresholds 0.6,0.75,0.9
+
+The messages are paraphrases of a few issues, replayed in random order. The
+threshold sweep feeds them through a SemanticCache that stores each message's
+issue, so a hit that returns another issue counts as wrong. It uses the stub
+LLM's bag-of-words embeddings, unless `--embeddings-url` and
+`--embedding-model` point at a real OpenAI-compatible server, which is the way
+to calibrate ROUTER_SEMANTIC_CACHE_THRESHOLD for a model. The latency run
+routes the same messages through svc_router against the stub LLM, with the
+cache off and on.
+"""
+import argparse
+import logging
+import os
+import random
+import time
+
+from openai import OpenAI
+
+from benchmarks.stub_llm import fake_embedding, start_stub_server
+from benchmarks.util import configure_llm_env, latency_summary, print_table
+from common.semantic_cache import SemanticCache
+from models import OuterWrapper
+
+ISSUES = {
+    "password": [
+        "I forgot my password, how do I reset it?",
+        "Please help me reset my password.",
+        "I can't remember my password and need to reset it.",
+        "How can I reset the password for my account?",
+        "Password reset needed, I forgot my password.",
+    ],
+    "invoice": [
+        "Where is my invoice for last month?",
+        "I did not receive my invoice for last month.",
+        "Can you send me the invoice for last month?",
+        "My invoice for last month is missing, where is it?",
+        "Please resend last month's invoice.",
+    ],
+    "refund": [
+        "I was charged twice and want a refund.",
+        "Please refund the double charge on my card.",
+        "You charged me twice, I want a refund for one of them.",
+        "Refund request: my card was charged twice.",
+        "I need a refund because I was charged twice this month.",
+    ],
+    "device": [
+        "My Gizmo-X does not turn on anymore.",
+        "The Gizmo-X won't turn on after charging.",
+        "Gizmo-X is dead, it does not turn on.",
+        "My new Gizmo-X device does not power on.",
+        "The Gizmo-X doesn't turn on, what should I do?",
+    ],
+    "login": [
+        "The login page of your website shows an error.",
+        "Your website login page gives me an error.",
+        "I get an error on the website when I try to log in.",
+        "Login on the website fails with an error page.",
+        "Error on your login page, the website is broken.",
+    ],
+}
+
+
+def make_messages(amplify, seed=7):
+    messages = [(issue, text) for issue, texts in ISSUES.items() for text in texts] * amplify
+    random.Random(seed).shuffle(messages)
+    return messages
+
+
+def sweep(messages, thresholds, embed):
+    rows = []
+    vectors = [embed(text) for _, text in messages]
+    for threshold in thresholds:
+        cache = SemanticCache(max_size=len(messages), threshold=threshold)
+        hits = wrong = 0
+        for (issue, _), vector in zip(messages, vectors):
+            hit = cache.lookup(vector)
+            if hit:
+                hits += 1
+                wrong += hit[0] != issue
+            else:
+                cache.add(vector, issue)
+        rows.append([threshold, f"{hits / len(messages):.0%}", wrong, len(cache.values)])
+    return rows
+
+
+def route_all(app_module, messages):
+    latencies = []
+    for i, (_, text) in enumerate(messages):
+        started = time.perf_counter()
+        app_module.processor.process(OuterWrapper(message_id=f"bench-{i}", content=text))
+        latencies.append(time.perf_counter() - started)
+    return latency_summary(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="Stub LLM latency")
+    parser.add_argument("--amplify", type=int, default=4, help="Replay the paraphrases this many times")
+    parser.add_argument("--thresholds", default="0.5,0.6,0.7,0.8,0.9")
+    parser.add_argument("--embeddings-url", help="OpenAI-compatible server for the threshold sweep")
+    parser.add_argument("--embedding-model", default="nomic-embed-text")
+    args = parser.parse_args()
+
+    messages = make_messages(args.amplify)
+    if args.embeddings_url:
+        client = OpenAI(base_url=args.embeddings_url, api_key=os.getenv("LLM_API_KEY", "not-needed"))
+        embed = lambda text: client.embeddings.create(model=args.embedding_model, input=text).data[0].embedding
+        source = f"'{args.embedding_model}' at {args.embeddings_url}"
+    else:
+        embed, source = fake_embedding, "the stub's bag-of-words embeddings"
+    print(f"{len(messages)} messages, paraphrases of {len(ISSUES)} issues; embeddings from {source}")
+    print_table(["threshold", "hit_rate", "wrong_hits", "entries"], sweep(messages, [float(t) for t in args.thresholds.split(",")], embed))
+
+    server, base_url = start_stub_server(latency_ms=args.latency_ms)
+    configure_llm_env(base_url)
+    # Only the semantic cache: the exact-match cache would answer the repeated texts.
+    os.environ["LLM_CACHE_BACKEND"] = "none"
+    os.environ["ROUTER_SEMANTIC_CACHE_PATH"] = ""
+    logging.disable(logging.WARNING)
+
+    # Imported after the environment points at the stub server.
+    import svc_router.app as app_module
+
+    rows = []
+    app_module.processor.semantic_cache = None
+    rows.append(["off"] + list(route_all(app_module, messages).values()) + ["", ""])
+    app_module.processor.semantic_cache = SemanticCache(max_size=1000, threshold=app_module.ROUTER_SEMANTIC_CACHE_THRESHOLD)
+    summary = route_all(app_module, messages)
+    stats = app_module.processor.semantic_cache.stats()
+    rows.append(["on"] + list(summary.values()) + [f"{stats['hit_rate']:.0%}", stats["saved_seconds"]])
+
+    print(f"\nRouting through svc_router, stub LLM latency {args.latency_ms} ms, "
+          f"threshold {app_module.ROUTER_SEMANTIC_CACHE_THRESHOLD}")
+    print_table(["semantic_cache", "p50_ms", "p99_ms", "mean_ms", "hit_rate", "saved_s"], rows)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Latency of the structure processor's extraction with and without streaming,
+and how cut-offs by the timeout or the token budget end.
+
+    python -m benchmarks.bench_structure_stream --latency-ms 200 --token-ms 20
+
+The stub LLM waits `--latency-ms` before the first chunk of its reply and
+`--token-ms` between chunks of 16 characters. Without streaming, the first
+field is only available with the whole reply. The cut-off runs lower the
+timeout and the token budget below what the reply needs.
+"""
+import argparse
+import logging
+import os
+import time
+
+from prometheus_client import REGISTRY
+
+from benchmarks.stub_llm import start_stub_server
+from benchmarks.util import configure_llm_env, latency_summary, print_table
+from models import OuterWrapper
+
+SAMPLE_CONTENT = (
+    "Hello, I was charged twice for my Gizmo-X subscription this month and would like a refund. "
+    "Regards, John Smith, Global Tech Inc., john.smith@globaltech.com"
+)
+
+
+def first_field_sum():
+    return REGISTRY.get_sample_value("triage_llm_first_field_seconds_sum") or 0.0
+
+
+def run(app_module, iterations):
+    """Returns (first-field latencies, total latencies, outcome counts) of `iterations` messages."""
+    first_field, total, outcomes = [], [], {"complete": 0, "partial": 0, "error": 0}
+    for i in range(iterations):
+        message = OuterWrapper(message_id=f"bench-{i}", content=SAMPLE_CONTENT)
+        before = first_field_sum()
+        started = time.perf_counter()
+        app_module.processor.process(message)
+        elapsed = time.perf_counter() - started
+        total.append(elapsed)
+        # Without streaming the fields arrive with the whole reply.
+        first_field.append(first_field_sum() - before if app_module.STRUCTURE_STREAMING else elapsed)
+        if message.error:
+            outcomes["error"] += 1
+        elif "structure_partial" in message.metadata:
+            outcomes["partial"] += 1
+        else:
+            outcomes["complete"] += 1
+    return first_field, total, outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Stub LLM latency before the first chunk")
+    parser.add_argument("--token-ms", type=float, default=20.0, help="Stub LLM time per chunk of output")
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency_ms=args.latency_ms, token_ms=args.token_ms)
+    configure_llm_env(base_url)
+    # Every message must reach the stub: no cached answers, and no breaker opened by the timed-out runs.
+    os.environ["LLM_CACHE_BACKEND"] = "none"
+    os.environ["LLM_BREAKER_FAILURES"] = "0"
+    # The cut-off runs log an error per message.
+    logging.disable(logging.ERROR)
+
+    # Imported after the environment points at the stub server.
+    import svc_structure_processor.app as app_module
+
+    default_timeout, default_max_tokens = app_module.STRUCTURE_TIMEOUT_SECONDS, app_module.STRUCTURE_MAX_TOKENS
+    # The reply is about 12 chunks long: the timeout lands after the first fields, the budget just before the end.
+    cutoff_timeout = (args.latency_ms + 6 * args.token_ms) / 1000.0
+    variants = (
+        ("non-streaming", False, default_timeout, default_max_tokens),
+        ("streaming", True, default_timeout, default_max_tokens),
+        ("non-streaming timeout", False, cutoff_timeout, default_max_tokens),
+        ("streaming timeout", True, cutoff_timeout, default_max_tokens),
+        ("streaming max-tokens", True, default_timeout, 40),
+    )
+    rows = []
+    for name, streaming, timeout, max_tokens in variants:
+        app_module.STRUCTURE_STREAMING = streaming
+        app_module.STRUCTURE_TIMEOUT_SECONDS = timeout
+        app_module.STRUCTURE_MAX_TOKENS = max_tokens
+        first_field, total, outcomes = run(app_module, args.iterations)
+        first_field, total = latency_summary(first_field), latency_summary(total)
+        rows.append([
+            name, first_field["p50_ms"], total["p50_ms"], total["p99_ms"],
+            outcomes["complete"], outcomes["partial"], outcomes["error"],
+        ])
+
+    print(f"Stub LLM latency: {args.latency_ms} ms, {args.token_ms} ms per chunk")
+    print_table(["mode", "first_field_p50_ms", "total_p50_ms", "total_p99_ms", "complete", "partial", "error"], rows)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
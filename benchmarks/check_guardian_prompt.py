@@ -0,0 +1,121 @@
+"""
+Checks that a guardian model answers the per-harm prompt versions of
+common/prompts.py with a plain Yes or No, and compares their accuracy on
+labelled messages. Exits with an error if a check fails.
+
+    python -m benchmarks.check_guardian_prompt --base-url http://localhost:11434/v1 --model granite3-guardian:2b
+
+Version 1 of `guardian.harm` is the format Granite Guardian was trained on:
+the harm name as system prompt, the message as user turn. Version 2 puts a
+fixed English instruction and the message first, for prefix caching, and asks
+about the harm last. Granite Guardian gets version 1 by default; run this
+before pinning it to version 2 with PROMPT_VERSIONS, and with any other
+guardian model before relying on version 2.
+
+`--samples` is a JSON-lines file with a `content` and the list of its `harms`
+per line; `guardian_samples.jsonl` next to this script is used by default.
+Every message is checked for every harm of models.HARMS_TO_CHECK, with the
+guardian service's own request. The script fails if any answer of a version
+is not Yes or No, or if version 2 gets more checks wrong than version 1 plus
+`--max-extra-errors`. Without `--base-url` it runs against the stub LLM
+server, which only exercises the requests and the parsing.
+"""
+import argparse
+import json
+import logging
+import os
+
+from benchmarks.stub_llm import start_stub_server
+from benchmarks.util import configure_llm_env, print_table
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "guardian_samples.jsonl")
+VERSIONS = (1, 2)
+
+
+def load_samples(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def parse_answer(text):
+    """'yes' or 'no' if the answer is a plain Yes or No, give or take case and punctuation, otherwise None."""
+    answer = text.strip().strip(".!").strip().lower()
+    return answer if answer in ("yes", "no") else None
+
+
+def run_version(processor, version, samples, harms):
+    """Returns (unparsed (harm, answer) pairs, wrong checks, checks) of one prompt version."""
+    from common.prompts import get_prompt
+
+    processor.harm_prompt = get_prompt("guardian.harm", version)
+    unparsed, wrong, checks = [], 0, 0
+    for sample in samples:
+        for harm in harms:
+            completion = processor.client.chat.completions.create(
+                model=os.environ["LLM_MODEL_NAME"],
+                messages=processor._harm_messages(sample["content"], harm),
+                max_tokens=5,
+                temperature=0.0,
+                extra_headers=processor.harm_prompt.headers(),
+            )
+            text = completion.choices[0].message.content or ""
+            answer = parse_answer(text)
+            checks += 1
+            if answer is None:
+                unparsed.append((harm, text))
+            # What the guardian service makes of the answer
+            if ("yes" in text.strip().lower()) != (harm in sample["harms"]):
+                wrong += 1
+    return unparsed, wrong, checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", help="OpenAI-compatible server with the guardian model; the stub if unset")
+    parser.add_argument("--model", default="granite3-guardian-2b")
+    parser.add_argument("--api-key", default="not-needed")
+    parser.add_argument("--samples", default=SAMPLES)
+    parser.add_argument("--max-extra-errors", type=int, default=0,
+                        help="Checks version 2 may get wrong beyond those version 1 gets wrong")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if not base_url:
+        server, base_url = start_stub_server(latency_ms=1.0, reply="No")
+    configure_llm_env(base_url, args.model)
+    os.environ["LLM_API_KEY"] = args.api_key
+    os.environ["LLM_CACHE_BACKEND"] = "none"
+    os.environ["GUARDIAN_MODE"] = "per-harm"
+    logging.disable(logging.WARNING)
+    # Imported after the environment points at the server.
+    import svc_guardian_processor.app as guardian_app
+    from models import HARMS_TO_CHECK
+
+    processor = guardian_app.MessageProcessor(concurrency=1, mode=guardian_app.GUARDIAN_MODE_PER_HARM)
+    samples = load_samples(args.samples)
+    results = {version: run_version(processor, version, samples, HARMS_TO_CHECK) for version in VERSIONS}
+    if server:
+        server.shutdown()
+
+    print(f"Model '{args.model}' at {base_url}, {len(samples)} messages x {len(HARMS_TO_CHECK)} harms")
+    print_table(["template", "checks", "not_yes_no", "wrong"],
+                [[f"guardian.harm@v{v}", checks, len(unparsed), wrong] for v, (unparsed, wrong, checks) in results.items()])
+    failures = []
+    for version, (unparsed, _, _) in results.items():
+        for harm, text in unparsed[:5]:
+            print(f"v{version} answered {text!r} to the check for '{harm}'")
+        if unparsed:
+            failures.append(f"version {version} got {len(unparsed)} answers that are not Yes or No")
+    extra = results[2][1] - results[1][1]
+    if extra > args.max_extra_errors:
+        failures.append(f"version 2 gets {extra} more checks wrong than version 1")
+    for failure in failures:
+        print(f"FAIL  {failure}")
+    if failures:
+        raise SystemExit(1)
+    print("All checks passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Self-checking run of the LLM client's resilience layers, all combined,
+against the stub LLM server. Exits with an error if a check fails.
+
+    python -m benchmarks.check_llm_resilience
+
+The client is the one the services use (common/llm.py's
+create_openai_client), built from LLM_* settings that turn on every layer:
+hedging, the adaptive limit, the circuit breaker and the in-flight cap. The
+script checks that
+
+- hedged requests are accounted for: each hedge reaches the server once more,
+  its loser is closed, and a winner is counted per hedge;
+- the circuit breaker opens after the configured failures, rejects requests
+  without calling the server while open, and closes again after a probe;
+- requests the adaptive limit rejects locally do not count as failures of the
+  server, so a burst of them leaves the breaker closed;
+- the adaptive limit shrinks on the failures and grows back on the successes;
+- no adaptive or in-flight slot is left taken, and no request waits forever
+  for one.
+"""
+import logging
+import os
+import threading
+import time
+
+SETTINGS = {
+    "LLM_MAX_RETRIES": "0",
+    "LLM_MAX_IN_FLIGHT": "3",
+    "LLM_ADAPTIVE_MAX_IN_FLIGHT": "6",
+    "LLM_ADAPTIVE_MIN_IN_FLIGHT": "1",
+    "LLM_ADMISSION_TIMEOUT_SECONDS": "5",
+    "LLM_BREAKER_FAILURES": "3",
+    "LLM_BREAKER_RESET_SECONDS": "0.5",
+    "LLM_HEDGE_PERCENTILE": "90",
+    "LLM_READ_TIMEOUT_SECONDS": "5",
+}
+# Set before common.llm is imported, as it reads them at import time.
+os.environ.update(SETTINGS)
+
+import openai  # noqa: E402
+
+from benchmarks.stub_llm import start_stub_server  # noqa: E402
+from common import llm  # noqa: E402
+from common.llm_resilience import (  # noqa: E402
+    OPEN, CLOSED, AdaptiveConcurrencyTransport, CircuitBreakerTransport, HedgingTransport,
+)
+
+MESSAGES = [{"role": "user", "content": "Is this message harmful? I was charged twice for my subscription."}]
+CALL_TIMEOUT_SECONDS = 20.0
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def check(condition, description):
+    if not condition:
+        raise CheckFailed(description)
+    print(f"ok    {description}")
+
+
+def wait_for(condition, timeout=5.0):
+    """Polls condition until it holds or the timeout passes; returns its last value."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+
+def call(client):
+    """One chat completion; returns True on success and False on an API error."""
+    try:
+        client.chat.completions.create(model="stub-model", messages=MESSAGES)
+        return True
+    except openai.APIError:
+        return False
+
+
+def run_calls(client, calls, threads=1):
+    """Makes `calls` calls from `threads` threads; returns their results, or fails if a call hangs."""
+    results = []
+    remaining = iter(range(calls))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            result = call(client)
+            with lock:
+                results.append(result)
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(threads)]
+    for worker_thread in workers:
+        worker_thread.start()
+    deadline = time.monotonic() + CALL_TIMEOUT_SECONDS
+    for worker_thread in workers:
+        worker_thread.join(max(0.0, deadline - time.monotonic()))
+    check(not any(t.is_alive() for t in workers),
+          f"{calls} calls from {threads} thread{'s' if threads > 1 else ''} finish (no slot left taken)")
+    return results
+
+
+def in_flight_slots_free(slots, count):
+    """Whether all `count` slots of the in-flight cap can be taken at once, i.e. none is held."""
+    taken = 0
+    while taken < count and slots.acquire(blocking=False):
+        taken += 1
+    for _ in range(taken):
+        slots.release()
+    return taken == count
+
+
+def layer(kind):
+    return next(layer for layer in llm._resilience_layers if isinstance(layer, kind))
+
+
+def main():
+    logging.disable(logging.WARNING)
+    server, base_url = start_stub_server(latency_ms=20.0)
+    config, stats = server.RequestHandlerClass.config, server.RequestHandlerClass.stats
+    client = llm.create_openai_client("not-needed", base_url)
+    hedging = layer(HedgingTransport)
+    adaptive = layer(AdaptiveConcurrencyTransport)
+    breaker = layer(CircuitBreakerTransport)
+    max_in_flight = int(SETTINGS["LLM_MAX_IN_FLIGHT"])
+    max_limit = int(SETTINGS["LLM_ADAPTIVE_MAX_IN_FLIGHT"])
+    failures = int(SETTINGS["LLM_BREAKER_FAILURES"])
+
+    def idle():
+        return (adaptive.stats()["in_flight"] == 0 and stats.in_flight == 0
+                and in_flight_slots_free(llm._in_flight_slots, max_in_flight))
+
+    try:
+        # Enough calls for hedging to know the usual latency.
+        check(all(run_calls(client, hedging.min_samples + 5)), "warm-up calls succeed")
+        check(hedging.stats()["hedge_after_ms"] is not None, "hedging has a delay after the warm-up")
+        check(idle(), "no slot held after the warm-up")
+
+        # Tail: a third of the requests are slow, so many get a second copy.
+        config.slow_rate, config.slow_ms = 0.3, 400.0
+        before, received = hedging.stats(), stats.snapshot()["received"]
+        calls = 40
+        successes = sum(run_calls(client, calls, threads=6))
+        config.slow_rate = 0.0
+        check(successes == calls, f"all {calls} calls with slow requests succeed ({successes})")
+        check(wait_for(lambda: hedging.stats()["losers_discarded"] - before["losers_discarded"]
+                       == hedging.stats()["hedged"] - before["hedged"]),
+              "the losing copy of every hedged request is closed")
+        after = hedging.stats()
+        hedged = after["hedged"] - before["hedged"]
+        check(hedged > 0, f"slow requests are hedged ({hedged} of {calls})")
+        check(0 < after["hedge_wins"] - before["hedge_wins"] <= hedged,
+              f"hedges win some of the hedged requests ({after['hedge_wins'] - before['hedge_wins']} of {hedged})")
+        check(wait_for(lambda: stats.snapshot()["received"] - received == calls + hedged),
+              "the server received one request per call plus one per hedge")
+        check(wait_for(idle), "no adaptive, in-flight or server slot held after hedging")
+
+        # Overload on this side: the adaptive limit turns requests away while the server is healthy.
+        config.slow_rate, config.slow_ms = 1.0, 300.0
+        adaptive.limit, adaptive.admission_timeout = 1.0, 0.05
+        rejected = adaptive.stats()["rejected"]
+        results = run_calls(client, 12, threads=3)
+        adaptive.admission_timeout = float(SETTINGS["LLM_ADMISSION_TIMEOUT_SECONDS"])
+        config.slow_rate = 0.0
+        rejected = adaptive.stats()["rejected"] - rejected
+        check(rejected >= failures, f"the adaptive limit rejects requests locally ({rejected} of {len(results)})")
+        check(breaker.stats()["state"] == CLOSED and breaker.stats()["consecutive_failures"] == 0,
+              "the local rejections leave the breaker closed")
+        check(wait_for(idle), "no slot held after the local rejections")
+
+        # Outage: every request fails. The breaker opens after `failures` calls in a row.
+        config.error_rate = 1.0
+        received = stats.snapshot()["received"]
+        results = run_calls(client, failures + 5)
+        check(not any(results), "calls fail during the outage")
+        check(breaker.stats()["state"] == OPEN, "the breaker opens after the failures")
+        check(stats.snapshot()["received"] - received == failures,
+              f"only {failures} calls reach the server, the open breaker rejects the others")
+        shrunk = adaptive.stats()["limit"]
+        check(shrunk < max_limit and adaptive.stats()["decreases"] > 0,
+              f"the adaptive limit shrinks on the failures ({max_limit} -> {shrunk})")
+        check(wait_for(idle), "no slot held during the outage")
+
+        # Recovery: after the reset time a probe goes through and closes the breaker.
+        config.error_rate = 0.0
+        time.sleep(float(SETTINGS["LLM_BREAKER_RESET_SECONDS"]) + 0.1)
+        check(all(run_calls(client, 1)), "the probe after the reset time succeeds")
+        check(breaker.stats()["state"] == CLOSED, "the breaker closes after the probe")
+        calls = 60
+        successes = sum(run_calls(client, calls, threads=6))
+        check(successes == calls, f"all {calls} calls after the recovery succeed ({successes})")
+        grown = adaptive.stats()["limit"]
+        check(grown > shrunk, f"the adaptive limit grows back on the successes ({shrunk} -> {grown})")
+        check(wait_for(idle), "no slot held at the end")
+    except CheckFailed as e:
+        print(f"FAIL  {e}")
+        print(f"Layers: {llm.resilience_stats()}")
+        raise SystemExit(1)
+    finally:
+        server.shutdown()
+    print("All checks passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Offline evaluation of the router's keyword pre-classifier on labelled messages.
+
+    python -m benchmarks.eval_router_rules --thresholds 0.6,0.7,0.8,0.9
+
+`--samples` is a JSON-lines file with a `content` and the expected `route`
+(support, finance, website or unknown) per line; `router_samples.jsonl` next to
+this script is used by default. For every threshold it reports the coverage
+(the share of messages the rules route without the LLM) and the accuracy on
+those messages. With `--show-errors`, the wrong confident routes are listed.
+Messages labelled `unknown` can never be routed correctly by the rules, so
+every confident route on them counts as wrong.
+"""
+import argparse
+import json
+import os
+
+from benchmarks.util import print_table
+from common.preprocess import reduce_content
+from models import Route
+from svc_router.preclassifier import RulePreclassifier
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "router_samples.jsonl")
+
+
+def load_samples(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def evaluate(samples, threshold):
+    """Returns (coverage, accuracy on the covered messages, wrong (expected, got, reason, content) tuples)."""
+    preclassifier = RulePreclassifier(threshold)
+    covered, correct, wrong = 0, 0, []
+    for sample in samples:
+        selection = preclassifier.classify(reduce_content(sample["content"]))
+        if selection is None:
+            continue
+        covered += 1
+        if selection.route == Route(sample["route"]):
+            correct += 1
+        else:
+            wrong.append((sample["route"], selection.route.value, selection.reason, sample["content"]))
+    return covered / len(samples), correct / covered if covered else float("nan"), wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", default=SAMPLES, help="JSON-lines file of labelled messages")
+    parser.add_argument("--thresholds", default="0.5,0.6,0.7,0.8,0.9")
+    parser.add_argument("--show-errors", action="store_true", help="List the messages routed wrongly")
+    args = parser.parse_args()
+
+    samples = load_samples(args.samples)
+    rows, errors = [], {}
+    for threshold in [float(t) for t in args.thresholds.split(",")]:
+        coverage, accuracy, wrong = evaluate(samples, threshold)
+        rows.append([threshold, f"{coverage:.0%}", f"{accuracy:.0%}", len(wrong)])
+        errors[threshold] = wrong
+
+    print(f"{len(samples)} labelled messages from {args.samples}")
+    print_table(["threshold", "coverage", "accuracy", "wrong"], rows)
+    if args.show_errors:
+        for threshold, wrong in errors.items():
+            for expected, got, reason, content in wrong:
+                print(f"\n[{threshold}] expected {expected}, got {got} ({reason}):\n  {content}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Stands in for the customer database in local benchmarks.
+
+`install()` replaces `psycopg2.connect` with a function returning connections
+to an in-memory SQLite copy of `db_customer/data.sql`, so svc_customer_lookup
+runs its real pool, cache and queries without a Postgres server. Only what
+the lookup's database mode uses is implemented: `%s` parameters,
+`= ANY(%s)` with a list, fetchone/fetchall and the attributes the psycopg2
+pool checks.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+DATA_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "db_customer", "data.sql")
+
+# data.sql leaves updated_at to its default, which SQLite does not do for positional inserts.
+SCHEMA = (
+    "CREATE TABLE customers (customer_id TEXT PRIMARY KEY, company_name TEXT, contact_name TEXT, "
+    "contact_email TEXT UNIQUE, country TEXT, phone TEXT)"
+)
+
+ANY_PARAM = re.compile(r"=\s*ANY\(%s\)")
+
+
+class FakeDatabase:
+    """One SQLite database shared by every fake connection, with optional per-query latency."""
+
+    def __init__(self, query_latency_ms=0.0):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.lock = threading.Lock()
+        self.query_latency_ms = query_latency_ms
+        self.conn.execute(SCHEMA)
+        with open(DATA_SQL) as f:
+            self.conn.executescript(f.read())
+
+    def emails(self):
+        return [row[0] for row in self.conn.execute("SELECT contact_email FROM customers")]
+
+    def execute(self, query, params):
+        params = list(params or ())
+        # `x = ANY(%s)` with a list becomes `x IN (?, ?, ...)`.
+        for i, param in enumerate(params):
+            if isinstance(param, (list, tuple)):
+                query = ANY_PARAM.sub("IN (" + ", ".join("?" * len(param)) + ")", query, count=1)
+                params[i:i + 1] = param
+                break
+        if self.query_latency_ms:
+            time.sleep(self.query_latency_ms / 1000.0)
+        with self.lock:
+            return self.conn.execute(query.replace("%s", "?"), params).fetchall()
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, query, params=None):
+        self.rows = self.db.execute(query, params)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        self.rows = []
+
+
+class _Info:
+    transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.closed = 0
+        self.autocommit = False
+        self.info = _Info()
+
+    def cursor(self, name=None):
+        return FakeCursor(self.db)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+def install(query_latency_ms=0.0):
+    """Patches psycopg2.connect and returns the FakeDatabase behind it."""
+    db = FakeDatabase(query_latency_ms)
+    psycopg2.connect = lambda *args, **kwargs: FakeConnection(db)
+    return db
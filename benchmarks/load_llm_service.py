@@ -0,0 +1,119 @@
+"""
+Requests per second one pod of an LLM service sustains against a slow LLM.
+
+    python -m benchmarks.load_llm_service --service svc_router --latency-ms 500
+
+Starts the stub LLM server and the service under gunicorn once per worker
+class, then keeps `--clients` concurrent requests in flight for `--duration`
+seconds. With the default sync worker each worker is blocked for the whole
+LLM round trip; with the gevent worker one worker keeps many round trips in
+flight (bounded by LLM_MAX_IN_FLIGHT if set).
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+from benchmarks.stub_llm import start_stub_server
+from benchmarks.util import latency_summary, print_table
+
+WORKER_CLASSES = {
+    "sync": [],
+    "gevent": ["--worker-class", "gevent", "--worker-connections", "1000"],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_service(service, worker_class, workers, llm_base_url, extra_env):
+    port = free_port()
+    env = dict(os.environ, LLM_API_BASE_URL=llm_base_url, LLM_API_KEY="not-needed", LLM_MODEL_NAME="stub-model",
+               LLM_CACHE_BACKEND="none", **extra_env)
+    command = [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", str(workers),
+               "--log-level", "warning", *WORKER_CLASSES[worker_class], f"{service}.app:app"]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/healthz", timeout=5).ok:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{service} did not become healthy")
+
+
+def drive(url, clients, duration):
+    latencies, failures = [], [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        while time.monotonic() < stop_at:
+            # Unique content, so no response cache could short-circuit the LLM.
+            payload = {"message_id": str(uuid.uuid4()), "content": f"Please help with my invoice {uuid.uuid4()}"}
+            started = time.perf_counter()
+            try:
+                ok = session.post(url, json=payload, timeout=60).ok
+            except requests.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    failures[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, failures[0], time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--service", default="svc_router",
+                        choices=["svc_structure_processor", "svc_guardian_processor", "svc_router"])
+    parser.add_argument("--latency-ms", type=float, default=500.0)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--worker-classes", default="sync,gevent")
+    parser.add_argument("--max-in-flight", type=int, default=0, help="LLM_MAX_IN_FLIGHT for the service")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency_ms=args.latency_ms)
+    rows = []
+    for worker_class in args.worker_classes.split(","):
+        process, url = start_service(args.service, worker_class, args.workers, base_url,
+                                     {"LLM_MAX_IN_FLIGHT": str(args.max_in_flight)})
+        try:
+            latencies, failures, elapsed = drive(url, args.clients, args.duration)
+        finally:
+            process.terminate()
+            process.wait()
+        summary = latency_summary(latencies)
+        rows.append([worker_class, args.workers, len(latencies) / elapsed, summary["p50_ms"], summary["p99_ms"], failures])
+
+    print(f"{args.service}: stub LLM latency {args.latency_ms} ms, {args.clients} concurrent clients")
+    print_table(["worker", "workers", "req/s", "p50_ms", "p99_ms", "failed"], rows)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+Fan-out of Server-Sent Events to thousands of clients from one gevent worker.
+
+    python -m benchmarks.load_sse --clients 5000 --events 100 --rate 5
+
+Starts the ui_observer under gunicorn with one gevent worker, like its
+container, and opens `--clients` connections to /stream. Then it POSTs
+`--events` CloudEvents at `--rate` per second and measures how long each event
+takes to reach every client. A share of the clients (`--slow-share`) stops
+reading for `--slow-pause-seconds` with a small receive buffer: with more
+events published meanwhile than SSE_BUFFER_SIZE, they must skip ahead and
+still get the latest events, without being disconnected. Finally a client
+reconnects with the Last-Event-ID of an earlier event and must get exactly
+the events after it.
+
+With `--replicas`/`--workers`, clients and POSTs are spread over several
+observers, and `--backend sqlite` makes them share one stream.
+
+The clients run on one asyncio loop in this process, so at high client counts
+part of the measured latency is the clients' own parsing.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import requests
+
+from benchmarks.load_llm_service import free_port
+from benchmarks.util import latency_summary, print_table
+
+SENT_AT = re.compile(rb'"sent_at": ([0-9.]+), "n": ([0-9]+)')
+
+
+def start_observer(buffer_size, clients, workers, extra_env):
+    port = free_port()
+    env = dict(os.environ, SSE_BUFFER_SIZE=str(buffer_size), SSE_REPLAY_EVENTS="0", SSE_KEEPALIVE_SECONDS="5",
+               **extra_env)
+    command = [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", str(workers),
+               "--worker-class", "gevent", "--worker-connections", str(clients + 100), "--timeout", "0",
+               "--backlog", str(clients + 100), "--log-level", "warning", "ui_observer.app:app"]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/healthz", timeout=5).ok:
+                return process, port, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("ui_observer did not become healthy")
+
+
+class Client:
+    """One SSE connection, over HTTP/1.0 so the stream is not chunked."""
+
+    def __init__(self, port, slow=False, last_event_id=None):
+        self.port = port
+        self.slow = slow
+        self.last_event_id = last_event_id
+        self.received = []  # (n, latency seconds)
+        self.ids = []
+        self.skipped = 0
+        self.connected = asyncio.Event()
+        self.closed = False
+
+    async def run(self, pause_until=None):
+        sock = socket.socket()
+        if self.slow:
+            # A small buffer, so the server's writes block once this client stops reading
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", self.port))
+        # The stream reader stops reading from the socket at twice its limit
+        reader, writer = await asyncio.open_connection(sock=sock, limit=2 ** 16 if self.slow else 2 ** 20)
+        headers = f"Last-Event-ID: {self.last_event_id}\r\n" if self.last_event_id else ""
+        writer.write(f"GET /stream HTTP/1.0\r\nHost: localhost\r\n{headers}\r\n".encode())
+        await writer.drain()
+        try:
+            while True:
+                if pause_until and self.connected.is_set() and time.time() < pause_until:
+                    await asyncio.sleep(pause_until - time.time())
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.startswith(b": connected"):
+                    self.connected.set()
+                elif line.startswith(b": skipped"):
+                    self.skipped += int(line.split()[2])
+                elif line.startswith(b"id: "):
+                    self.ids.append(line[4:].strip().decode())
+                elif line.startswith(b"data: "):
+                    match = SENT_AT.search(line)
+                    if match:
+                        self.received.append((int(match.group(2)), time.time() - float(match.group(1))))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.closed = True
+            writer.close()
+
+
+def publish(urls, first, count, rate, padding_bytes, latencies):
+    """POSTs events one after the other, round-robin over the replicas."""
+    session = requests.Session()
+    interval = 1.0 / rate
+    started = time.monotonic()
+    for i in range(count):
+        time.sleep(max(0.0, started + i * interval - time.monotonic()))
+        n = first + i
+        headers = {"Content-Type": "application/json", "Ce-Type": "com.example.triage.benchmark",
+                   "Ce-Source": "load-sse", "Ce-Id": str(uuid.uuid4()), "Ce-Specversion": "1.0",
+                   "Ce-Subject": f"message-{n}"}
+        # Serialized by hand, so the pattern the clients look for is fixed
+        body = f'{{"sent_at": {time.time():.6f}, "n": {n}, "padding": "{"x" * padding_bytes}"}}'
+        posted = time.perf_counter()
+        ok = session.post(urls[n % len(urls)], data=body, headers=headers, timeout=30).ok
+        latencies.append(time.perf_counter() - posted)
+        if not ok:
+            raise RuntimeError(f"POST of event {n} failed")
+
+
+async def wait_for_event(clients, n, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(c.received and c.received[-1][0] == n for c in clients):
+            return
+        await asyncio.sleep(0.2)
+
+
+async def stop(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def fan_out(args, ports, urls):
+    """Every client reads; returns the table row, the resume check and the POST latencies."""
+    clients = [Client(ports[i % len(ports)]) for i in range(args.clients)]
+    tasks = []
+    connect_started = time.monotonic()
+    for i, client in enumerate(clients):
+        tasks.append(asyncio.create_task(client.run()))
+        if i % 200 == 199:
+            await asyncio.sleep(0.05)
+    await asyncio.wait_for(asyncio.gather(*(c.connected.wait() for c in clients)), timeout=120)
+    print(f"{len(clients)} clients connected to {len(urls)} replica(s) "
+          f"in {time.monotonic() - connect_started:.1f}s")
+
+    post_latencies = []
+    await asyncio.to_thread(publish, urls, 0, args.events, args.rate, 0, post_latencies)
+    await wait_for_event(clients, args.events - 1, timeout=30)
+
+    # A client that resumes from an earlier event gets exactly the ones after
+    # it, also from another replica.
+    reference = clients[0]
+    resume_from = len(reference.ids) - 1 - args.resume_events
+    resumed = Client(ports[-1], last_event_id=reference.ids[resume_from])
+    resume_task = asyncio.create_task(resumed.run())
+    await asyncio.sleep(1.0)
+    await stop([resume_task, *tasks])
+    resume_ok = [n for n, _ in resumed.received] == [n for n, _ in reference.received[resume_from + 1:]]
+
+    latencies = [latency for c in clients for _, latency in c.received]
+    summary = latency_summary(latencies)
+    # Events are POSTed one after the other, so every client must see them in that order.
+    in_order = sum(1 for c in clients if [n for n, _ in c.received] == list(range(args.events)))
+    row = ["fan-out", len(clients), sum(1 for c in clients if len(c.received) == args.events), in_order,
+           len(latencies), summary["p50_ms"], summary["p99_ms"], 0, "-"]
+    return row, resume_ok, len(resumed.received), post_latencies
+
+
+async def paused(args, ports, urls):
+    """
+    Paused clients next to a reading one, while a burst of large events
+    overflows both their socket buffers and the ring buffer.
+    """
+    first = args.events
+    pause_until = time.time() + args.slow_pause_seconds
+    reader = Client(ports[0])
+    slow_clients = [Client(ports[0], slow=True) for _ in range(args.slow_clients)]
+    tasks = [asyncio.create_task(reader.run())]
+    tasks += [asyncio.create_task(c.run(pause_until=pause_until)) for c in slow_clients]
+    await asyncio.gather(*(c.connected.wait() for c in [reader, *slow_clients]))
+
+    await asyncio.to_thread(publish, urls, first, args.burst_events, args.burst_rate, args.burst_padding_bytes, [])
+    last = first + args.burst_events - 1
+    await wait_for_event([reader, *slow_clients], last, timeout=args.slow_pause_seconds + 30)
+    await stop(tasks)
+
+    summary = latency_summary([latency for _, latency in reader.received])
+    rows = [
+        ["burst, reading", 1, int(len(reader.received) == args.burst_events), "-", len(reader.received),
+         summary["p50_ms"], summary["p99_ms"], reader.skipped, int(bool(reader.received and reader.received[-1][0] == last))],
+        ["burst, paused", len(slow_clients), sum(1 for c in slow_clients if len(c.received) == args.burst_events),
+         "-", sum(len(c.received) for c in slow_clients), "-", "-", sum(c.skipped for c in slow_clients),
+         sum(1 for c in slow_clients if c.received and c.received[-1][0] == last)],
+    ]
+    return rows
+
+
+async def run(args):
+    extra_env = {"SSE_BACKEND": args.backend}
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.backend == "sqlite":
+            # One file for all replicas, like a volume shared on the node
+            extra_env["SSE_SQLITE_PATH"] = os.path.join(tmp, "sse-events.sqlite3")
+        processes, ports, urls = [], [], []
+        try:
+            for _ in range(args.replicas):
+                process, port, url = start_observer(args.buffer_size, args.clients, args.workers, extra_env)
+                processes.append(process)
+                ports.append(port)
+                urls.append(url)
+            fan_out_row, resume_ok, resumed_count, post_latencies = await fan_out(args, ports, urls)
+            burst_rows = await paused(args, ports, urls)
+            stats = [requests.get(f"{url}/stats", timeout=10).json() for url in urls]
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    posts = latency_summary(post_latencies)
+    print(f"SSE_BACKEND={args.backend}, {args.replicas} replica(s) of {args.workers} worker(s)")
+    print(f"{args.events} events at {args.rate}/s to {args.clients} clients, then {args.burst_events} events of "
+          f"{args.burst_padding_bytes} bytes to {args.slow_clients} paused clients (SSE_BUFFER_SIZE={args.buffer_size})")
+    print(f"POST to the observer: p50 {posts['p50_ms']:.1f} ms, p99 {posts['p99_ms']:.1f} ms")
+    print_table(["phase", "clients", "got_all", "in_order", "deliveries", "p50_ms", "p99_ms", "skipped", "got_latest"],
+                [fan_out_row, *burst_rows])
+    print(f"Resume with Last-Event-ID, {args.resume_events} events back: "
+          f"{'ok' if resume_ok else 'MISMATCH'} ({resumed_count} events)")
+    for replica in stats:
+        print(f"Replica: {json.dumps(replica)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50.0, help="events published per second")
+    parser.add_argument("--backend", default="memory", choices=["memory", "sqlite"], help="SSE_BACKEND")
+    parser.add_argument("--replicas", type=int, default=1, help="observer instances, sharing the SQLite file")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers per replica")
+    parser.add_argument("--buffer-size", type=int, default=100, help="SSE_BUFFER_SIZE of the observer")
+    parser.add_argument("--resume-events", type=int, default=20)
+    parser.add_argument("--slow-clients", type=int, default=20)
+    parser.add_argument("--slow-pause-seconds", type=float, default=5.0)
+    parser.add_argument("--burst-events", type=int, default=300)
+    parser.add_argument("--burst-rate", type=float, default=200.0)
+    parser.add_argument("--burst-padding-bytes", type=int, default=20000,
+                        help="padding per burst event, so paused clients fill their socket buffers")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
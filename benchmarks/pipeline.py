@@ -0,0 +1,302 @@
+"""
+End-to-end benchmark of the triage pipeline on one machine, without a cluster.
+
+    python -m benchmarks.pipeline --rate 20 --amplify 5 --latency-ms 200
+
+Every service's Flask app is imported in-process. A small broker, listening on
+localhost as the intake service's K_SINK, delivers each event to the services
+whose `config/200-trigger.yaml` filters on its type (and to the unfiltered
+observers), then publishes their reply events in turn, just like the Knative
+Broker. The stub LLM server answers the LLM calls, and svc_customer_lookup
+queries an in-memory SQLite copy of db_customer/data.sql.
+
+The messages of `--requests` (a JSON-lines file; each line's `content`, or its
+`title` and `body`) are replayed `--amplify` times through the intake service
+at `--rate` messages per second. The report shows throughput, per-service
+latency percentiles and end-to-end latency from intake to the last event of
+each message, and the bytes of event payloads the Broker carried.
+
+`--mode combined` replaces the structure, guardian, customer lookup and router
+services with svc_combined_processor, and `--mode compare` runs both
+pipelines one after the other and compares their latency and LLM usage.
+"""
+import argparse
+import glob
+import importlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks import fake_postgres
+from benchmarks.stub_llm import start_stub_server
+from benchmarks.util import configure_llm_env, latency_summary, print_table
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRIGGER_TYPE = re.compile(r"^\s+type:\s*(\S+)", re.MULTILINE)
+INTAKE_PACKAGE = "svc_intake"
+COMBINED_PACKAGE = "svc_combined_processor"
+REPLACED_BY_COMBINED = {"svc_structure_processor", "svc_guardian_processor", "svc_customer_lookup", "svc_router"}
+MODES = ("multi-hop", "combined")
+
+
+def load_triggers(root=ROOT):
+    """
+    Returns (package, event_type) for every <package>/config/200-trigger.yaml.
+    event_type is None for a trigger without a filter, which gets every event.
+    """
+    triggers = []
+    for path in sorted(glob.glob(os.path.join(root, "*", "config", "200-trigger.yaml"))):
+        package = os.path.basename(os.path.dirname(os.path.dirname(path)))
+        with open(path) as f:
+            match = TRIGGER_TYPE.search(f.read())
+        triggers.append((package, match.group(1) if match else None))
+    return triggers
+
+
+def select_triggers(triggers, mode):
+    """The triggers of the services deployed in `mode`, like the default and the `combined` skaffold profile."""
+    if mode == "combined":
+        return [(package, event_type) for package, event_type in triggers if package not in REPLACED_BY_COMBINED]
+    return [(package, event_type) for package, event_type in triggers if package != COMBINED_PACKAGE]
+
+
+def load_corpus(path, amplify=1):
+    """Reads message contents from a JSON-lines file and repeats them `amplify` times."""
+    contents = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            content = record.get("content") or f"{record.get('title', '')}\n\n{record.get('body', '')}".strip()
+            if content:
+                contents.append(content)
+    return contents * amplify
+
+
+class Broker:
+    """
+    Delivers events to the subscribed apps on a pool of threads and follows
+    their reply events. An event that no subscriber replies to ends its
+    message's path through the pipeline.
+    """
+
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="broker")
+        self.lock = threading.Lock()
+        self.subscribe([])
+
+    def subscribe(self, triggers):
+        """Delivers events to the apps of `triggers` from now on, and clears the measurements."""
+        subscribers = [
+            (package, event_type, importlib.import_module(f"{package}.app").app)
+            for package, event_type in triggers
+        ]
+        with self.lock:
+            self.subscribers = subscribers
+            self.stage_latencies = defaultdict(list)
+            self.finished = {}
+            self.outcomes = Counter()
+            self.failures = Counter()
+            # Payload bytes of the published events, by event type
+            self.payload_bytes = Counter()
+
+    def publish(self, headers, body):
+        with self.lock:
+            self.payload_bytes[headers.get("Ce-Type")] += len(body)
+        self.pool.submit(self._deliver, headers, body)
+
+    def _deliver(self, headers, body):
+        event_type = headers.get("Ce-Type")
+        replies = []
+        for package, filter_type, app in self.subscribers:
+            if filter_type is not None and filter_type != event_type:
+                continue
+            started = time.perf_counter()
+            response = app.test_client().post("/", data=body, headers=headers)
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.stage_latencies[package].append(elapsed)
+                if response.status_code >= 300:
+                    self.failures[package] += 1
+            if response.headers.get("Ce-Type"):
+                reply_headers = {k: v for k, v in response.headers.items() if k.lower().startswith("ce-")}
+                reply_headers["Content-Type"] = "application/json"
+                replies.append((reply_headers, response.get_data()))
+
+        for reply in replies:
+            self.publish(*reply)
+        if not replies:
+            with self.lock:
+                self.finished[headers.get("Ce-Subject")] = time.perf_counter()
+                self.outcomes[event_type] += 1
+
+    def serve(self):
+        """Listens on localhost for the events the intake service sends to its K_SINK."""
+        broker = self
+
+        class IngressHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                broker.publish({k: v for k, v in self.headers.items()}, body)
+                self.send_response(202)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), IngressHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def replay(intake_app, contents, rate, clients, submitted, intake_latencies, failures):
+    """Sends each content to the intake service, open loop at `rate` messages per second."""
+    lock = threading.Lock()
+
+    def send(content):
+        started = time.perf_counter()
+        response = intake_app.test_client().post("/", json={"content": content})
+        elapsed = time.perf_counter() - started
+        with lock:
+            intake_latencies.append(elapsed)
+            if response.status_code == 202:
+                submitted[response.get_json()["eventId"]] = started
+            else:
+                failures[INTAKE_PACKAGE] += 1
+
+    with ThreadPoolExecutor(max_workers=clients, thread_name_prefix="client") as pool:
+        started = time.perf_counter()
+        for i, content in enumerate(contents):
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, content)
+
+
+def run(mode, broker, intake_app, triggers, contents, args, llm_stats):
+    """Replays the messages through the services of `mode` and prints the report. Returns the summary."""
+    broker.subscribe(select_triggers(triggers, mode))
+    llm_stats.reset()
+    print(f"\n=== {mode} ===")
+    print("Triggers: " + ", ".join(f"{package} <- {event_type or '*'}" for package, event_type, _ in broker.subscribers))
+    print(f"Replaying {len(contents)} messages at {args.rate}/s, stub LLM latency {args.latency_ms} ms")
+
+    submitted, intake_latencies = {}, []
+    started = time.perf_counter()
+    replay(intake_app, contents, args.rate, args.clients, submitted, intake_latencies, broker.failures)
+
+    deadline = time.perf_counter() + args.drain_seconds
+    while time.perf_counter() < deadline:
+        with broker.lock:
+            if all(message_id in broker.finished for message_id in submitted):
+                break
+        time.sleep(0.05)
+
+    with broker.lock:
+        end_to_end = [broker.finished[m] - t for m, t in submitted.items() if m in broker.finished]
+        last_finished = max(broker.finished.values(), default=started)
+        stages = {INTAKE_PACKAGE: intake_latencies, **broker.stage_latencies}
+        failures = dict(broker.failures)
+        outcomes = dict(broker.outcomes)
+        payload_bytes = sum(broker.payload_bytes.values())
+
+    elapsed = last_finished - started
+    print(f"\nCompleted {len(end_to_end)}/{len(contents)} messages in {elapsed:.1f}s "
+          f"({len(end_to_end) / elapsed if elapsed > 0 else 0.0:.1f} messages/s)\n")
+    rows = []
+    for package, latencies in stages.items():
+        summary = latency_summary(latencies)
+        rows.append([package, len(latencies), summary["p50_ms"], summary["p99_ms"], summary["mean_ms"], failures.get(package, 0)])
+    summary = latency_summary(end_to_end)
+    rows.append(["end-to-end", len(end_to_end), summary["p50_ms"], summary["p99_ms"], summary["mean_ms"], ""])
+    print_table(["stage", "events", "p50_ms", "p99_ms", "mean_ms", "failed"], rows)
+
+    print("\nLast event of each message:")
+    print_table(["event_type", "messages"], sorted(outcomes.items()))
+    llm = llm_stats.snapshot()
+    completed = max(1, len(end_to_end))
+    print(f"\nLLM calls: {llm['requests']} ({llm['requests'] / completed:.1f}/message), "
+          f"prompt tokens: {llm['prompt_tokens']}, completion tokens: {llm['completion_tokens']}")
+    print(f"Event payloads through the Broker: {payload_bytes / completed:.0f} bytes/message")
+    return {
+        "mode": mode, "completed": len(end_to_end), **summary,
+        "calls": llm["requests"] / completed,
+        "prompt_tokens": llm["prompt_tokens"] / completed,
+        "completion_tokens": llm["completion_tokens"] / completed,
+        "payload_bytes": payload_bytes / completed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", default=os.path.join(ROOT, "requests.jsonl"), help="JSON-lines file of messages")
+    parser.add_argument("--amplify", type=int, default=1, help="Replay the messages this many times")
+    parser.add_argument("--rate", type=float, default=10.0, help="Messages per second sent to intake")
+    parser.add_argument("--clients", type=int, default=50, help="Maximum concurrent intake requests")
+    parser.add_argument("--broker-workers", type=int, default=64, help="Concurrent event deliveries")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Stub LLM latency")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--db-latency-ms", type=float, default=1.0, help="Added to every customer query")
+    parser.add_argument("--llm-cache", default="none", help="LLM_CACHE_BACKEND for the LLM services")
+    parser.add_argument("--drain-seconds", type=float, default=120.0, help="How long to wait for messages in flight")
+    parser.add_argument("--mode", choices=MODES + ("compare",), default="multi-hop",
+                        help="The services to run; compare runs both pipelines")
+    parser.add_argument("--verbose", action="store_true", help="Keep the services' INFO and WARNING logs")
+    args = parser.parse_args()
+
+    contents = load_corpus(args.requests, args.amplify)
+    db = fake_postgres.install(query_latency_ms=args.db_latency_ms)
+    # Spread the LLM's answers over known and unknown customers and over every route.
+    server, base_url = start_stub_server(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        field_choices={
+            "email_address": db.emails() + ["nobody@example.com"],
+            "route": ["support", "finance", "website"],
+        },
+    )
+    configure_llm_env(base_url)
+    os.environ["LLM_CACHE_BACKEND"] = args.llm_cache
+    for name in ("DB_HOST", "DB_NAME", "DB_USER", "DB_PASSWORD"):
+        os.environ.setdefault(name, "benchmark")
+
+    triggers = load_triggers()
+    broker = Broker(args.broker_workers)
+    ingress, sink_url = broker.serve()
+    os.environ["K_SINK"] = sink_url
+    intake_app = importlib.import_module(f"{INTAKE_PACKAGE}.app").app
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    modes = MODES if args.mode == "compare" else (args.mode,)
+    results = [
+        run(mode, broker, intake_app, triggers, contents, args, server.RequestHandlerClass.stats)
+        for mode in modes
+    ]
+    if len(results) > 1:
+        print("\n=== comparison (per completed message) ===")
+        print_table(
+            ["mode", "completed", "e2e_p50_ms", "e2e_p99_ms", "llm_calls", "prompt_tokens", "completion_tokens",
+             "payload_bytes"],
+            [[r["mode"], r["completed"], r["p50_ms"], r["p99_ms"], r["calls"], r["prompt_tokens"], r["completion_tokens"],
+              r["payload_bytes"]]
+             for r in results],
+        )
+
+    ingress.shutdown()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,490 @@
+"""
+A tiny OpenAI-compatible server used by the benchmarks in this directory.
+
+It answers `/v1/chat/completions` after an injected delay. Plain completions
+get a canned text reply (e.g. "No" for the guardian). Requests that carry
+`tools` (as sent by instructor) get a tool call whose arguments are generated
+from the tool's JSON schema, so any `response_model` can be satisfied.
+`field_choices` pins named fields to values picked at random from a list,
+e.g. to spread the router's answers over all routes.
+
+`/completions` answers a single prompt or a list of prompts in one call, as
+vLLM does, with one choice per prompt after the injected delay plus
+`batch_ms` for every prompt after the first.
+
+`/embeddings` returns hashed bag-of-words vectors: texts that share words get
+similar embeddings, so paraphrases can be told apart from unrelated texts.
+
+With `stream: true` the reply is sent as server-sent events, one chunk of
+CHUNK_CHARS characters every `token_ms` after the first `latency_ms`. Replies
+longer than `max_tokens` are cut short with finish_reason "length".
+
+Faults can be injected: `error_rate` answers a share of the requests with a
+500 after the usual delay, `slow_rate` adds `slow_ms` to a share of them, and
+`capacity` answers 429 to requests beyond that many in flight. `slots`
+models a server that runs that many requests at a time and queues the rest
+(e.g. Ollama's OLLAMA_NUM_PARALLEL). `POST /config`
+with a JSON object changes any of these settings while the server runs, e.g.
+to start and end an outage.
+
+With `prefix_cache` (on by default) it reports the prompt tokens a prefix
+cache would have served, like vLLM's automatic prefix caching: the prompt is
+cut into blocks of PREFIX_BLOCK_CHARS characters, and the leading blocks
+whose whole prefix was seen before count as `cached_tokens` in the usage's
+`prompt_tokens_details`. Latency does not depend on it.
+
+Run it standalone:
+
+    python -m benchmarks.stub_llm --port 9000 --latency-ms 200
+
+or start it in-process with `start_stub_server()`.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import re
+import struct
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Characters of output per streamed chunk (about 4 tokens)
+CHUNK_CHARS = 16
+EMBEDDING_DIM = 256
+# Characters per block of the simulated prefix cache (16 tokens, as in vLLM), and blocks it keeps
+PREFIX_BLOCK_CHARS = 64
+PREFIX_CACHE_BLOCKS = 100_000
+
+
+def approx_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token)."""
+    return max(1, len(text) // 4)
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM) -> list:
+    """A normalized bag-of-words vector: each lowercased word adds +1 or -1 at a position given by its hash."""
+    vector = [0.0] * dim
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.md5(word.encode()).digest()
+        vector[int.from_bytes(digest[:4], "little") % dim] += 1.0 if digest[4] & 1 else -1.0
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+def fake_from_schema(schema: dict, defs: dict = None, field_choices: dict = None):
+    """
+    Builds a value that satisfies a (pydantic-generated) JSON schema. Object
+    properties named in field_choices get one of the listed values instead,
+    unless they are objects themselves.
+    """
+    defs = defs if defs is not None else schema.get("$defs", {})
+    field_choices = field_choices or {}
+    if "$ref" in schema:
+        return fake_from_schema(defs[schema["$ref"].split("/")[-1]], defs, field_choices)
+    if "enum" in schema:
+        return schema["enum"][0]
+    if "anyOf" in schema:
+        options = [s for s in schema["anyOf"] if s.get("type") != "null"]
+        return fake_from_schema(options[0], defs, field_choices) if options else None
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        def is_object(prop):
+            return (defs[prop["$ref"].split("/")[-1]] if "$ref" in prop else prop).get("type") == "object"
+
+        return {
+            name: random.choice(field_choices[name]) if name in field_choices and not is_object(prop)
+            else fake_from_schema(prop, defs, field_choices)
+            for name, prop in schema.get("properties", {}).items()
+        }
+    if schema_type == "array":
+        return []
+    if schema_type == "boolean":
+        return False
+    if schema_type == "integer":
+        return 0
+    if schema_type == "number":
+        return 0.0
+    return "stub"
+
+
+class StubConfig:
+    def __init__(self, latency_ms=100.0, jitter_ms=0.0, reply="No", field_choices=None, token_ms=0.0, embedding_ms=5.0,
+                 error_rate=0.0, slow_rate=0.0, slow_ms=0.0, capacity=0, slots=0, batch_ms=0.0, prefix_cache=True):
+        self.latency_ms = latency_ms
+        self.embedding_ms = embedding_ms
+        self.jitter_ms = jitter_ms
+        self.token_ms = token_ms
+        self.reply = reply
+        self.field_choices = field_choices or {}
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.capacity = capacity
+        self.slots = slots
+        self.batch_ms = batch_ms
+        self.prefix_cache = prefix_cache
+
+
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Requests holding one of the server's slots
+        self.running = 0
+        self.slot_freed = threading.Condition(self.lock)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.prompt_tokens = 0
+            self.cached_tokens = 0
+            self.completion_tokens = 0
+            # Hashes of the prompt prefixes seen, one per block
+            self.prefix_blocks = set()
+            self.received = 0
+            self.errors = 0
+            self.overloaded = 0
+            self.in_flight = 0
+
+    def enter(self, capacity):
+        """Counts a request in flight, or returns False if `capacity` are already."""
+        with self.lock:
+            self.received += 1
+            if capacity and self.in_flight >= capacity:
+                self.overloaded += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def take_slot(self, slots):
+        """Waits until fewer than `slots` requests run (0 is unlimited), then runs this one."""
+        with self.lock:
+            while slots and self.running >= slots:
+                self.slot_freed.wait()
+            self.running += 1
+
+    def free_slot(self):
+        with self.lock:
+            self.running -= 1
+            self.slot_freed.notify()
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def cached_prefix(self, prompt_text):
+        """Returns the characters of prompt_text a prefix cache would have served, and caches its blocks."""
+        digest = hashlib.sha256()
+        cached, hit = 0, True
+        with self.lock:
+            if len(self.prefix_blocks) > PREFIX_CACHE_BLOCKS:
+                self.prefix_blocks.clear()
+            for start in range(0, len(prompt_text) - PREFIX_BLOCK_CHARS + 1, PREFIX_BLOCK_CHARS):
+                # Each block's hash covers everything before it, so a block only hits after the same prefix.
+                digest.update(prompt_text[start:start + PREFIX_BLOCK_CHARS].encode())
+                block = digest.digest()
+                if hit and block in self.prefix_blocks:
+                    cached += PREFIX_BLOCK_CHARS
+                else:
+                    hit = False
+                    self.prefix_blocks.add(block)
+        return cached
+
+    def record(self, prompt_tokens, completion_tokens, cached_tokens=0):
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+            self.completion_tokens += completion_tokens
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "completion_tokens": self.completion_tokens,
+                "received": self.received,
+                "errors": self.errors,
+                "overloaded": self.overloaded,
+            }
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    # Set on the server class by start_stub_server()
+    config: StubConfig = None
+    stats: StubStats = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped waiting, e.g. after a timeout.
+            pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.stats.snapshot())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path == "/stats/reset":
+            self.stats.reset()
+            self._send_json(200, {"status": "reset"})
+        elif self.path == "/config":
+            for name, value in self._read_json().items():
+                if not hasattr(self.config, name):
+                    self._send_json(400, {"error": f"unknown setting '{name}'"})
+                    return
+                setattr(self.config, name, value)
+            self._send_json(200, vars(self.config))
+        elif self.path.endswith("/completions") or self.path.endswith("/embeddings"):
+            body = self._read_json()
+            if not self.stats.enter(self.config.capacity):
+                self._send_json(429, {"error": {"message": "Stub LLM over capacity", "type": "overloaded"}})
+                return
+            try:
+                if random.random() < self.config.error_rate:
+                    self._sleep()
+                    self.stats.record_error()
+                    self._send_json(500, {"error": {"message": "Injected stub LLM failure", "type": "server_error"}})
+                elif self.path.endswith("/embeddings"):
+                    self._send_json(200, self._embeddings(body))
+                elif not self.path.endswith("/chat/completions"):
+                    self._send_json(200, self._text_completion(body))
+                elif body.get("stream"):
+                    self._stream_chat_completion(body)
+                else:
+                    self._send_json(200, self._chat_completion(body))
+            finally:
+                self.stats.leave()
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def _sleep(self, extra_ms=0.0):
+        delay_ms = self.config.latency_ms + random.uniform(0, self.config.jitter_ms) + extra_ms
+        if self.config.slow_rate and random.random() < self.config.slow_rate:
+            delay_ms += self.config.slow_ms
+        self.stats.take_slot(self.config.slots)
+        try:
+            time.sleep(delay_ms / 1000.0)
+        finally:
+            self.stats.free_slot()
+
+    def _generate(self, body):
+        """Returns (prompt_text, output_text, tool_name, finish_reason) for a request."""
+        prompt_text = "".join(str(m.get("content") or "") for m in body.get("messages", []))
+        tool_name = None
+        tools = body.get("tools")
+        if tools:
+            function = tools[0]["function"]
+            tool_name = function["name"]
+            output_text = json.dumps(fake_from_schema(function.get("parameters", {}), field_choices=self.config.field_choices))
+            # Chat templates put the tool definitions ahead of the messages.
+            prompt_text = json.dumps(tools) + prompt_text
+        else:
+            output_text = self.config.reply
+
+        finish_reason = "stop"
+        max_tokens = body.get("max_tokens")
+        if max_tokens and approx_tokens(output_text) > max_tokens:
+            output_text = output_text[:max_tokens * 4]
+            finish_reason = "length"
+        return prompt_text, output_text, tool_name, finish_reason
+
+    def _usage(self, prompt_text, output_text, prompts=None):
+        prompt_tokens = approx_tokens(prompt_text)
+        completion_tokens = approx_tokens(output_text)
+        cached_tokens = 0
+        if self.config.prefix_cache:
+            cached_chars = sum(self.stats.cached_prefix(text) for text in (prompts or [prompt_text]))
+            cached_tokens = min(prompt_tokens, cached_chars // 4)
+        self.stats.record(prompt_tokens, completion_tokens, cached_tokens)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+
+    def _chat_completion(self, body):
+        prompt_text, output_text, tool_name, finish_reason = self._generate(body)
+        self._sleep()
+        # Without streaming the whole generation time passes before the reply.
+        time.sleep(self.config.token_ms * (len(output_text) // CHUNK_CHARS) / 1000.0)
+        if tool_name:
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": tool_name, "arguments": output_text},
+                }],
+            }
+        else:
+            message = {"role": "assistant", "content": output_text}
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": self._usage(prompt_text, output_text),
+        }
+
+    def _text_completion(self, body):
+        """A legacy completion: one choice per prompt, answered together."""
+        prompts = body.get("prompt") or ""
+        prompts = [prompts] if isinstance(prompts, str) else prompts
+        self._sleep(extra_ms=self.config.batch_ms * (len(prompts) - 1))
+        output_text = self.config.reply
+        max_tokens = body.get("max_tokens")
+        finish_reason = "stop"
+        if max_tokens and approx_tokens(output_text) > max_tokens:
+            output_text = output_text[:max_tokens * 4]
+            finish_reason = "length"
+        return {
+            "id": f"cmpl-{uuid.uuid4().hex[:12]}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": i, "text": output_text, "finish_reason": finish_reason, "logprobs": None}
+                        for i in range(len(prompts))],
+            "usage": self._usage("".join(prompts), output_text * len(prompts), prompts=prompts),
+        }
+
+    def _embeddings(self, body):
+        """Embeddings are not counted in the stats, which are about chat completions."""
+        time.sleep(self.config.embedding_ms / 1000.0)
+        inputs = body.get("input")
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        data = []
+        for i, text in enumerate(inputs):
+            vector = fake_embedding(text)
+            if body.get("encoding_format") == "base64":
+                # The openai client asks for little-endian float32 in base64 when numpy is installed.
+                vector = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode()
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        tokens = sum(approx_tokens(text) for text in inputs)
+        return {
+            "object": "list", "data": data, "model": body.get("model", "stub"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def _stream_chat_completion(self, body):
+        prompt_text, output_text, tool_name, finish_reason = self._generate(body)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        model = body.get("model", "stub")
+
+        def chunk(delta, finish=None, usage=None):
+            data = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+            if usage:
+                data["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(data)}\n\n".encode())
+            self.wfile.flush()
+
+        self._sleep()
+        # No Content-Length: the stream ends when the connection is closed.
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            if tool_name:
+                chunk({"role": "assistant", "tool_calls": [{
+                    "index": 0, "id": f"call_{uuid.uuid4().hex[:12]}", "type": "function",
+                    "function": {"name": tool_name, "arguments": ""},
+                }]})
+            for i in range(0, len(output_text), CHUNK_CHARS):
+                if i:
+                    time.sleep(self.config.token_ms / 1000.0)
+                piece = output_text[i:i + CHUNK_CHARS]
+                if tool_name:
+                    chunk({"tool_calls": [{"index": 0, "function": {"arguments": piece}}]})
+                else:
+                    chunk({"content": piece})
+            chunk({}, finish=finish_reason)
+            if (body.get("stream_options") or {}).get("include_usage"):
+                chunk(None, usage=self._usage(prompt_text, output_text))
+            else:
+                self._usage(prompt_text, output_text)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading, e.g. after a timeout.
+            pass
+
+
+def start_stub_server(port=0, **config_kwargs):
+    """
+    Starts the stub server on a background thread.
+    Returns (server, base_url); call server.shutdown() to stop it.
+    """
+    handler = type("BoundStubLLMHandler", (StubLLMHandler,), {
+        "config": StubConfig(**config_kwargs),
+        "stats": StubStats(),
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    return server, base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub OpenAI-compatible LLM server")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=100.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--token-ms", type=float, default=0.0, help="Generation time per chunk of output")
+    parser.add_argument("--reply", default="No", help="Text returned for plain (non-tool) completions")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 500")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Share of requests delayed by --slow-ms")
+    parser.add_argument("--slow-ms", type=float, default=0.0)
+    parser.add_argument("--capacity", type=int, default=0, help="Requests in flight before 429s; 0 is unlimited")
+    parser.add_argument("--slots", type=int, default=0, help="Requests processed at a time, the rest queue; 0 is unlimited")
+    parser.add_argument("--batch-ms", type=float, default=0.0, help="Extra time per additional prompt of a /completions call")
+    parser.add_argument("--no-prefix-cache", action="store_true", help="Report no cached prompt tokens")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(
+        port=args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, reply=args.reply, token_ms=args.token_ms,
+        error_rate=args.error_rate, slow_rate=args.slow_rate, slow_ms=args.slow_ms, capacity=args.capacity,
+        slots=args.slots, batch_ms=args.batch_ms, prefix_cache=not args.no_prefix_cache,
+    )
+    print(f"Stub LLM listening at {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""Small helpers shared by the benchmark scripts."""
+import math
+import os
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers (p in 0..100)."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def latency_summary(latencies_s):
+    """Returns p50/p99/mean in milliseconds for a list of latencies in seconds."""
+    ms = [v * 1000.0 for v in latencies_s]
+    return {
+        "p50_ms": percentile(ms, 50),
+        "p99_ms": percentile(ms, 99),
+        "mean_ms": sum(ms) / len(ms) if ms else float("nan"),
+    }
+
+
+def print_table(headers, rows):
+    """Prints rows as a fixed-width table."""
+    rendered = [[f"{c:.1f}" if isinstance(c, float) else str(c) for c in row] for row in rows]
+    widths = [max(len(h), *(len(r[i]) for r in rendered)) for i, h in enumerate(headers)]
+    print("  ".join(h.rjust(w) for h, w in zip(headers, widths)))
+    for row in rendered:
+        print("  ".join(c.rjust(w) for c, w in zip(row, widths)))
+
+
+def configure_llm_env(base_url, model_name="stub-model"):
+    """Points the LLM services at the given (stub) server before they are imported."""
+    os.environ["LLM_API_BASE_URL"] = base_url
+    os.environ["LLM_API_KEY"] = "not-needed"
+    os.environ["LLM_MODEL_NAME"] = model_name
@@ -0,0 +1,216 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from common.cache import MISSING, TTLCache
+from common.llm_cache import MemoryBackend, SQLiteBackend
+from common.metrics import BLOB_FETCH_SECONDS, BLOB_STORE_OPERATIONS
+
+# --- Configuration ---
+# Claim check for message contents. With a backend, svc_intake stores the
+# content of large messages once and the events carry a `content_ref` instead
+# of the content; the stages that need the text fetch it from the store.
+# "filesystem" (a directory, e.g. a volume shared by the pods), "sqlite" (a
+# local file shared by the workers of a pod), "memory" (only for services
+# running in one process, as in the benchmarks) or "none" (the default).
+BLOB_STORE_BACKEND = os.getenv("BLOB_STORE_BACKEND", "none")
+# A directory for "filesystem", a file for "sqlite"
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", "")
+# Contents smaller than this stay in the event: carrying them costs less than a fetch.
+BLOB_STORE_MIN_BYTES = int(os.getenv("BLOB_STORE_MIN_BYTES", "4096"))
+# How long a content is kept; it must outlive the processing and redeliveries of its message.
+BLOB_STORE_TTL_SECONDS = float(os.getenv("BLOB_STORE_TTL_SECONDS", "86400"))
+BLOB_STORE_SIZE = int(os.getenv("BLOB_STORE_SIZE", "100000"))
+# Fetched contents kept per worker, for redeliveries and retries of the same message
+BLOB_STORE_CACHE_SIZE = int(os.getenv("BLOB_STORE_CACHE_SIZE", "64"))
+
+DEFAULT_PATHS = {"filesystem": "/tmp/blobs", "sqlite": "/tmp/blobs.sqlite3"}
+REF_PREFIX = "sha256:"
+
+
+def content_ref(content: str) -> str:
+    """The content-addressed reference of a content: its SHA-256, so equal contents are stored once."""
+    return REF_PREFIX + hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class FileBackend:
+    """
+    One file per content, named after its hash, in a subdirectory per first
+    two hex digits. Files are written to a temporary name and renamed, so a
+    reader never sees a partial content. Files older than the TTL are removed
+    every `prune_every` writes.
+    """
+
+    def __init__(self, directory, ttl_seconds, prune_every=1000):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.prune_every = prune_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = key.removeprefix(REF_PREFIX)
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read().decode("utf-8")
+        except FileNotFoundError:
+            return MISSING
+
+    def set(self, key, value):
+        path = self._path(key)
+        if os.path.exists(path):
+            # Same hash, same content: refresh its age instead of writing it again.
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(value.encode("utf-8"))
+        os.replace(temporary, path)
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.prune_every == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        cutoff = time.time() - self.ttl_seconds
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+class BlobStore:
+    """
+    Stores message contents by their hash and fetches them back, for the
+    claim-check mode of the pipeline: the content of a large email travels
+    through the Broker once, as a reference, instead of in every event.
+
+    Fetched contents are checked against their hash and kept in a small
+    per-worker cache. Within one event, `message_content` fetches the
+    content at most once, and only when a stage actually reads it.
+    """
+
+    def __init__(self, backend, cache_size=BLOB_STORE_CACHE_SIZE, ttl_seconds=BLOB_STORE_TTL_SECONDS):
+        self.backend = backend
+        self.cache = TTLCache(max_size=cache_size, ttl_seconds=ttl_seconds)
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.stored_bytes = 0
+        self.fetched = 0
+        self.fetched_bytes = 0
+        self.fetch_seconds_total = 0.0
+
+    def put(self, content: str) -> str:
+        """Stores content and returns its reference."""
+        ref = content_ref(content)
+        self.backend.set(ref, content)
+        BLOB_STORE_OPERATIONS.labels(op="put", result="stored").inc()
+        with self._lock:
+            self.stored += 1
+            self.stored_bytes += len(content)
+        return ref
+
+    def get(self, ref: str) -> str:
+        """Returns the content of ref. Raises KeyError if the store does not have it (any more)."""
+        content = self.cache.get(ref)
+        if content is not MISSING:
+            BLOB_STORE_OPERATIONS.labels(op="get", result="hit").inc()
+            return content
+        started = time.perf_counter()
+        content = self.backend.get(ref)
+        elapsed = time.perf_counter() - started
+        if content is MISSING:
+            BLOB_STORE_OPERATIONS.labels(op="get", result="missing").inc()
+            raise KeyError(f"Content {ref} not found in the blob store; it may have expired.")
+        if content_ref(content) != ref:
+            BLOB_STORE_OPERATIONS.labels(op="get", result="corrupt").inc()
+            raise ValueError(f"Content {ref} in the blob store does not match its hash.")
+        BLOB_STORE_OPERATIONS.labels(op="get", result="fetched").inc()
+        BLOB_FETCH_SECONDS.observe(elapsed)
+        self.cache.set(ref, content)
+        with self._lock:
+            self.fetched += 1
+            self.fetched_bytes += len(content)
+            self.fetch_seconds_total += elapsed
+        return content
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": type(self.backend).__name__,
+                "stored": self.stored,
+                "stored_bytes": self.stored_bytes,
+                "fetched": self.fetched,
+                "fetched_bytes": self.fetched_bytes,
+                "fetch_ms_avg": (self.fetch_seconds_total / self.fetched * 1000.0) if self.fetched else 0.0,
+                "cache_hits": self.cache.hits,
+            }
+
+
+def create_blob_store():
+    """Builds a blob store from the BLOB_STORE_* environment variables, or returns None if disabled."""
+    if BLOB_STORE_BACKEND == "none":
+        return None
+    path = BLOB_STORE_PATH or DEFAULT_PATHS.get(BLOB_STORE_BACKEND)
+    if BLOB_STORE_BACKEND == "memory":
+        backend = MemoryBackend(BLOB_STORE_SIZE, BLOB_STORE_TTL_SECONDS)
+    elif BLOB_STORE_BACKEND == "filesystem":
+        backend = FileBackend(path, BLOB_STORE_TTL_SECONDS)
+    elif BLOB_STORE_BACKEND == "sqlite":
+        backend = SQLiteBackend(path, BLOB_STORE_SIZE, BLOB_STORE_TTL_SECONDS, table="blobs")
+    else:
+        raise SystemExit(f"BLOB_STORE_BACKEND must be 'filesystem', 'sqlite', 'memory' or 'none', got '{BLOB_STORE_BACKEND}'.")
+    logging.info(f"Message contents of {BLOB_STORE_MIN_BYTES} bytes or more are passed by reference, "
+                 f"through blob store backend '{BLOB_STORE_BACKEND}'" + (f" at '{path}'." if path else "."))
+    return BlobStore(backend)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def blob_store():
+    """The blob store of this worker, or None if claim check is disabled."""
+    global _store
+    with _store_lock:
+        if _store is None and BLOB_STORE_BACKEND != "none":
+            _store = create_blob_store()
+        return _store
+
+
+def fetch_content(ref: str) -> str:
+    """The content stored under ref, from this worker's blob store."""
+    store = blob_store()
+    if store is None:
+        raise RuntimeError(f"Message content is passed by reference ({ref}), but BLOB_STORE_BACKEND is 'none'.")
+    return store.get(ref)
+
+
+def message_content(message) -> str:
+    """
+    The content of an OuterWrapper: its `content`, or the content its
+    `content_ref` points to, fetched on first use and kept with the message.
+    """
+    if not message.content_ref or message.content:
+        return message.content
+    if message._fetched_content is None:
+        message._fetched_content = fetch_content(message.content_ref)
+    return message._fetched_content
+
+
+def blob_store_stats():
+    """The stats of this worker's blob store, for the /stats endpoints, or None if claim check is disabled."""
+    store = blob_store()
+    return store.stats() if store else None
@@ -0,0 +1,265 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from common.metrics import SSE_CLIENTS, SSE_EVENTS_PUBLISHED, SSE_EVENTS_SKIPPED
+
+# --- Configuration ---
+# Where published events go: "memory" (the clients of this process only) or
+# "sqlite" (a local file shared by every worker and replica that points at
+# it, so they all serve the same stream and history).
+SSE_BACKEND = os.getenv("SSE_BACKEND", "memory")
+SSE_SQLITE_PATH = os.getenv("SSE_SQLITE_PATH", "/tmp/sse-events.sqlite3")
+# How often each process checks the SQLite file for events published by others
+SSE_POLL_INTERVAL_SECONDS = float(os.getenv("SSE_POLL_INTERVAL_SECONDS", "0.05"))
+# Events kept for clients that fall behind or reconnect with Last-Event-ID
+SSE_BUFFER_SIZE = int(os.getenv("SSE_BUFFER_SIZE", "1000"))
+# Events sent to a client that connects without Last-Event-ID
+SSE_REPLAY_EVENTS = int(os.getenv("SSE_REPLAY_EVENTS", "50"))
+# Idle streams get a comment line this often, so proxies keep them open
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+
+
+class MemoryBackend:
+    """Numbers events in this process. Only its own clients see them."""
+
+    def __init__(self):
+        self.epoch = f"{time.time_ns():x}"
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.deliver = None
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, data):
+        # Under the lock, so events are delivered in the order they are numbered
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq = seq + 1
+            self.deliver(seq, data)
+        return seq
+
+    def name(self):
+        return "memory"
+
+
+class SQLiteBackend:
+    """
+    An append-only table per channel in a SQLite file. Its rowids are the
+    sequence numbers, so every process using the file sees the events in the
+    same order, and an event id means the same on every replica. Each process
+    tails the table from a background thread and delivers new rows to its own
+    clients. Rows older than the newest `retain` are pruned every
+    `prune_every` writes.
+
+    SQLite's WAL mode needs shared memory, so the processes must run on the
+    same node: the workers of a pod, or replicas sharing a hostPath volume.
+    """
+
+    def __init__(self, path, channel, retain, poll_interval_seconds, prune_every=100):
+        if not channel.isidentifier():
+            raise ValueError(f"SSE channel name '{channel}' must be a valid identifier.")
+        self.path = path
+        self.table = f"sse_{channel}"
+        self.retain = retain
+        self.poll_interval_seconds = poll_interval_seconds
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._writes = 0
+        # Set by publish, so the events of this process do not wait for the next poll
+        self.published = threading.Event()
+        self.deliver = None
+        with self._connection() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} (seq INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS sse_epochs (channel TEXT PRIMARY KEY, epoch TEXT NOT NULL)")
+            # The first process to use the file picks the epoch, the others adopt it.
+            conn.execute("INSERT OR IGNORE INTO sse_epochs (channel, epoch) VALUES (?, ?)",
+                         (channel, f"{time.time_ns():x}"))
+            self.epoch = conn.execute("SELECT epoch FROM sse_epochs WHERE channel = ?", (channel,)).fetchone()[0]
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def start(self, deliver):
+        self.deliver = deliver
+        # Start with the same history as every other process
+        rows = self._connection().execute(
+            f"SELECT seq, data FROM {self.table} ORDER BY seq DESC LIMIT ?", (self.retain,)
+        ).fetchall()
+        last_seq = -1
+        for seq, data in reversed(rows):
+            deliver(seq, data)
+            last_seq = seq
+        threading.Thread(target=self._tail, args=(last_seq,), name=f"{self.table}-tail", daemon=True).start()
+
+    def publish(self, data):
+        with self._connection() as conn:
+            seq = conn.execute(f"INSERT INTO {self.table} (data) VALUES (?)", (data,)).lastrowid
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                conn.execute(f"DELETE FROM {self.table} WHERE seq <= ?", (seq - self.retain,))
+        self.published.set()
+        return seq
+
+    def _tail(self, last_seq):
+        while True:
+            # Cleared before the query, so a publish during it is not missed
+            self.published.clear()
+            try:
+                rows = self._connection().execute(
+                    f"SELECT seq, data FROM {self.table} WHERE seq > ? ORDER BY seq LIMIT 1000", (last_seq,)
+                ).fetchall()
+            except sqlite3.Error as e:
+                logging.warning(f"Could not read SSE events from '{self.path}', retrying: {e}")
+                rows = []
+                time.sleep(1.0)
+            for seq, data in rows:
+                self.deliver(seq, data)
+                last_seq = seq
+            if not rows:
+                self.published.wait(self.poll_interval_seconds)
+
+    def name(self):
+        return "sqlite"
+
+
+class Broadcaster:
+    """
+    Fans events out to Server-Sent Events clients from a ring buffer.
+
+    `publish` serializes an event once and hands it to the backend, which
+    numbers it and delivers it to this process, or to every process sharing
+    the backend. A delivered event is formatted once into the bytes of a
+    complete SSE message and stored in the ring buffer under its sequence
+    number. Every client keeps its own cursor into the buffer and is woken up
+    when new events arrive, so publishing costs the same for one client or
+    thousands, and nothing is queued per client. A client that falls more than
+    `buffer_size` events behind skips ahead to the oldest event still in the
+    buffer instead of being disconnected.
+
+    Event ids are `<epoch>-<sequence>`, where the epoch identifies the
+    backend's numbering. A browser that reconnects sends the last id it saw in
+    the Last-Event-ID header and resumes right after it; an id from another
+    epoch gets everything still buffered. New clients get the last `replay`
+    events.
+
+    Waiting clients share one `threading.Event`, which each delivery sets and
+    replaces. The gunicorn gevent worker monkey-patches `threading`, so they
+    are greenlets parked on a single gevent event, and waking them costs the
+    publisher one call.
+    """
+
+    def __init__(self, event_name, buffer_size=1000, replay=50, keepalive_seconds=15.0, backend=None):
+        self.event_name = event_name
+        self.buffer_size = buffer_size
+        self.replay = min(replay, buffer_size)
+        self.keepalive_seconds = keepalive_seconds
+        self.buffer = [b""] * buffer_size
+        self.next_seq = 0
+        self.lock = threading.Lock()
+        # Set, and replaced by a fresh one, on every delivery
+        self.published = threading.Event()
+        self.clients = 0
+        self.skipped = 0
+        self.backend = backend or MemoryBackend()
+        self.epoch = self.backend.epoch
+        self.backend.start(self._deliver)
+
+    def publish(self, data):
+        """Serializes data as JSON and sends it to every client. Returns the event id."""
+        seq = self.backend.publish(json.dumps(data))
+        SSE_EVENTS_PUBLISHED.inc()
+        return f"{self.epoch}-{seq}"
+
+    def _deliver(self, seq, data):
+        """Stores an event from the backend in the ring buffer and wakes the clients."""
+        message = f"id: {self.epoch}-{seq}\nevent: {self.event_name}\ndata: {data}\n\n".encode()
+        with self.lock:
+            # Sequence numbers can have gaps (e.g. a rolled back insert); those slots stay empty.
+            for missing in range(max(self.next_seq, seq - self.buffer_size + 1), seq):
+                self.buffer[missing % self.buffer_size] = b""
+            self.buffer[seq % self.buffer_size] = message
+            self.next_seq = seq + 1
+            published, self.published = self.published, threading.Event()
+        published.set()
+
+    def _start(self, last_event_id):
+        """The sequence number a client starts at, given its Last-Event-ID header."""
+        with self.lock:
+            oldest = max(0, self.next_seq - self.buffer_size)
+            if last_event_id:
+                epoch, _, seq = last_event_id.partition("-")
+                if epoch == self.epoch and seq.isdigit():
+                    return max(oldest, min(int(seq) + 1, self.next_seq))
+                return oldest
+            return max(oldest, self.next_seq - self.replay)
+
+    def stream(self, last_event_id=None):
+        """Yields the SSE byte stream of one client, until the client disconnects."""
+        cursor = self._start(last_event_id)
+        with self.lock:
+            self.clients += 1
+        SSE_CLIENTS.inc()
+        try:
+            # Sends the response headers right away, even if there is nothing to replay.
+            yield b": connected\n\n"
+            while True:
+                with self.lock:
+                    published = self.published if cursor >= self.next_seq else None
+                if published:
+                    published.wait(self.keepalive_seconds)
+                with self.lock:
+                    end = self.next_seq
+                    oldest = max(0, end - self.buffer_size)
+                    skipped = max(0, oldest - cursor)
+                    cursor = max(cursor, oldest)
+                    chunk = b"".join(self.buffer[seq % self.buffer_size] for seq in range(cursor, end))
+                    self.skipped += skipped
+                cursor = end
+                if skipped:
+                    SSE_EVENTS_SKIPPED.inc(skipped)
+                    chunk = f": skipped {skipped} events\n\n".encode() + chunk
+                # A comment line on timeout keeps proxies from closing an idle
+                # stream, and shows when the client has gone away.
+                yield chunk or b": keepalive\n\n"
+        finally:
+            with self.lock:
+                self.clients -= 1
+            SSE_CLIENTS.dec()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": self.backend.name(),
+                "clients": self.clients,
+                "last_seq": self.next_seq - 1,
+                "buffered": min(self.next_seq, self.buffer_size),
+                "buffer_size": self.buffer_size,
+                "skipped": self.skipped,
+            }
+
+
+def create_broadcaster(event_name):
+    """Builds the broadcaster for an SSE event type from the SSE_* environment variables."""
+    if SSE_BACKEND == "memory":
+        backend = MemoryBackend()
+    elif SSE_BACKEND == "sqlite":
+        backend = SQLiteBackend(SSE_SQLITE_PATH, event_name, SSE_BUFFER_SIZE, SSE_POLL_INTERVAL_SECONDS)
+    else:
+        raise SystemExit(f"SSE_BACKEND must be 'memory' or 'sqlite', got '{SSE_BACKEND}'.")
+    logging.info(f"SSE stream '{event_name}' uses backend '{SSE_BACKEND}'.")
+    return Broadcaster(event_name, buffer_size=SSE_BUFFER_SIZE, replay=SSE_REPLAY_EVENTS,
+                       keepalive_seconds=SSE_KEEPALIVE_SECONDS, backend=backend)
@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+import uuid
+
+from flask import Response
+
+from common.cache import MISSING
+from common.llm_cache import MemoryBackend, SQLiteBackend
+from common.metrics import DUPLICATES_SUPPRESSED
+
+# --- Configuration ---
+# Where the replies to processed events are kept: "memory" (per worker),
+# "sqlite" (a local file shared by the workers of a pod, survives restarts)
+# or "none".
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "memory")
+IDEMPOTENCY_SIZE = int(os.getenv("IDEMPOTENCY_SIZE", "10000"))
+# Redeliveries come within minutes; a message processed again after this is treated as new.
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+IDEMPOTENCY_PATH = os.getenv("IDEMPOTENCY_PATH", "/tmp/idempotency.sqlite3")
+
+# Namespace of the deterministic Ce-Ids of replies
+EVENT_ID_NAMESPACE = uuid.UUID("6f1c3f5e-6a8e-4f43-9c55-2d4c1e0b7a19")
+
+
+def event_id(stage, message_id):
+    """The Ce-Id of the reply of a stage to a message: the same on every delivery, worker and replica."""
+    return str(uuid.uuid5(EVENT_ID_NAMESPACE, f"{stage}:{message_id}"))
+
+
+class IdempotencyStore:
+    """
+    Remembers the reply (body and CloudEvent headers) a stage sent for each
+    message_id, so a redelivered event is answered with the same reply
+    instead of redoing the LLM and database work. Downstream stages then see
+    the same event again, with the same Ce-Id, and answer it from their own
+    store in turn.
+
+    Duplicates are looked up by the Ce-Subject header, which carries the
+    message_id of every event in the pipeline, so the payload is not even
+    parsed. A duplicate that arrives while the original is still being
+    processed is processed again, and its LLM calls are answered by the LLM
+    response cache; whichever delivery finishes last overwrites the recorded
+    reply.
+    """
+
+    def __init__(self, stage, backend=None):
+        self.stage = stage
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.duplicates = 0
+        self.recorded = 0
+
+    def event_id(self, message_id):
+        return event_id(self.stage, message_id)
+
+    def _key(self, message_id):
+        return f"{self.stage}:{message_id}"
+
+    def replay(self, message_id):
+        """Returns the recorded reply to message_id as a Flask response, or None if it was not seen."""
+        if self.backend is None or not message_id:
+            return None
+        try:
+            reply = self.backend.get(self._key(message_id))
+        except Exception as e:
+            logging.warning(f"Idempotency store read failed for stage '{self.stage}': {e}")
+            return None
+        if reply is MISSING:
+            return None
+        with self._lock:
+            self.duplicates += 1
+        DUPLICATES_SUPPRESSED.labels(stage=self.stage).inc()
+        logging.info(f"[{message_id}] - Redelivered event answered with the recorded reply.")
+        return Response(reply["body"], status=200, headers=reply["headers"], mimetype="application/json")
+
+    def record(self, message_id, response, headers):
+        """
+        Stores the reply to message_id: a Flask response (or body string) and
+        its CloudEvent headers. Replaces any reply recorded before.
+        """
+        if self.backend is None:
+            return
+        body = response.get_data(as_text=True) if isinstance(response, Response) else response
+        try:
+            self.backend.set(self._key(message_id), {"body": body, "headers": headers})
+        except Exception as e:
+            logging.warning(f"Idempotency store write failed for stage '{self.stage}': {e}")
+            return
+        with self._lock:
+            self.recorded += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "stage": self.stage,
+                "backend": type(self.backend).__name__ if self.backend else None,
+                "recorded": self.recorded,
+                "duplicates": self.duplicates,
+            }
+
+
+def create_idempotency_store(stage):
+    """Builds the idempotency store for a stage from the IDEMPOTENCY_* environment variables."""
+    if IDEMPOTENCY_BACKEND == "none":
+        backend = None
+    elif IDEMPOTENCY_BACKEND == "memory":
+        backend = MemoryBackend(IDEMPOTENCY_SIZE, IDEMPOTENCY_TTL_SECONDS)
+    elif IDEMPOTENCY_BACKEND == "sqlite":
+        backend = SQLiteBackend(IDEMPOTENCY_PATH, IDEMPOTENCY_SIZE, IDEMPOTENCY_TTL_SECONDS, table="idempotency")
+    else:
+        raise SystemExit(f"IDEMPOTENCY_BACKEND must be 'memory', 'sqlite' or 'none', got '{IDEMPOTENCY_BACKEND}'.")
+    logging.info(f"Idempotency store for '{stage}' uses backend '{IDEMPOTENCY_BACKEND}'.")
+    return IdempotencyStore(stage, backend)
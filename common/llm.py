@@ -0,0 +1,157 @@
+import logging
+import os
+import threading
+
+import httpx
+from openai import OpenAI
+
+from common.llm_resilience import (
+    AdaptiveConcurrencyTransport, CircuitBreakerTransport, FallbackTransport, HedgingTransport,
+)
+from common.llm_telemetry import InstrumentedTransport
+
+# --- Configuration ---
+# Connections kept to the LLM server by each worker.
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+# Cap on LLM requests in flight at once per worker; 0 means no cap. With the
+# gevent worker class a single worker serves the whole pod, so this is also
+# the cap per pod.
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "0"))
+# Time to open a connection to the LLM server, and the longest wait for the
+# next bytes of a response (not the whole generation).
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LLM_CONNECT_TIMEOUT_SECONDS", "5"))
+LLM_READ_TIMEOUT_SECONDS = float(os.getenv("LLM_READ_TIMEOUT_SECONDS", "120"))
+# Retries of the OpenAI client on connection errors, 408/409/429 and 5xx
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+# Failed LLM calls in a row that open the circuit breaker; 0 disables it.
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+# How long an open breaker rejects requests before it lets a probe through
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+# Upper bound of the adaptive (AIMD) limit on requests in flight per client; 0 disables it.
+LLM_ADAPTIVE_MAX_IN_FLIGHT = int(os.getenv("LLM_ADAPTIVE_MAX_IN_FLIGHT", "0"))
+LLM_ADAPTIVE_MIN_IN_FLIGHT = int(os.getenv("LLM_ADAPTIVE_MIN_IN_FLIGHT", "1"))
+# Calls slower than this also lower the adaptive limit; 0 means only failures do.
+LLM_ADAPTIVE_LATENCY_SECONDS = float(os.getenv("LLM_ADAPTIVE_LATENCY_SECONDS", "0"))
+# Longest wait for an adaptive slot before the request is rejected
+LLM_ADMISSION_TIMEOUT_SECONDS = float(os.getenv("LLM_ADMISSION_TIMEOUT_SECONDS", "30"))
+# Non-streamed requests slower than this percentile of recent calls get a
+# second copy, and the first answer wins; 0 disables hedging.
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))
+# A second OpenAI-compatible server, serving the same model, for requests the primary fails
+LLM_FALLBACK_BASE_URL = os.getenv("LLM_FALLBACK_BASE_URL", "")
+
+# Shared by every client created in this process, so the cap holds across services' clients.
+_in_flight_slots = threading.BoundedSemaphore(LLM_MAX_IN_FLIGHT) if LLM_MAX_IN_FLIGHT > 0 else None
+# The breakers, limiters, hedging and fallback layers of the clients of this process, for /stats
+_resilience_layers = []
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """Wraps a response body and runs `release` once the body has been closed."""
+
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+        self.released = False
+
+    def __iter__(self):
+        yield from self.stream
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            if not self.released:
+                self.released = True
+                self.release()
+
+
+class InFlightLimitTransport(httpx.BaseTransport):
+    """
+    Lets at most a fixed number of requests through at a time. A slot is held
+    until the response body is closed, so streamed generations count as in
+    flight for as long as they run.
+    """
+
+    def __init__(self, transport: httpx.BaseTransport, slots: threading.BoundedSemaphore):
+        self.transport = transport
+        self.slots = slots
+
+    def handle_request(self, request):
+        self.slots.acquire()
+        try:
+            response = self.transport.handle_request(request)
+        except BaseException:
+            self.slots.release()
+            raise
+        response.stream = _ReleasingStream(response.stream, self.slots.release)
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+def _resilient_transport(limits, target):
+    """The instrumented transport to one LLM server, behind its hedging, adaptive limit and breaker."""
+    transport = InstrumentedTransport(httpx.HTTPTransport(limits=limits))
+    if LLM_HEDGE_PERCENTILE > 0:
+        transport = HedgingTransport(transport, target, percentile=LLM_HEDGE_PERCENTILE)
+        _resilience_layers.append(transport)
+    if LLM_ADAPTIVE_MAX_IN_FLIGHT > 0:
+        transport = AdaptiveConcurrencyTransport(
+            transport, target, LLM_ADAPTIVE_MAX_IN_FLIGHT, min_limit=LLM_ADAPTIVE_MIN_IN_FLIGHT,
+            latency_threshold=LLM_ADAPTIVE_LATENCY_SECONDS, admission_timeout=LLM_ADMISSION_TIMEOUT_SECONDS,
+        )
+        _resilience_layers.append(transport)
+    # Outermost, so an open breaker rejects a request before it waits for a slot
+    if LLM_BREAKER_FAILURES > 0:
+        transport = CircuitBreakerTransport(transport, target, LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS)
+        _resilience_layers.append(transport)
+    return transport
+
+
+def resilience_stats():
+    """State of the circuit breakers, adaptive limits, hedging and fallback of this worker's LLM clients."""
+    return [layer.stats() for layer in _resilience_layers]
+
+
+def create_http_client(base_url=None, **kwargs) -> httpx.Client:
+    """
+    Builds the httpx client the OpenAI client of a service should use: a
+    bounded pool of keep-alive connections to the LLM server, instrumented
+    (see common/llm_telemetry.py), behind the resilience layers of
+    common/llm_resilience.py and the in-flight cap. With
+    LLM_FALLBACK_BASE_URL set, requests to `base_url` that fail go to the
+    fallback server, which has its own layers. Extra keyword arguments are
+    passed to httpx.Client.
+    """
+    limits = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS)
+    # Instrumented inside the limits, so latency does not include waiting for a slot.
+    transport = _resilient_transport(limits, "primary")
+    if LLM_FALLBACK_BASE_URL and base_url:
+        transport = FallbackTransport(transport, _resilient_transport(limits, "fallback"), base_url, LLM_FALLBACK_BASE_URL)
+        _resilience_layers.append(transport)
+    if _in_flight_slots is not None:
+        transport = InFlightLimitTransport(transport, _in_flight_slots)
+    logging.info(f"LLM HTTP client: up to {LLM_MAX_CONNECTIONS} connections, "
+                 f"in-flight cap {LLM_MAX_IN_FLIGHT or 'disabled'}, "
+                 f"adaptive limit {LLM_ADAPTIVE_MAX_IN_FLIGHT or 'disabled'}, "
+                 f"breaker after {LLM_BREAKER_FAILURES or 'no'} failures, "
+                 f"hedging {f'after p{LLM_HEDGE_PERCENTILE:g}' if LLM_HEDGE_PERCENTILE > 0 else 'disabled'}, "
+                 f"fallback {LLM_FALLBACK_BASE_URL or 'none'}.")
+    return httpx.Client(transport=transport, **kwargs)
+
+
+def create_openai_client(api_key, base_url) -> OpenAI:
+    """
+    The OpenAI client of a service, on the client of create_http_client, with
+    explicit connect/read timeouts and retries. Services patch it with
+    instructor as they need.
+    """
+    return OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=create_http_client(base_url),
+        timeout=httpx.Timeout(LLM_READ_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+        max_retries=LLM_MAX_RETRIES,
+    )
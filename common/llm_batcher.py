@@ -0,0 +1,182 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# --- Configuration ---
+# Micro-batching of the LLM prompts of concurrent events within a worker, in
+# the guardian (per-harm checks) and the router. A window of 0 disables it.
+# Only useful when the worker serves requests concurrently (threads or gevent).
+LLM_BATCH_WINDOW_MS = float(os.getenv("LLM_BATCH_WINDOW_MS", "0"))
+LLM_BATCH_MAX_SIZE = int(os.getenv("LLM_BATCH_MAX_SIZE", "16"))
+# How a batch is sent:
+# - "parallel": one chat completion per prompt, all sent at once over the
+#   pooled connections (default). Works with any OpenAI-compatible server.
+# - "completions": a single /completions call with the list of prompts, for
+#   servers that accept one (e.g. vLLM). The chat messages are rendered as
+#   plain text, without the model's chat template.
+LLM_BATCH_MODE_PARALLEL = "parallel"
+LLM_BATCH_MODE_COMPLETIONS = "completions"
+LLM_BATCH_MODE = os.getenv("LLM_BATCH_MODE", LLM_BATCH_MODE_PARALLEL)
+
+
+def render_prompt(messages):
+    """Renders chat messages as one text prompt for the /completions API."""
+    lines = [f"{m['role'].capitalize()}: {m['content']}" for m in messages]
+    return "\n\n".join(lines) + "\n\nAssistant:"
+
+
+def _chain(future, outcome):
+    """Resolves future with a result, or with an exception."""
+    if isinstance(outcome, BaseException):
+        future.set_exception(outcome)
+    else:
+        future.set_result(outcome)
+
+
+class LLMBatcher:
+    """
+    Collects the LLM prompts of concurrent events in one worker and sends
+    them together, so the LLM server gets a batch instead of a trickle.
+
+    A background thread takes the first pending prompt, then keeps collecting
+    until the window has passed or the batch is full, as the customer lookup
+    batcher does. The batch is handed to a pool of `max_batches_in_flight`
+    batches, so the next one is collected while it is being answered. Each
+    caller gets a Future with its own answer, or with the exception of its
+    request.
+
+    `submit` takes chat messages and answers with the text of the reply. In
+    the "parallel" mode every prompt becomes a chat completion, sent at the
+    same time as the others of its batch; in the "completions" mode the
+    batch is one /completions call, and identical prompts are sent once.
+    `submit_call` takes any LLM call (e.g. an instructor call with a
+    response model) and runs it in the next batch, in parallel, in both
+    modes.
+    """
+
+    def __init__(self, client, model, mode=LLM_BATCH_MODE_PARALLEL, window_ms=10.0, max_batch_size=16,
+                 max_batches_in_flight=4, name="llm"):
+        self.client = client
+        self.model = model
+        self.mode = mode
+        self.window_seconds = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.name = name
+        self.pending = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=max_batch_size * max_batches_in_flight,
+                                           thread_name_prefix=f"{name}-batch")
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.prompts = 0
+        self.requests = 0
+        self.largest_batch = 0
+        threading.Thread(target=self._run, name=f"{name}-batcher", daemon=True).start()
+
+    def submit(self, messages, max_tokens=None, extra_headers=None) -> Future:
+        """Queues a chat prompt; the Future resolves to the text of its reply."""
+        future = Future()
+        self.pending.put(("prompt", (messages, max_tokens, extra_headers), future))
+        return future
+
+    def submit_call(self, call) -> Future:
+        """Queues an LLM call made by call(); the Future resolves to what it returns."""
+        future = Future()
+        self.pending.put(("call", call, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.window_seconds
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        prompts = [(payload, future) for kind, payload, future in batch if kind == "prompt"]
+        calls = [(payload, future) for kind, payload, future in batch if kind == "call"]
+        if self.mode == LLM_BATCH_MODE_COMPLETIONS and prompts:
+            self.executor.submit(self._complete_all, prompts)
+            requests = 1
+        else:
+            calls += [(self._chat_call(*prompt), future) for prompt, future in prompts]
+            requests = 0
+        for call, future in calls:
+            self.executor.submit(self._run_call, call, future)
+        with self._stats_lock:
+            self.batches += 1
+            self.prompts += len(batch)
+            self.requests += requests + len(calls)
+            self.largest_batch = max(self.largest_batch, len(batch))
+
+    def _chat_call(self, messages, max_tokens, extra_headers):
+        def call():
+            completion = self.client.chat.completions.create(
+                model=self.model, messages=messages, max_tokens=max_tokens, temperature=0.0, extra_headers=extra_headers,
+            )
+            return completion.choices[0].message.content
+        return call
+
+    @staticmethod
+    def _run_call(call, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            _chain(future, call())
+        except Exception as e:
+            _chain(future, e)
+
+    def _complete_all(self, prompts):
+        """Answers a batch of chat prompts with one /completions call."""
+        texts = list(dict.fromkeys(render_prompt(messages) for (messages, _, _), _ in prompts))
+        limits = [max_tokens for (_, max_tokens, _), _ in prompts]
+        # Headers only apply to the whole call, so they are sent when all prompts agree on them.
+        headers = [extra_headers for (_, _, extra_headers), _ in prompts]
+        try:
+            completion = self.client.completions.create(
+                model=self.model, prompt=texts, temperature=0.0,
+                max_tokens=None if None in limits else max(limits),
+                extra_headers=headers[0] if all(h == headers[0] for h in headers) else None,
+            )
+            answers = {texts[choice.index]: choice.text for choice in completion.choices}
+        except Exception as e:
+            logging.error(f"Batched completion of {len(texts)} prompts failed: {e}")
+            for _, future in prompts:
+                _chain(future, e)
+            return
+        for (messages, _, _), future in prompts:
+            answer = answers.get(render_prompt(messages))
+            _chain(future, answer if answer is not None else RuntimeError("No choice returned for the prompt."))
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "mode": self.mode,
+                "batches": self.batches,
+                "prompts": self.prompts,
+                "requests": self.requests,
+                "avg_batch_size": self.prompts / self.batches if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+            }
+
+
+def create_llm_batcher(name, client, model):
+    """Builds the batcher of a service from the LLM_BATCH_* environment variables, or None if disabled."""
+    if LLM_BATCH_MODE not in (LLM_BATCH_MODE_PARALLEL, LLM_BATCH_MODE_COMPLETIONS):
+        raise SystemExit(f"LLM_BATCH_MODE must be '{LLM_BATCH_MODE_PARALLEL}' or '{LLM_BATCH_MODE_COMPLETIONS}', "
+                         f"got '{LLM_BATCH_MODE}'.")
+    if LLM_BATCH_WINDOW_MS <= 0:
+        return None
+    logging.info(f"LLM prompts of '{name}' are batched in '{LLM_BATCH_MODE}' mode, "
+                 f"up to {LLM_BATCH_MAX_SIZE} per {LLM_BATCH_WINDOW_MS} ms window.")
+    return LLMBatcher(client, model, mode=LLM_BATCH_MODE, window_ms=LLM_BATCH_WINDOW_MS,
+                      max_batch_size=LLM_BATCH_MAX_SIZE, name=name)
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from common.cache import MISSING, TTLCache
+
+# --- Configuration ---
+# Backend of the LLM response cache: "memory" (per worker), "sqlite" (a local
+# file shared by the workers of a pod, survives restarts) or "none".
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "3600"))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "/tmp/llm-cache.sqlite3")
+
+
+def normalize_content(content: str) -> str:
+    """Collapses whitespace, so re-wrapped copies of the same email share a cache entry."""
+    return " ".join(content.split())
+
+
+class MemoryBackend:
+    """
+    In-process LRU with TTL. Each worker has its own copy. Values are kept
+    JSON-encoded, like in SQLite, so a caller changing what it got back does
+    not change the cached value.
+    """
+
+    def __init__(self, max_size, ttl_seconds):
+        self.entries = TTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        return MISSING if value is MISSING else json.loads(value)
+
+    def set(self, key, value):
+        self.entries.set(key, json.dumps(value))
+
+
+class SQLiteBackend:
+    """
+    A SQLite file holding JSON-encoded responses. It is shared by all workers
+    that point at the same path and survives restarts. Expired entries, and
+    the oldest ones beyond max_size, are pruned every `prune_every` writes.
+    Other stores can keep their entries in the same file under another `table`.
+    """
+
+    def __init__(self, path, max_size, ttl_seconds, prune_every=100, table="llm_cache"):
+        self.path = path
+        self.table = table
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_created_at ON {table} (created_at)")
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            f"SELECT value FROM {self.table} WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else MISSING
+
+    def set(self, key, value):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now + self.ttl_seconds),
+            )
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+                conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN ("
+                    f"SELECT key FROM {self.table} ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_size,),
+                )
+
+
+class ResponseCache:
+    """
+    Memoizes LLM results for one service, keyed on the model name, the prompt
+    template and a hash of the normalized message content.
+
+    Values must be JSON-serializable (e.g. `model_dump(mode='json')`), so
+    every backend returns a fresh copy. Concurrent misses for the same key
+    wait for the first caller instead of calling the LLM again, so a
+    redelivered event that arrives while the original is still being
+    processed is also answered from the cache. Only callers of the same key
+    wait: the lock that tracks the keys in progress is never held across an
+    LLM call.
+    """
+
+    def __init__(self, service, backend=None):
+        self.service = service
+        self.backend = backend
+        # Keys being computed, each with the Future its concurrent callers wait on
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key(model, template, content):
+        digest = hashlib.sha256()
+        for part in (model, template, normalize_content(content)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, or calls compute() and caches its
+        result. A caller that finds the key already being computed waits for
+        that result, or its exception, instead.
+        """
+        if self.backend is None:
+            return compute()
+
+        value = self._get(key)
+        if value is not MISSING:
+            self._count(hit=True)
+            return value
+
+        with self._in_flight_lock:
+            pending = self._in_flight.get(key)
+            if pending is None:
+                pending = self._in_flight[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            with self._stats_lock:
+                self.coalesced += 1
+            # A fresh copy, as from the backend, since callers may change the value.
+            return json.loads(pending.result())
+
+        try:
+            # Another request may have filled the entry before this one registered the key.
+            value = self._get(key)
+            if value is not MISSING:
+                self._count(hit=True)
+            else:
+                self._count(hit=False)
+                value = compute()
+                try:
+                    self.backend.set(key, value)
+                except Exception as e:
+                    logging.warning(f"LLM cache write failed for service '{self.service}': {e}")
+            pending.set_result(json.dumps(value))
+            return value
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+
+    def lookup(self, key):
+        """Returns the cached value for key, or MISSING, without waiting for a concurrent miss."""
+        if self.backend is None:
+            return MISSING
+        value = self._get(key)
+        self._count(hit=value is not MISSING)
+        return value
+
+    def store(self, key, value):
+        """Caches a value computed without get_or_compute, e.g. answered by a batch."""
+        if self.backend is None:
+            return
+        try:
+            self.backend.set(key, value)
+        except Exception as e:
+            logging.warning(f"LLM cache write failed for service '{self.service}': {e}")
+
+    def _get(self, key):
+        try:
+            return self.backend.get(key)
+        except Exception as e:
+            logging.warning(f"LLM cache read failed for service '{self.service}': {e}")
+            return MISSING
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "service": self.service,
+                "backend": type(self.backend).__name__ if self.backend else None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "coalesced": self.coalesced,
+            }
+
+
+def create_response_cache(service):
+    """Builds the response cache for a service from the LLM_CACHE_* environment variables."""
+    if LLM_CACHE_BACKEND == "none":
+        backend = None
+    elif LLM_CACHE_BACKEND == "memory":
+        backend = MemoryBackend(LLM_CACHE_SIZE, LLM_CACHE_TTL_SECONDS)
+    elif LLM_CACHE_BACKEND == "sqlite":
+        backend = SQLiteBackend(LLM_CACHE_PATH, LLM_CACHE_SIZE, LLM_CACHE_TTL_SECONDS)
+    else:
+        raise SystemExit(f"LLM_CACHE_BACKEND must be 'memory', 'sqlite' or 'none', got '{LLM_CACHE_BACKEND}'.")
+    logging.info(f"LLM response cache for '{service}' uses backend '{LLM_CACHE_BACKEND}'.")
+    return ResponseCache(service, backend)
@@ -0,0 +1,451 @@
+import json
+import logging
+import math
+import queue
+import threading
+import time
+from collections import deque
+
+import httpx
+
+from common.metrics import (
+    LLM_BREAKER_STATE, LLM_CONCURRENCY_LIMIT, LLM_FALLBACKS, LLM_HEDGED_REQUESTS, LLM_REJECTED,
+)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+BREAKER_STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+
+def _is_failure(status_code):
+    """Statuses that mean the server is overloaded or broken, not that the request was bad."""
+    return status_code == 429 or status_code >= 500
+
+
+def reject(request, reason, message):
+    """
+    A 503 answered locally, without calling the LLM server. The OpenAI client
+    raises it as an APIStatusError right away: `x-should-retry: false` turns
+    its retries off, so the processors' error handling sees it immediately.
+    The body is an unread stream, as `content=` would read it and mark the
+    response closed, and the layers outside would never see it closed.
+    """
+    LLM_REJECTED.labels(reason=reason).inc()
+    body = json.dumps({"error": {"message": message, "type": reason, "code": reason}}).encode()
+    return httpx.Response(
+        503, headers={"content-type": "application/json", "content-length": str(len(body)),
+                      "x-should-retry": "false", "x-llm-rejected": reason},
+        stream=httpx.ByteStream(body), request=request,
+    )
+
+
+def _succeeded(outcome):
+    """Whether a hedged copy, (copy, response, error), got a usable answer."""
+    _, response, error = outcome
+    return error is None and not _is_failure(response.status_code)
+
+
+def _buffered(response, request):
+    """
+    Reads the whole body of a response, which closes it, and returns a new,
+    unread response with the same body. The layers outside then wrap and
+    close the new one as any other response, so their close hooks run.
+    """
+    content = response.read()
+    # The body is decoded already; the new response must not decode it again.
+    headers = [(k, v) for k, v in response.headers.multi_items() if k.lower() not in ("content-encoding", "content-length")]
+    return httpx.Response(response.status_code, headers=headers, stream=httpx.ByteStream(content),
+                          request=request, extensions=response.extensions)
+
+
+class _ObservedStream(httpx.SyncByteStream):
+    """Wraps a response body and calls `on_close(failed)` once, when it is closed."""
+
+    def __init__(self, stream, on_close):
+        self.stream = stream
+        self.on_close = on_close
+        self.failed = False
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            yield from self.stream
+        except Exception:
+            # e.g. a read timeout while the body arrives
+            self.failed = True
+            raise
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            if not self.closed:
+                self.closed = True
+                self.on_close(self.failed)
+
+
+class CircuitBreakerTransport(httpx.BaseTransport):
+    """
+    Stops calling an LLM server that keeps failing. After `failure_threshold`
+    failed calls in a row (connection errors, timeouts, 429 and 5xx answers)
+    the breaker opens, and for `reset_seconds` every request is rejected
+    locally with a 503 instead of waiting for the server. Then a single probe
+    request is let through (half-open): if it succeeds the breaker closes, if
+    it fails it opens again.
+
+    A call counts once its response body is closed, so a read timeout in the
+    middle of a streamed generation is a failure too. A 503 rejected locally
+    by an inner layer, such as the adaptive limit, never reached the server
+    and counts neither way.
+    """
+
+    def __init__(self, transport: httpx.BaseTransport, name, failure_threshold=5, reset_seconds=30.0):
+        self.transport = transport
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+        LLM_BREAKER_STATE.labels(target=name).set(BREAKER_STATE_VALUES[CLOSED])
+
+    def _set_state(self, state):
+        if state != self.state:
+            logging.warning(f"LLM circuit breaker '{self.name}' is now {state}.")
+        self.state = state
+        LLM_BREAKER_STATE.labels(target=self.name).set(BREAKER_STATE_VALUES[state])
+
+    def _admit(self):
+        """Returns True if the request may go to the server, and whether it is the half-open probe."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self._set_state(HALF_OPEN)
+            if self.state == CLOSED:
+                return True, False
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True, True
+            self.rejected += 1
+            return False, False
+
+    def _record(self, ok, probe):
+        """Records an outcome: ok True or False, or None for a request the server never saw."""
+        with self._lock:
+            if probe:
+                self.probing = False
+            if ok is None:
+                # A probe rejected locally leaves the breaker half-open for the next one.
+                return
+            if ok:
+                self.failures = 0
+                if self.state == HALF_OPEN and probe:
+                    self._set_state(CLOSED)
+                return
+            self.failures += 1
+            if (self.state == HALF_OPEN and probe) or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.opened += 1
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def handle_request(self, request):
+        admitted, probe = self._admit()
+        if not admitted:
+            return reject(request, "circuit_open", f"LLM circuit breaker '{self.name}' is open after repeated failures.")
+        try:
+            response = self.transport.handle_request(request)
+        except BaseException:
+            self._record(False, probe)
+            raise
+        if "x-llm-rejected" in response.headers:
+            self._record(None, probe)
+            return response
+        status_failed = _is_failure(response.status_code)
+        response.stream = _ObservedStream(
+            response.stream, lambda failed: self._record(not (status_failed or failed), probe)
+        )
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                "breaker": self.name,
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+    def close(self):
+        self.transport.close()
+
+
+class AdaptiveConcurrencyTransport(httpx.BaseTransport):
+    """
+    Limits the requests in flight to a limit that follows the LLM server's
+    health (AIMD). Every call that completes fine raises the limit by 1/limit,
+    about one more slot per round of calls, up to `max_limit`. A failed call
+    (as for the circuit breaker) or one slower than `latency_threshold`
+    seconds halves it, down to `min_limit`. Only calls started after the last
+    decrease can decrease it again, so one slow spell halves the limit once.
+
+    A request waits for a slot for at most `admission_timeout` seconds and is
+    then rejected locally with a 503, rather than piling up in the worker. A
+    slot is held until the response body is closed.
+    """
+
+    def __init__(self, transport: httpx.BaseTransport, name, max_limit, min_limit=1, latency_threshold=0.0,
+                 admission_timeout=30.0, backoff=0.5):
+        self.transport = transport
+        self.name = name
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.latency_threshold = latency_threshold
+        self.admission_timeout = admission_timeout
+        self.backoff = backoff
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.decreased_at = 0.0
+        self.decreases = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+        LLM_CONCURRENCY_LIMIT.labels(target=name).set(self.limit)
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.admission_timeout
+        with self._condition:
+            while self.in_flight >= math.floor(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    return False
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def _release(self, started, ok):
+        latency = time.monotonic() - started
+        with self._condition:
+            self.in_flight -= 1
+            if not ok or (self.latency_threshold and latency > self.latency_threshold):
+                if started > self.decreased_at:
+                    self.limit = max(float(self.min_limit), self.limit * self.backoff)
+                    self.decreased_at = time.monotonic()
+                    self.decreases += 1
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            LLM_CONCURRENCY_LIMIT.labels(target=self.name).set(self.limit)
+            self._condition.notify_all()
+
+    def handle_request(self, request):
+        if not self._acquire():
+            return reject(request, "overloaded",
+                          f"No LLM concurrency slot within {self.admission_timeout}s (limit {math.floor(self.limit)}).")
+        started = time.monotonic()
+        try:
+            response = self.transport.handle_request(request)
+        except BaseException:
+            self._release(started, False)
+            raise
+        status_failed = _is_failure(response.status_code)
+        response.stream = _ObservedStream(
+            response.stream, lambda failed: self._release(started, not (status_failed or failed))
+        )
+        return response
+
+    def stats(self):
+        with self._condition:
+            return {
+                "limiter": self.name,
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "decreases": self.decreases,
+                "rejected": self.rejected,
+            }
+
+    def close(self):
+        self.transport.close()
+
+
+class HedgingTransport(httpx.BaseTransport):
+    """
+    Sends a second copy of a request that takes longer than the `percentile`
+    latency of recent calls, and answers with whichever copy completes first.
+    This cuts the tail latency caused by a slow replica or a stalled
+    connection, for at most `100 - percentile` percent more LLM calls.
+
+    Only non-streamed requests are hedged, since a copy is complete only once
+    its whole body has been read. Until `min_samples` calls have completed
+    nothing is hedged. The losing copy runs to completion in the background
+    and is then closed. A copy's body is read here, so the response handed on
+    is a new one holding it, which the layers outside still see closed.
+    """
+
+    def __init__(self, transport: httpx.BaseTransport, name, percentile=95.0, window=200, min_samples=20):
+        self.transport = transport
+        self.name = name
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.losers_discarded = 0
+
+    def _delay(self):
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        rank = max(1, math.ceil(self.percentile / 100.0 * len(ordered)))
+        return ordered[rank - 1]
+
+    @staticmethod
+    def _streamed(request):
+        try:
+            return bool(json.loads(request.content or b"{}").get("stream"))
+        except (ValueError, AttributeError):
+            return True
+
+    def handle_request(self, request):
+        delay = self._delay()
+        if self._streamed(request):
+            return self.transport.handle_request(request)
+        if delay is None:
+            started = time.monotonic()
+            response = _buffered(self.transport.handle_request(request), request)
+            self._observe(response, time.monotonic() - started)
+            return response
+
+        results = queue.Queue()
+        lock = threading.Lock()
+        decided = False
+
+        def attempt(copy):
+            started = time.monotonic()
+            try:
+                # A copy is complete once its whole body has arrived.
+                response = _buffered(self.transport.handle_request(request), request)
+                self._observe(response, time.monotonic() - started)
+                outcome = (copy, response, None)
+            except Exception as e:
+                outcome = (copy, None, e)
+            with lock:
+                if not decided:
+                    results.put(outcome)
+                    return
+            self._discard(outcome)
+
+        threading.Thread(target=attempt, args=("primary",), daemon=True).start()
+        hedged = False
+        try:
+            outcome = results.get(timeout=delay)
+        except queue.Empty:
+            hedged = True
+            with self._lock:
+                self.hedged += 1
+            threading.Thread(target=attempt, args=("hedge",), daemon=True).start()
+            outcome = results.get()
+        # A failed copy only counts if the other one fails as well.
+        if hedged and not _succeeded(outcome):
+            other = results.get()
+            outcome, loser = (other, outcome) if _succeeded(other) else (outcome, other)
+            self._discard(loser)
+        with lock:
+            decided = True
+        # The other copy may have been queued before the decision; later ones discard themselves.
+        while not results.empty():
+            self._discard(results.get_nowait())
+        if hedged:
+            LLM_HEDGED_REQUESTS.labels(winner=outcome[0]).inc()
+            if outcome[0] == "hedge":
+                with self._lock:
+                    self.hedge_wins += 1
+        _, response, error = outcome
+        if error is not None:
+            raise error
+        return response
+
+    def _discard(self, outcome):
+        """Closes the response of a losing copy."""
+        if outcome[1] is not None:
+            outcome[1].close()
+        with self._lock:
+            self.losers_discarded += 1
+
+    def _observe(self, response, latency):
+        if not _is_failure(response.status_code):
+            with self._lock:
+                self._latencies.append(latency)
+
+    def stats(self):
+        delay = self._delay()
+        with self._lock:
+            return {
+                "hedging": self.name,
+                "hedge_after_ms": round(delay * 1000.0, 1) if delay is not None else None,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "losers_discarded": self.losers_discarded,
+            }
+
+    def close(self):
+        self.transport.close()
+
+
+class FallbackTransport(httpx.BaseTransport):
+    """
+    Sends a request to a secondary LLM server when the primary one fails: a
+    connection error, a 429 or 5xx answer, or a 503 rejected locally by the
+    primary's circuit breaker or concurrency limit. URLs under `primary_base`
+    are rewritten to the same path under `fallback_base`; the model name and
+    API key stay the same.
+    """
+
+    def __init__(self, primary: httpx.BaseTransport, fallback: httpx.BaseTransport, primary_base, fallback_base):
+        self.primary = primary
+        self.fallback = fallback
+        self.primary_base = str(primary_base).rstrip("/")
+        self.fallback_base = str(fallback_base).rstrip("/")
+        self._lock = threading.Lock()
+        self.fallbacks = 0
+
+    def _fallback_request(self, request):
+        url = str(request.url)
+        if not url.startswith(self.primary_base):
+            return None
+        # Host and Content-Length are derived again for the new URL and body.
+        headers = [(k, v) for k, v in request.headers.multi_items() if k.lower() not in ("host", "content-length")]
+        return httpx.Request(request.method, self.fallback_base + url[len(self.primary_base):], headers=headers,
+                             content=request.content, extensions=request.extensions)
+
+    def handle_request(self, request):
+        try:
+            response = self.primary.handle_request(request)
+        except httpx.TransportError as e:
+            fallback_request = self._fallback_request(request)
+            if fallback_request is None:
+                raise
+            reason = type(e).__name__
+        else:
+            fallback_request = self._fallback_request(request) if _is_failure(response.status_code) else None
+            if fallback_request is None:
+                return response
+            reason = response.headers.get("x-llm-rejected") or str(response.status_code)
+            response.close()
+        with self._lock:
+            self.fallbacks += 1
+        LLM_FALLBACKS.labels(reason=reason).inc()
+        return self.fallback.handle_request(fallback_request)
+
+    def stats(self):
+        with self._lock:
+            return {"fallback": self.fallback_base, "fallbacks": self.fallbacks}
+
+    def close(self):
+        try:
+            self.primary.close()
+        finally:
+            self.fallback.close()
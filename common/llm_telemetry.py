@@ -0,0 +1,217 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+
+import httpx
+
+from common.metrics import cached_prompt_tokens, record_llm_call
+from common.prompts import TEMPLATE_HEADER
+
+# --- Configuration ---
+# Fraction of LLM calls whose full request and response bodies are logged.
+LLM_LOG_BODY_SAMPLE_RATE = float(os.getenv("LLM_LOG_BODY_SAMPLE_RATE", "0"))
+# Logs every body and turns on httpx's own request logging.
+LLM_DEBUG = os.getenv("LLM_DEBUG", "false").lower() == "true"
+# Log records waiting for the writer thread; more are dropped rather than blocking a request.
+LLM_LOG_QUEUE_SIZE = int(os.getenv("LLM_LOG_QUEUE_SIZE", "10000"))
+
+# Only the tail of a streamed response is kept, which is where the usage chunk arrives.
+STREAM_TAIL_BYTES = 8192
+
+logger = logging.getLogger("llm.calls")
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread without formatting them first, and
+    drops them when the queue is full instead of waiting for it to drain.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_queue_handler = None
+_setup_lock = threading.Lock()
+
+
+def _setup_logging():
+    """Sends the llm.calls logger through a queue to a writer thread, once per process."""
+    global _queue_handler
+    with _setup_lock:
+        if _queue_handler is not None:
+            return
+        log_queue = queue.Queue(maxsize=LLM_LOG_QUEUE_SIZE)
+        # Write with the handlers of the root logger configured by the service.
+        handlers = logging.getLogger().handlers or [logging.StreamHandler()]
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        _queue_handler = _DroppingQueueHandler(log_queue)
+        logger.addHandler(_queue_handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        if LLM_DEBUG:
+            logging.getLogger("httpx").setLevel(logging.DEBUG)
+
+
+class CallStats:
+    """Totals of the LLM calls made by this worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.latency_seconds_total = 0.0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        # template id -> [calls, prompt tokens, cached prompt tokens]
+        self.templates = {}
+
+    def record(self, status, latency_seconds, usage, template=None):
+        record_llm_call(status, latency_seconds, usage, template)
+        cached = cached_prompt_tokens(usage)
+        with self._lock:
+            self.calls += 1
+            if status is None or status >= 400:
+                self.errors += 1
+            self.latency_seconds_total += latency_seconds
+            self.prompt_tokens += usage.get("prompt_tokens") or 0
+            self.cached_tokens += cached
+            self.completion_tokens += usage.get("completion_tokens") or 0
+            if template:
+                totals = self.templates.setdefault(template, [0, 0, 0])
+                totals[0] += 1
+                totals[1] += usage.get("prompt_tokens") or 0
+                totals[2] += cached
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "latency_ms_avg": (self.latency_seconds_total / self.calls * 1000.0) if self.calls else 0.0,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "completion_tokens": self.completion_tokens,
+                "templates": {
+                    template: {"calls": calls, "prompt_tokens": prompt, "cached_tokens": cached,
+                               "cached_share": cached / prompt if prompt else 0.0}
+                    for template, (calls, prompt, cached) in self.templates.items()
+                },
+                "log_records_dropped": _queue_handler.dropped if _queue_handler else 0,
+            }
+
+
+call_stats = CallStats()
+
+
+def _parse_usage(body, streamed):
+    """Returns (model, usage) from a chat completion body, or from the last SSE chunk that has usage."""
+    try:
+        if not streamed:
+            data = json.loads(body)
+            return data.get("model"), data.get("usage") or {}
+        for line in reversed(body.splitlines()):
+            if line.startswith(b"data:") and b'"usage"' in line:
+                data = json.loads(line[5:])
+                if data.get("usage"):
+                    return data.get("model"), data["usage"]
+    except (ValueError, AttributeError):
+        pass
+    return None, {}
+
+
+class _TappedStream(httpx.SyncByteStream):
+    """
+    Passes the response body through to the caller unchanged and keeps a copy
+    (only the tail of a streamed response), so usage can be recorded once the
+    caller has closed it. Nothing here forces the body to be read.
+    """
+
+    def __init__(self, stream, on_close, streamed, keep_all):
+        self.stream = stream
+        self.on_close = on_close
+        self.streamed = streamed
+        self.keep_all = keep_all
+        self.chunks = []
+        self.size = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.stream:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            if self.streamed and not self.keep_all:
+                while self.size - len(self.chunks[0]) >= STREAM_TAIL_BYTES:
+                    self.size -= len(self.chunks.pop(0))
+            yield chunk
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            if not self.closed:
+                self.closed = True
+                self.on_close(b"".join(self.chunks))
+
+
+class InstrumentedTransport(httpx.BaseTransport):
+    """
+    Records status, model, latency and token usage of every LLM call to
+    `call_stats`, and logs one line per call through a queue. Full request
+    and response bodies are logged only for sampled calls.
+    """
+
+    def __init__(self, transport: httpx.BaseTransport, body_sample_rate=LLM_LOG_BODY_SAMPLE_RATE):
+        self.transport = transport
+        self.body_sample_rate = 1.0 if LLM_DEBUG else body_sample_rate
+        _setup_logging()
+
+    def handle_request(self, request):
+        started = time.perf_counter()
+        template = request.headers.get(TEMPLATE_HEADER)
+        try:
+            response = self.transport.handle_request(request)
+        except Exception as e:
+            latency = time.perf_counter() - started
+            call_stats.record(None, latency, {}, template)
+            logger.warning(f"LLM call failed path={request.url.path} latency_ms={latency * 1000:.1f} error={type(e).__name__}: {e}")
+            raise
+
+        sampled = self.body_sample_rate > 0 and random.random() < self.body_sample_rate
+        streamed = response.headers.get("content-type", "").startswith("text/event-stream")
+
+        def on_close(body):
+            latency = time.perf_counter() - started
+            model, usage = _parse_usage(body, streamed)
+            call_stats.record(response.status_code, latency, usage, template)
+            logger.info(
+                f"LLM call path={request.url.path} status={response.status_code} model={model} template={template} "
+                f"latency_ms={latency * 1000:.1f} prompt_tokens={usage.get('prompt_tokens')} "
+                f"cached_tokens={cached_prompt_tokens(usage)} completion_tokens={usage.get('completion_tokens')}"
+            )
+            if sampled:
+                logger.info(f"LLM request body: {request.content.decode('utf-8', 'replace')}")
+                logger.info(f"LLM response body: {body.decode('utf-8', 'replace')}")
+
+        response.stream = _TappedStream(response.stream, on_close, streamed, keep_all=sampled)
+        return response
+
+    def close(self):
+        self.transport.close()
@@ -0,0 +1,157 @@
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Response
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+# --- Configuration ---
+# With several gunicorn workers each one keeps its own metrics. When this is
+# set, workers write their samples to files in this directory and /metrics
+# aggregates them, whichever worker serves the scrape. gunicorn.conf.py clears
+# it on startup and cleans up after workers that exit.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+# Buckets from 0.5ms (parsing a payload) to 60s (a slow LLM generation).
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# --- Metrics ---
+STAGE_SECONDS = Histogram(
+    "triage_stage_seconds", "Time spent in each stage of handling an event.",
+    ["stage"], buckets=LATENCY_BUCKETS,
+)
+EVENTS_RECEIVED = Counter("triage_events_received_total", "Events received, by CloudEvent type.", ["event_type"])
+EVENTS_EMITTED = Counter("triage_events_emitted_total", "Events emitted, by CloudEvent type.", ["event_type"])
+DUPLICATES_SUPPRESSED = Counter(
+    "triage_duplicates_suppressed_total", "Redelivered events answered with the recorded reply, by stage.", ["stage"],
+)
+
+LLM_REQUEST_SECONDS = Histogram(
+    "triage_llm_request_seconds", "Duration of LLM HTTP calls, until the response body is closed.",
+    ["status"], buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter("triage_llm_tokens_total", "Tokens reported in the usage of LLM responses.", ["kind"])
+LLM_TEMPLATE_TOKENS = Counter(
+    "triage_llm_template_tokens_total", "Prompt tokens of LLM calls, and those served from the server's prefix cache, by prompt template.",
+    ["template", "kind"],
+)
+LLM_FIRST_FIELD_SECONDS = Histogram(
+    "triage_llm_first_field_seconds", "Time from sending a streamed extraction to its first parsed field.",
+    buckets=LATENCY_BUCKETS,
+)
+LLM_CUTOFFS = Counter(
+    "triage_llm_cutoffs_total", "Extractions cut off by the timeout or the token budget, and whether the partial result was used.",
+    ["reason", "partial_used"],
+)
+LLM_BREAKER_STATE = Gauge(
+    "triage_llm_breaker_state", "State of the LLM circuit breakers: 0 closed, 1 open, 2 half-open.",
+    ["target"], multiprocess_mode="max",
+)
+LLM_CONCURRENCY_LIMIT = Gauge(
+    "triage_llm_concurrency_limit", "Adaptive limit on LLM requests in flight, summed over the workers.",
+    ["target"], multiprocess_mode="livesum",
+)
+LLM_REJECTED = Counter(
+    "triage_llm_rejected_total", "LLM requests rejected locally by an open circuit breaker or the concurrency limit.",
+    ["reason"],
+)
+LLM_HEDGED_REQUESTS = Counter(
+    "triage_llm_hedged_requests_total", "LLM requests that got a hedged second copy, by the copy that answered.",
+    ["winner"],
+)
+LLM_FALLBACKS = Counter("triage_llm_fallbacks_total", "LLM requests sent to the fallback server, by reason.", ["reason"])
+
+ROUTER_DECISIONS = Counter(
+    "triage_router_decisions_total", "Messages routed, by the tier that classified them.", ["tier"],
+)
+SEMANTIC_CACHE_LOOKUPS = Counter("triage_semantic_cache_lookups_total", "Semantic cache lookups, by result.", ["result"])
+SEMANTIC_CACHE_SAVED_SECONDS = Counter(
+    "triage_semantic_cache_saved_seconds_total", "LLM time saved by semantic cache hits, net of the embedding call.",
+)
+
+EVENT_PAYLOAD_BYTES = Histogram(
+    "triage_event_payload_bytes", "Size of the event payloads sent to the Broker.",
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+)
+BLOB_STORE_OPERATIONS = Counter(
+    "triage_blob_store_operations_total", "Message contents stored and fetched for claim check, by result.",
+    ["op", "result"],
+)
+BLOB_FETCH_SECONDS = Histogram(
+    "triage_blob_fetch_seconds", "Time to fetch a message content from the blob store backend.", buckets=LATENCY_BUCKETS,
+)
+
+CONTENT_TOKENS = Histogram(
+    "triage_content_tokens", "Approximate tokens of message contents, before and after reduction for the LLM prompts.",
+    ["kind"], buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536),
+)
+
+DB_QUERY_SECONDS = Histogram(
+    "triage_db_query_seconds", "Duration of database queries, including the connection checkout.",
+    ["query"], buckets=LATENCY_BUCKETS,
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "triage_db_pool_wait_seconds", "Time spent waiting for a free pooled database connection.",
+    buckets=LATENCY_BUCKETS,
+)
+DB_CONNECTIONS_DISCARDED = Counter(
+    "triage_db_connections_discarded_total", "Pooled connections closed after a connection-level error.",
+)
+
+SSE_CLIENTS = Gauge("triage_sse_clients", "Connected Server-Sent Events clients.", multiprocess_mode="livesum")
+SSE_EVENTS_PUBLISHED = Counter("triage_sse_events_published_total", "Events published to Server-Sent Events clients.")
+SSE_EVENTS_SKIPPED = Counter(
+    "triage_sse_events_skipped_total", "Events slow Server-Sent Events clients skipped because they fell out of the buffer.",
+)
+
+FORWARD_QUEUE_DEPTH = Gauge(
+    "triage_forward_queue_depth", "Events accepted by the intake service and waiting to be sent to the Broker.",
+    multiprocess_mode="livesum",
+)
+FORWARD_RETRIES = Counter("triage_forward_retries_total", "Failed attempts to send a queued event to the Broker.")
+FORWARD_DROPPED = Counter("triage_forward_dropped_total", "Queued events dropped because the Broker rejected them.")
+
+
+@contextmanager
+def stage(name):
+    """Times the block into the triage_stage_seconds histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage=name).observe(time.perf_counter() - started)
+
+
+def cached_prompt_tokens(usage):
+    """The prompt tokens the LLM server answered from its prefix cache, as reported in OpenAI's usage."""
+    return (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+
+def record_llm_call(status, latency_seconds, usage, template=None):
+    LLM_REQUEST_SECONDS.labels(status=str(status) if status is not None else "error").observe(latency_seconds)
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage.get(kind):
+            LLM_TOKENS.labels(kind=kind.removesuffix("_tokens")).inc(usage[kind])
+    cached = cached_prompt_tokens(usage)
+    if cached:
+        LLM_TOKENS.labels(kind="cached_prompt").inc(cached)
+    if template and usage.get("prompt_tokens"):
+        LLM_TEMPLATE_TOKENS.labels(template=template, kind="prompt").inc(usage["prompt_tokens"])
+        LLM_TEMPLATE_TOKENS.labels(template=template, kind="cached_prompt").inc(cached)
+
+
+def register_metrics_route(app):
+    """Adds GET /metrics in the Prometheus text format to a Flask app."""
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        if PROMETHEUS_MULTIPROC_DIR:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
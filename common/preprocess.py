@@ -0,0 +1,223 @@
+import functools
+import logging
+import os
+import re
+
+from common.blobstore import message_content
+from common.metrics import CONTENT_TOKENS
+
+# --- Configuration ---
+# The largest message content, in approximate tokens, that is put into an LLM
+# prompt. Longer content keeps its beginning and its end. 0 disables the limit.
+CONTENT_MAX_TOKENS = int(os.getenv("CONTENT_MAX_TOKENS", "2000"))
+# Share of the budget kept from the end of the content, where the sender's
+# name and contact details usually are.
+CONTENT_TAIL_SHARE = float(os.getenv("CONTENT_TAIL_SHARE", "0.2"))
+# Drop the quoted reply chain and trim signatures before the budget applies
+CONTENT_STRIP_QUOTES = os.getenv("CONTENT_STRIP_QUOTES", "true").lower() == "true"
+CONTENT_STRIP_SIGNATURES = os.getenv("CONTENT_STRIP_SIGNATURES", "true").lower() == "true"
+# Lines of a "-- " signature block that are kept: name, company and phone are
+# extracted by the structure processor, longer blocks are mostly disclaimers.
+SIGNATURE_MAX_LINES = 4
+# Tokens each chunk of an over-budget content repeats from the end of the one
+# before, so a phrase across a cut is whole in one of them.
+CHUNK_OVERLAP_TOKENS = 50
+
+# Words, numbers and single punctuation marks; a long word counts as one token per 4 characters.
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# The first line of a quoted reply chain. Everything from here on is the previous thread.
+REPLY_HEADER = re.compile(
+    r"^(On .{1,200} wrote:|-{2,}\s*Original Message\s*-{2,}|-{2,}\s*Forwarded message\s*-{2,})$",
+    re.IGNORECASE,
+)
+# The fields of a header block as Outlook quotes a reply: "From:", then "Sent:", "To:", "Subject:" and the like.
+HEADER_FIELD = re.compile(r"^(From|Sent|Date|To|Cc|Subject):\s", re.IGNORECASE)
+SIGNATURE_DELIMITER = re.compile(r"^--\s?$")
+MOBILE_FOOTER = re.compile(r"^Sent from my \w+", re.IGNORECASE)
+
+
+def approx_tokens(text: str) -> int:
+    """A local approximation of the token count of text, close to BPE tokenizers for English."""
+    return sum(max(1, len(word) // 4) for word in TOKEN_PATTERN.findall(text))
+
+
+def normalize_whitespace(text: str) -> str:
+    """Collapses runs of spaces and tabs, trims lines and keeps at most one blank line in a row."""
+    lines = [" ".join(line.split()) for line in text.splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def _header_block_at(lines, i) -> bool:
+    """
+    Whether lines[i] starts a quoted header block: a "From:" line followed by
+    "Sent:" (or "Date:"), "To:" and "Subject:" lines. A lone line starting
+    with "From:" is part of the message.
+    """
+    if not lines[i].lower().startswith("from:"):
+        return False
+    fields = set()
+    for line in lines[i + 1:i + 6]:
+        field = HEADER_FIELD.match(line)
+        if not field:
+            break
+        fields.add(field.group(1).lower())
+    return bool(fields & {"sent", "date"}) and {"to", "subject"} <= fields
+
+
+def strip_quoted_replies(text: str) -> str:
+    """Removes the quoted reply chain: everything after a reply header, and lines quoted with '>'."""
+    kept = []
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        if REPLY_HEADER.match(line) or _header_block_at(lines, i):
+            break
+        if not line.startswith(">"):
+            kept.append(line)
+    return "\n".join(kept).strip()
+
+
+def strip_signature(text: str) -> str:
+    """Drops mobile footers and trims a '-- ' signature block to its first SIGNATURE_MAX_LINES lines."""
+    lines = [line for line in text.splitlines() if not MOBILE_FOOTER.match(line)]
+    for i, line in enumerate(lines):
+        if SIGNATURE_DELIMITER.match(line):
+            lines = lines[:i] + lines[i + 1:i + 1 + SIGNATURE_MAX_LINES]
+            break
+    return "\n".join(lines).strip()
+
+
+def _pieces(text: str, max_piece_tokens: int) -> list[tuple[str, str]]:
+    """
+    The words of text, each with the separator before it, with every word
+    over max_piece_tokens (a long URL, an encoded attachment, text without
+    spaces) cut into pieces that join without a separator. A piece of n
+    characters is at most n tokens.
+    """
+    pieces = []
+    for index, word in enumerate(text.split(" ")):
+        separator = " " if index else ""
+        if approx_tokens(word) > max_piece_tokens:
+            pieces.extend((separator if i == 0 else "", word[i:i + max_piece_tokens])
+                          for i in range(0, len(word), max_piece_tokens))
+        else:
+            pieces.append((separator, word))
+    return pieces
+
+
+def _join(pieces) -> str:
+    text = "".join(separator + piece for separator, piece in pieces)
+    return text[1:] if pieces and pieces[0][0] else text
+
+
+def truncate_to_budget(text: str, max_tokens: int) -> str:
+    """
+    Keeps the beginning and the end of text within max_tokens, with a marker
+    where the middle was left out. Cuts fall on word boundaries, or inside
+    words too long to keep whole.
+    """
+    if max_tokens <= 0 or approx_tokens(text) <= max_tokens:
+        return text
+    tail_budget = int(max_tokens * CONTENT_TAIL_SHARE)
+    # The marker takes about 10 tokens of the budget.
+    head_budget = max_tokens - tail_budget - 10
+    pieces = _pieces(text, max(1, min(head_budget, tail_budget or head_budget) // 2))
+    head, used = [], 0
+    for piece in pieces:
+        used += approx_tokens(piece[1])
+        if used > head_budget:
+            break
+        head.append(piece)
+    tail, used = [], 0
+    for piece in reversed(pieces[len(head):]):
+        used += approx_tokens(piece[1])
+        if used > tail_budget:
+            break
+        tail.append(piece)
+    omitted = approx_tokens(_join(pieces[len(head):len(pieces) - len(tail)]))
+    return f"{_join(head)}\n[... {omitted} tokens omitted ...]\n{_join(list(reversed(tail)))}".strip()
+
+
+def split_to_budget(text: str, max_tokens: int, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> list[str]:
+    """
+    Splits text into consecutive chunks of about max_tokens each, cut on word
+    boundaries, each starting `overlap_tokens` before the end of the previous
+    one. Unlike truncate_to_budget nothing is left out. A word longer than
+    half the budget, such as an encoded attachment, is cut into pieces.
+    """
+    if max_tokens <= 0 or approx_tokens(text) <= max_tokens:
+        return [text]
+    overlap = min(overlap_tokens, max_tokens // 4)
+    pieces = _pieces(text, max(1, max_tokens // 2))
+    costs = [approx_tokens(piece) for _, piece in pieces]
+    chunks, start = [], 0
+    while True:
+        end, used = start, 0
+        while end < len(pieces) and used + costs[end] <= max_tokens:
+            used += costs[end]
+            end += 1
+        end = max(end, start + 1)
+        chunks.append(_join(pieces[start:end]))
+        if end >= len(pieces):
+            return chunks
+        next_start, repeated = end, 0
+        while next_start > start + 1 and repeated + costs[next_start - 1] <= overlap:
+            next_start -= 1
+            repeated += costs[next_start]
+        start = next_start
+
+
+@functools.lru_cache(maxsize=256)
+def reduce_content(content: str) -> str:
+    """
+    The text of a message as it goes into LLM prompts. It only depends on the
+    content and the configuration, so every LLM stage sends the same text.
+    """
+    text = normalize_whitespace(content)
+    if CONTENT_STRIP_QUOTES:
+        text = strip_quoted_replies(text) or text
+    if CONTENT_STRIP_SIGNATURES:
+        text = strip_signature(text) or text
+    return truncate_to_budget(text, CONTENT_MAX_TOKENS)
+
+
+def prompt_content(message) -> str:
+    """
+    Returns the reduced content of an OuterWrapper. The first stage to reduce
+    a message records the original and reduced sizes in metadata.content_size.
+    """
+    content = message_content(message)
+    reduced = reduce_content(content)
+    if "content_size" not in message.metadata:
+        size = {
+            "original_chars": len(content),
+            "original_tokens": approx_tokens(content),
+            "reduced_chars": len(reduced),
+            "reduced_tokens": approx_tokens(reduced),
+        }
+        message.metadata["content_size"] = size
+        CONTENT_TOKENS.labels(kind="original").observe(size["original_tokens"])
+        CONTENT_TOKENS.labels(kind="reduced").observe(size["reduced_tokens"])
+        if size["reduced_tokens"] < size["original_tokens"]:
+            logging.info(f"[{message.message_id}] - Content reduced from {size['original_tokens']} "
+                         f"to {size['reduced_tokens']} tokens for the LLM prompts.")
+    return reduced
+
+
+@functools.lru_cache(maxsize=256)
+def _content_chunks(content: str) -> tuple:
+    return tuple(split_to_budget(normalize_whitespace(content), CONTENT_MAX_TOKENS))
+
+
+def content_chunks(message) -> list[str]:
+    """
+    The whole content of an OuterWrapper, for checks that must see all of it,
+    like the guardian's: only whitespace is normalized, no reply chain or
+    signature is stripped, and content over CONTENT_MAX_TOKENS is split into
+    chunks to check one by one instead of being truncated.
+    """
+    chunks = list(_content_chunks(message_content(message)))
+    if len(chunks) > 1:
+        logging.info(f"[{message.message_id}] - Content split into {len(chunks)} chunks of up to "
+                     f"{CONTENT_MAX_TOKENS} tokens for the checks.")
+    return chunks
@@ -0,0 +1,160 @@
+import logging
+import os
+import re
+
+# --- Configuration ---
+# Pins prompt templates to older versions, e.g. "guardian.harm=1,router.classify=1".
+# Templates not listed use their latest version.
+PROMPT_VERSIONS = os.getenv("PROMPT_VERSIONS", "")
+
+# Sent with every LLM call, so common/llm_telemetry.py can count tokens per template
+TEMPLATE_HEADER = "X-Prompt-Template"
+
+# Models trained on one prompt format, with the template versions they get unless PROMPT_VERSIONS pins another.
+# Granite Guardian takes the name of the risk as its system prompt and answers Yes or No: guardian.harm@v1.
+MODEL_VERSIONS = [
+    (re.compile(r"granite.*guardian", re.IGNORECASE), {"guardian.harm": 1}),
+]
+
+
+class PromptTemplate:
+    """
+    A versioned chat prompt, laid out for the prefix caches of LLM servers
+    (vLLM's automatic prefix caching, OpenAI's prompt caching): they reuse the
+    work done for the longest prefix a prompt shares with earlier ones.
+
+    The system message is fixed text, shared by every call of the template,
+    so it comes first. The message content comes next, in its own user
+    message; it is shared by the calls made for one message. An optional
+    question comes last, for the parts that vary between calls on the same
+    content, such as the harm the guardian asks about.
+
+    `user` and `question` are format strings: `{content}` is the message
+    content, other fields are passed to `messages`. The system message is
+    formatted too, so literal braces in any part are doubled.
+
+    The text of a version must not change once it has been used, since
+    response caches are keyed on the template id instead of its text.
+    """
+
+    def __init__(self, name, version, system, user="{content}", question=None):
+        self.name = name
+        self.version = version
+        self.system = system
+        self.user = user
+        self.question = question
+
+    @property
+    def id(self):
+        return f"{self.name}@v{self.version}"
+
+    def messages(self, content, **values):
+        messages = [
+            {"role": "system", "content": self.system.format(**values)},
+            {"role": "user", "content": self.user.format(content=content, **values)},
+        ]
+        if self.question:
+            messages.append({"role": "user", "content": self.question.format(**values)})
+        return messages
+
+    def cache_template(self, **values):
+        """The template part of a response cache key: the id and the values of the variable fields."""
+        return "|".join([self.id, *(f"{k}={v}" for k, v in sorted(values.items()))])
+
+    def headers(self):
+        return {TEMPLATE_HEADER: self.id}
+
+
+_templates = {}
+
+
+def register(template):
+    _templates.setdefault(template.name, {})[template.version] = template
+    return template
+
+
+def _pinned_versions():
+    pinned = {}
+    for entry in filter(None, (part.strip() for part in PROMPT_VERSIONS.split(","))):
+        name, _, version = entry.partition("=")
+        if not version.strip().isdigit():
+            raise SystemExit(f"PROMPT_VERSIONS entries must look like 'name=1', got '{entry}'.")
+        pinned[name.strip()] = int(version)
+    return pinned
+
+
+def _model_version(name, model):
+    for pattern, model_versions in MODEL_VERSIONS:
+        if model and pattern.search(model) and name in model_versions:
+            return model_versions[name]
+    return None
+
+
+def get_prompt(name, version=None, model=None):
+    """
+    The template `name` at `version`, at the version pinned in
+    PROMPT_VERSIONS, at the version `model` needs (see MODEL_VERSIONS), or at
+    its latest version.
+    """
+    versions = _templates.get(name)
+    if not versions:
+        raise KeyError(f"Unknown prompt template '{name}'.")
+    version = version or _pinned_versions().get(name) or _model_version(name, model) or max(versions)
+    if version not in versions:
+        raise SystemExit(f"Prompt template '{name}' has no version {version}; known: {sorted(versions)}.")
+    logging.info(f"Using prompt template '{name}' version {version}.")
+    return versions[version]
+
+
+# --- Templates ---
+ROUTE_DESCRIPTIONS = """- **Support**: Issues related to technical support, product usage, and troubleshooting.
+- **Finance**: Questions about billing, invoices, receipts, payments, refunds, or financial disputes.
+- **Website**: Issues related to website functionality, login problems, password reset, account access, or technical errors on the website.
+- **Unknown**: If the message does not fit into any of the above categories or lacks sufficient context to classify accurately."""
+
+ROUTER_SYSTEM_PROMPT = (
+    "You are an AI-powered message classifier for an enterprise support system. Your task is to analyze email "
+    "messages and determine the most appropriate team for handling them:\n" + ROUTE_DESCRIPTIONS
+)
+ROUTER_USER_PROMPT = "Classify the following email message and determine the appropriate routing category.\n\nMESSAGE:\n{content}"
+
+register(PromptTemplate("router.classify", 1, ROUTER_SYSTEM_PROMPT, ROUTER_USER_PROMPT))
+# Batched /completions calls have no tools for instructor, so the answer is asked for as JSON.
+register(PromptTemplate(
+    "router.classify-json", 1, ROUTER_SYSTEM_PROMPT, ROUTER_USER_PROMPT,
+    question='Reply with only a JSON object like {{"route": "support", "reason": "...", "escalation_required": false}}, '
+             'where route is one of "support", "finance", "website" or "unknown".',
+))
+
+register(PromptTemplate(
+    "structure.extract", 1,
+    "You are a world-class text analysis expert. Extract the information precisely into the provided JSON format. "
+    "The message is a customer support email.",
+))
+
+# Version 1 puts the harm name first, so the three checks of a message share no prefix. It is the
+# format Granite Guardian was trained on, which gets it by default (see MODEL_VERSIONS).
+register(PromptTemplate("guardian.harm", 1, "{harm}"))
+register(PromptTemplate(
+    "guardian.harm", 2,
+    "You are a content safety classifier for an enterprise support system. You are given a customer support "
+    "email, followed by a question about one harm category. Answer with a single word: Yes if the email contains "
+    "that harm, otherwise No.",
+    user="EMAIL:\n{content}",
+    question="Does the email contain {harm_text}? Answer Yes or No.",
+))
+register(PromptTemplate(
+    "guardian.multi-label", 1,
+    "You are a content safety classifier. For each harm category, answer true if the message contains that harm, "
+    "otherwise false.",
+))
+
+register(PromptTemplate(
+    "combined.triage", 1,
+    "You are an AI-powered triage assistant for an enterprise support system. Analyze the customer support email "
+    "and fill in all three parts of the answer:\n"
+    "- **harms**: for each harm category, true if the message contains that harm, otherwise false.\n"
+    "- **structured**: extract the information precisely (reason, whether to escalate, contact details, product).\n"
+    "- **route**: the team that should handle the message:\n"
+    + "\n".join("  " + line for line in ROUTE_DESCRIPTIONS.splitlines()),
+))
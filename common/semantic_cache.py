@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    A nearest-neighbour cache of JSON-serializable values keyed on embedding
+    vectors. `lookup` returns the value of the most similar stored vector if
+    its cosine similarity is at least `threshold`. Entries are kept under a
+    namespace, such as the models and prompt template that computed them, and
+    a lookup only considers the entries of its own namespace.
+
+    Vectors are normalized and kept in one preallocated float32 matrix, so a
+    lookup is a single matrix-vector product. When the cache is full, the
+    least recently used entry is replaced. If `path` is set, the cache is
+    loaded from that .npz file on startup and written back every
+    `save_every` additions and by `save()`.
+    """
+
+    def __init__(self, max_size=5000, threshold=0.92, path=None, save_every=50):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.path = path
+        self.save_every = save_every
+        self.lock = threading.Lock()
+        self.vectors = None  # allocated on the first add, when the dimension is known
+        self.values = []
+        # The namespace of each entry, as an index into namespace_names
+        self.namespace_of = np.full(max_size, -1, dtype=np.int32)
+        self.namespace_names = []
+        self.costs = np.zeros(max_size, dtype=np.float32)
+        self.last_used = np.zeros(max_size, dtype=np.float64)
+        self.unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        if path and os.path.exists(path):
+            self._load()
+
+    def lookup(self, vector, namespace=""):
+        """Returns (value, similarity, cost_seconds) of the nearest entry in namespace, or None below the threshold."""
+        query = self._normalize(vector)
+        with self.lock:
+            if (not self.values or query.shape[0] != self.vectors.shape[1]
+                    or namespace not in self.namespace_names):
+                self.misses += 1
+                return None
+            similarities = self.vectors[:len(self.values)] @ query
+            similarities[self.namespace_of[:len(self.values)] != self.namespace_names.index(namespace)] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.last_used[best] = time.time()
+            return json.loads(self.values[best]), float(similarities[best]), float(self.costs[best])
+
+    def add(self, vector, value, cost_seconds=0.0, namespace=""):
+        """
+        Stores value under vector in namespace. cost_seconds is what computing
+        the value took, reported as saved on hits.
+        """
+        vector = self._normalize(vector)
+        with self.lock:
+            if self.vectors is None or vector.shape[0] != self.vectors.shape[1]:
+                # First entry, or the embedding model changed: start over.
+                self.vectors = np.zeros((self.max_size, vector.shape[0]), dtype=np.float32)
+                self.values = []
+            if len(self.values) < self.max_size:
+                slot = len(self.values)
+                self.values.append(None)
+            else:
+                slot = int(np.argmin(self.last_used))
+            if namespace not in self.namespace_names:
+                self.namespace_names.append(namespace)
+            self.vectors[slot] = vector
+            self.namespace_of[slot] = self.namespace_names.index(namespace)
+            self.values[slot] = json.dumps(value)
+            self.costs[slot] = cost_seconds
+            self.last_used[slot] = time.time()
+            self.unsaved += 1
+            save = self.path and self.unsaved >= self.save_every
+        if save:
+            self.save()
+
+    def record_saving(self, seconds):
+        with self.lock:
+            self.saved_seconds += max(0.0, seconds)
+
+    def save(self):
+        """Writes the cache to `path`, through a temporary file so a crash never leaves a partial file."""
+        if not self.path:
+            return
+        with self.lock:
+            if self.vectors is None or not self.unsaved:
+                return
+            count = len(self.values)
+            data = {
+                "vectors": self.vectors[:count].copy(),
+                "values": np.array(self.values, dtype=object),
+                "namespaces": np.array([self.namespace_names[i] for i in self.namespace_of[:count]], dtype=object),
+                "costs": self.costs[:count].copy(),
+                "last_used": self.last_used[:count].copy(),
+            }
+            self.unsaved = 0
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save the semantic cache to '{self.path}': {e}")
+
+    def _load(self):
+        try:
+            with np.load(self.path, allow_pickle=True) as data:
+                vectors, values = data["vectors"], [str(v) for v in data["values"]]
+                # Files without namespaces do not say which models computed their entries.
+                namespaces = [str(v) for v in data["namespaces"]]
+                costs, last_used = data["costs"], data["last_used"]
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable semantic cache file '{self.path}': {e}")
+            return
+        # Keep the most recently used entries if the file holds more than fit.
+        keep = np.argsort(last_used)[::-1][:self.max_size]
+        self.vectors = np.zeros((self.max_size, vectors.shape[1]), dtype=np.float32)
+        self.vectors[:len(keep)] = vectors[keep]
+        self.values = [values[i] for i in keep]
+        self.namespace_names = sorted({namespaces[i] for i in keep})
+        self.namespace_of[:len(keep)] = [self.namespace_names.index(namespaces[i]) for i in keep]
+        self.costs[:len(keep)] = costs[keep]
+        self.last_used[:len(keep)] = last_used[keep]
+        logging.info(f"Loaded {len(self.values)} semantic cache entries from '{self.path}'.")
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.values),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3),
+            }
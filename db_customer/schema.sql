@@ -4,5 +4,33 @@ CREATE TABLE customers (
                            contact_name VARCHAR(255),
                            contact_email VARCHAR(255) UNIQUE,
                            country VARCHAR(100),
-                           phone VARCHAR(50)
+                           phone VARCHAR(50),
+                           updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
 );
+
+CREATE INDEX customers_updated_at_idx ON customers (updated_at);
+
+-- Keeps updated_at current and announces every change on the 'customers_changed'
+-- channel, with the affected contact_email as payload. svc_customer_lookup uses
+-- both to refresh its in-memory snapshot incrementally.
+CREATE FUNCTION customers_track_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        NEW.updated_at := now();
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('customers_changed', OLD.contact_email);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        IF TG_OP = 'INSERT' OR NEW.contact_email IS DISTINCT FROM OLD.contact_email THEN
+            PERFORM pg_notify('customers_changed', NEW.contact_email);
+        END IF;
+        RETURN NEW;
+    END IF;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER customers_track_change
+    BEFORE INSERT OR UPDATE OR DELETE ON customers
+    FOR EACH ROW EXECUTE FUNCTION customers_track_change();
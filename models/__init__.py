@@ -1,26 +1,30 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr, create_model
 from typing import List, Optional, Any, Dict
 from datetime import datetime
 from enum import Enum
 
 # This model defines the structured data we want the LLM to extract.
+# The LLM generates the fields in this order, so the ones the routing depends
+# on come first and are complete early in a streamed extraction.
 class StructuredObject(BaseModel):
     reason: str
+    escalate: bool
+    email_address: Optional[str]
     sentiment: Optional[str]
     company_id: Optional[str]
     company_name: Optional[str]
     customer_name: Optional[str]
     country: Optional[str]
-    email_address: Optional[str]
     phone: Optional[str]
     product_name: Optional[str]
-    escalate: bool
 
 # This is the main data object that flows through the system.
 # It's the payload of our CloudEvents.
 class OuterWrapper(BaseModel):
     message_id: str
+    # Empty when the content is passed by reference (see common/blobstore.py)
     content: str
+    content_ref: Optional[str] = None
     metadata: Dict[str, Any] = Field(default_factory=dict)
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     structured: Optional[StructuredObject] = None
@@ -30,6 +34,8 @@ class OuterWrapper(BaseModel):
     finance: Optional[dict] = None
     comment: Optional[str] = None
     error: Optional[list] = Field(default_factory=list)
+    # The content fetched for content_ref, never serialized
+    _fetched_content: Optional[str] = PrivateAttr(default=None)
 
 class Route(str, Enum):
     support = "support"
@@ -41,3 +47,15 @@ class SelectedRoute(BaseModel):
     route: Route
     reason: str
     escalation_required: bool
+
+# This list defines all the harm categories the guardian (and the combined
+# processor) will check for. It's easily extensible.
+HARMS_TO_CHECK = ["violence", "social_bias", "profanity"]
+
+def build_harm_classification_model(harms):
+    """Builds a response model with one boolean field per harm category."""
+    fields = {
+        harm: (bool, Field(description=f"True if the message contains {harm.replace('_', ' ')}, otherwise false."))
+        for harm in harms
+    }
+    return create_model("HarmClassification", **fields)
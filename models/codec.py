@@ -0,0 +1,21 @@
+from flask import Response
+
+from common.metrics import EVENT_PAYLOAD_BYTES
+from models import OuterWrapper
+
+# Reading and writing OuterWrapper payloads straight from and to JSON bytes.
+# Compared to `OuterWrapper(**request.get_json())` and
+# `jsonify(wrapper.model_dump(mode='json'))`, pydantic parses and serializes in
+# one pass, without building an intermediate dict of the whole payload.
+
+
+def decode_wrapper(data: bytes) -> OuterWrapper:
+    """Validates a JSON payload into an OuterWrapper. Invalid JSON raises a ValidationError too."""
+    return OuterWrapper.model_validate_json(data)
+
+
+def wrapper_response(wrapper: OuterWrapper, status: int = 200, headers: dict = None) -> Response:
+    """A JSON response whose body is the serialized OuterWrapper."""
+    body = wrapper.model_dump_json()
+    EVENT_PAYLOAD_BYTES.observe(len(body))
+    return Response(body, status=status, headers=headers, mimetype="application/json")
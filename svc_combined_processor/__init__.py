@@ -0,0 +1 @@
+# keep this file
@@ -0,0 +1,194 @@
+import os
+import logging
+import instructor
+from flask import Flask, request, jsonify
+from pydantic import Field, ValidationError, create_model
+
+from common.blobstore import blob_store_stats
+from common.idempotency import create_idempotency_store
+from common.llm import create_openai_client, resilience_stats
+from common.llm_cache import create_response_cache
+from common.llm_telemetry import call_stats
+from common.metrics import EVENTS_EMITTED, EVENTS_RECEIVED, register_metrics_route, stage
+from common.preprocess import prompt_content
+from common.prompts import get_prompt
+from models import HARMS_TO_CHECK, OuterWrapper, Route, SelectedRoute, StructuredObject, build_harm_classification_model
+from models.codec import decode_wrapper, wrapper_response
+# The customer lookup runs in this process, configured by the same DB_* and
+# CUSTOMER_* environment variables as svc_customer_lookup.
+from svc_customer_lookup.app import processor as customer_lookup
+
+# --- Configuration ---
+app = Flask(__name__)
+# The main application logger
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# LLM calls are logged by common/llm_telemetry.py; set LLM_DEBUG=true for httpx's request logging
+logging.getLogger("openai").setLevel(logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+APP_PORT = int(os.getenv("PORT", "8080"))
+LLM_API_BASE_URL = os.getenv('LLM_API_BASE_URL')
+LLM_API_KEY = os.getenv('LLM_API_KEY', "not-needed")
+LLM_MODEL_NAME = os.getenv('LLM_MODEL_NAME', "not-set")
+
+if not LLM_API_BASE_URL:
+    raise SystemExit("LLM_API_BASE_URL environment variable is not set.")
+
+# The events the router emits for each route; anything else needs a review.
+ROUTE_EVENT_TYPES = {
+    Route.support: "com.example.triage.routed.support",
+    Route.finance: "com.example.triage.routed.finance",
+    Route.website: "com.example.triage.routed.website",
+}
+
+
+def build_triage_model(harms):
+    """Builds the response model of the single call: harm flags, extracted structure and route."""
+    return create_model(
+        "TriageAnalysis",
+        harms=(build_harm_classification_model(harms), Field(description="The harm categories found in the message.")),
+        structured=(StructuredObject, ...),
+        route=(SelectedRoute, ...),
+    )
+
+# --- Message Processor Class ---
+class MessageProcessor:
+    def __init__(self, harms=None):
+        """Initializes the processor and the LLM client."""
+        self.harms = harms if harms is not None else HARMS_TO_CHECK
+        self.analysis_model = build_triage_model(self.harms)
+
+        # A pooled, instrumented and resilient LLM client (see common/llm.py)
+        self.client = instructor.patch(create_openai_client(LLM_API_KEY, LLM_API_BASE_URL))
+        logging.info(f"LLM client configured for model '{LLM_MODEL_NAME}' at '{LLM_API_BASE_URL}'")
+        self.cache = create_response_cache("combined-processor")
+        # Versioned prompt (see common/prompts.py); the response cache is keyed on its version.
+        self.prompt = get_prompt("combined.triage")
+
+    def process(self, message: OuterWrapper) -> str:
+        """
+        Runs the guardian, structure, customer lookup and router steps on the
+        wrapper, in the pipeline's order, with a single LLM call. Returns the
+        type of the event the multi-hop pipeline would end with.
+        """
+        try:
+            logging.info(f"[{message.message_id}] - Starting combined LLM analysis.")
+            analysis = self.analysis_model.model_validate(self._analyze(message))
+        except Exception as e:
+            error_msg = f"LLM call failed: {e}"
+            logging.error(f"[{message.message_id}] - {error_msg}")
+            message.error.append(error_msg)
+            # Where the structure processor sends messages it cannot structure
+            return "com.example.triage.guardian-failed"
+
+        message.structured = analysis.structured
+        original_error_count = len(message.error)
+        for harm in self.harms:
+            if getattr(analysis.harms, harm):
+                error_msg = f"guardian:detected:{harm}"
+                logging.warning(f"[{message.message_id}] - Harm detected! Appending error: {error_msg}")
+                message.error.append(error_msg)
+        if len(message.error) > original_error_count:
+            return "com.example.triage.review.required"
+
+        customer_lookup.process(message)
+        if len(message.error) > original_error_count:
+            return "com.example.triage.review.required"
+
+        logging.info(f"[{message.message_id}] - Successfully classified route: {analysis.route.route.value}")
+        message.route = analysis.route.route
+        return ROUTE_EVENT_TYPES.get(analysis.route.route, "com.example.triage.review.required")
+
+    def _analyze(self, message: OuterWrapper) -> dict:
+        content = prompt_content(message)
+
+        def analyze():
+            return self.client.chat.completions.create(
+                model=LLM_MODEL_NAME,
+                response_model=self.analysis_model,
+                messages=self.prompt.messages(content),
+                temperature=0.0,
+                extra_headers=self.prompt.headers(),
+            ).model_dump(mode='json')
+
+        # The harm list is part of the template: adding a harm must not reuse old answers.
+        template = self.prompt.cache_template(harms=",".join(self.harms))
+        return self.cache.get_or_compute(self.cache.key(LLM_MODEL_NAME, template, content), analyze)
+
+# --- Global Processor Instance ---
+processor = MessageProcessor()
+# Replies already sent, for answering redelivered events
+idempotency = create_idempotency_store("combined-processor")
+
+# --- Flask Routes ---
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return "OK", 200
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """LLM response cache, LLM call counters and suppressed duplicates of this worker."""
+    return jsonify({
+        "llm_cache": processor.cache.stats(),
+        "llm_calls": call_stats.stats(),
+        "llm_resilience": resilience_stats(),
+        "idempotency": idempotency.stats(),
+        "blob_store": blob_store_stats(),
+    }), 200
+
+register_metrics_route(app)
+
+@app.route('/', methods=['POST'])
+def handle_event():
+    """
+    Receives a new message, triages it in one pass, and replies with the
+    event the multi-hop pipeline ends with: routed.* or review.required.
+    """
+    if not request.is_json:
+        return jsonify({"error": "Request must be application/json"}), 415
+    EVENTS_RECEIVED.labels(event_type=request.headers.get('Ce-Type', 'unknown-type')).inc()
+
+    # A redelivered event gets the reply recorded the first time, without redoing the work
+    replay = idempotency.replay(request.headers.get('Ce-Subject'))
+    if replay is not None:
+        return replay
+
+    try:
+        with stage("parse"):
+            incoming_wrapper = decode_wrapper(request.get_data())
+        logging.info(f"[{incoming_wrapper.message_id}] - Received event from Broker.")
+
+    except (ValidationError, TypeError) as e:
+        logging.error(f"Failed to parse incoming event payload: {e}")
+        return jsonify({"error": "Bad request: payload does not match expected schema"}), 400
+
+    with stage("process"):
+        event_type = processor.process(incoming_wrapper)
+    if event_type == "com.example.triage.review.required":
+        logging.warning(f"[{incoming_wrapper.message_id}] - Triage incomplete. Routing for review.")
+
+    # Construct the CloudEvent headers for the HTTP response.
+    response_headers = {
+        "Ce-Specversion": "1.0",
+        "Ce-Type": event_type,
+        "Ce-Source": "/services/combined-processor",
+        "Ce-Id": idempotency.event_id(incoming_wrapper.message_id),
+        "Ce-Subject": incoming_wrapper.message_id,
+    }
+
+    # The body of the response becomes the data payload of the new CloudEvent.
+    with stage("serialize"):
+        response_body = wrapper_response(incoming_wrapper)
+    EVENTS_EMITTED.labels(event_type=event_type).inc()
+
+    idempotency.record(incoming_wrapper.message_id, response_body, response_headers)
+
+    # Reply directly with the new event payload and headers.
+    logging.info(f"[{incoming_wrapper.message_id}] - Replying with new event of type '{event_type}'.")
+    return response_body, 200, response_headers
+
+
+if __name__ == '__main__':
+    logging.info(f"Service starting and listening on port {APP_PORT}")
+    app.run(host='0.0.0.0', port=APP_PORT, debug=True)
@@ -1,12 +1,16 @@
 import os
-import uuid
 import logging
 import psycopg2
-from psycopg2 import sql
 from flask import Flask, request, jsonify
 from pydantic import ValidationError
 
+from common.cache import TTLCache
+from common.idempotency import create_idempotency_store
+from common.metrics import EVENTS_EMITTED, EVENTS_RECEIVED, register_metrics_route, stage
 from models import OuterWrapper
+from models.codec import decode_wrapper, wrapper_response
+from svc_customer_lookup.db import ConnectionPool, CustomerDirectory
+from svc_customer_lookup.snapshot import CustomerSnapshot
 
 # --- Configuration ---
 app = Flask(__name__)
@@ -26,20 +30,78 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 if not all([DB_NAME, DB_USER, DB_PASSWORD, DB_HOST]):
     raise SystemExit("One or more database environment variables (DB_NAME, DB_USER, DB_PASSWORD, DB_HOST) are not set.")
 
+# Where lookups are answered from:
+# - "database": a query per lookup, through the pool and cache below (default).
+# - "snapshot": an in-memory copy of the customers table, refreshed in the background.
+LOOKUP_MODE_DATABASE = "database"
+LOOKUP_MODE_SNAPSHOT = "snapshot"
+CUSTOMER_LOOKUP_MODE = os.getenv("CUSTOMER_LOOKUP_MODE", LOOKUP_MODE_DATABASE)
+
+if CUSTOMER_LOOKUP_MODE not in (LOOKUP_MODE_DATABASE, LOOKUP_MODE_SNAPSHOT):
+    raise SystemExit(f"CUSTOMER_LOOKUP_MODE must be '{LOOKUP_MODE_DATABASE}' or '{LOOKUP_MODE_SNAPSHOT}', got '{CUSTOMER_LOOKUP_MODE}'.")
+
+# Connection pool, per worker process
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "5"))
+
+# Cache of contact_email -> customer row. A size of 0 disables the cache.
+CUSTOMER_CACHE_SIZE = int(os.getenv("CUSTOMER_CACHE_SIZE", "1024"))
+CUSTOMER_CACHE_TTL_SECONDS = float(os.getenv("CUSTOMER_CACHE_TTL_SECONDS", "300"))
+CUSTOMER_CACHE_NEGATIVE_TTL_SECONDS = float(os.getenv("CUSTOMER_CACHE_NEGATIVE_TTL_SECONDS", "30"))
+
+# Micro-batching of concurrent lookups within a worker. A window of 0 disables it.
+# Only useful when the worker serves requests concurrently (threads or gevent).
+CUSTOMER_LOOKUP_BATCH_WINDOW_MS = float(os.getenv("CUSTOMER_LOOKUP_BATCH_WINDOW_MS", "0"))
+CUSTOMER_LOOKUP_MAX_BATCH_SIZE = int(os.getenv("CUSTOMER_LOOKUP_MAX_BATCH_SIZE", "50"))
+
+# Snapshot mode: rows fetched per round trip while loading, and the interval of
+# the fallback refresh of changed rows (changes are normally applied on NOTIFY).
+CUSTOMER_SNAPSHOT_FETCH_SIZE = int(os.getenv("CUSTOMER_SNAPSHOT_FETCH_SIZE", "10000"))
+CUSTOMER_SNAPSHOT_REFRESH_SECONDS = float(os.getenv("CUSTOMER_SNAPSHOT_REFRESH_SECONDS", "30"))
+
 # --- Message Processor Class ---
 class MessageProcessor:
     def __init__(self):
-        """Initializes the processor."""
+        """Initializes the processor and the customer lookup for the configured mode."""
         logging.info("Customer Lookup Processor initialized.")
         self.db_conn_string = f"dbname='{DB_NAME}' user='{DB_USER}' password='{DB_PASSWORD}' host='{DB_HOST}' port='{DB_PORT}'"
-        # Test connection on startup
+        if CUSTOMER_LOOKUP_MODE == LOOKUP_MODE_SNAPSHOT:
+            self.customers = self._init_snapshot()
+        else:
+            self.customers = self._init_directory()
+
+    def _init_snapshot(self):
+        snapshot = CustomerSnapshot(
+            self.db_conn_string,
+            refresh_seconds=CUSTOMER_SNAPSHOT_REFRESH_SECONDS,
+            fetch_size=CUSTOMER_SNAPSHOT_FETCH_SIZE,
+        )
+        # Loading the snapshot doubles as the startup connection test
+        try:
+            snapshot.load()
+        except psycopg2.OperationalError as e:
+            logging.error(f"FATAL: Could not load customer snapshot on startup: {e}")
+            raise SystemExit(f"Database connection failed: {e}")
+        snapshot.start_refresh()
+        return snapshot
+
+    def _init_directory(self):
+        # Opening the pool connects right away, which doubles as the startup connection test
         try:
-            with psycopg2.connect(self.db_conn_string) as conn:
-                logging.info(f"Successfully connected to database '{DB_NAME}' at {DB_HOST}:{DB_PORT}.")
+            self.pool = ConnectionPool(self.db_conn_string, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE)
+            logging.info(f"Successfully connected to database '{DB_NAME}' at {DB_HOST}:{DB_PORT} (pool size {DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE}).")
         except psycopg2.OperationalError as e:
             logging.error(f"FATAL: Could not connect to database on startup: {e}")
             raise SystemExit(f"Database connection failed: {e}")
 
+        cache = TTLCache(max_size=CUSTOMER_CACHE_SIZE, ttl_seconds=CUSTOMER_CACHE_TTL_SECONDS) if CUSTOMER_CACHE_SIZE > 0 else None
+        return CustomerDirectory(
+            self.pool, cache,
+            negative_ttl_seconds=CUSTOMER_CACHE_NEGATIVE_TTL_SECONDS,
+            batch_window_ms=CUSTOMER_LOOKUP_BATCH_WINDOW_MS,
+            max_batch_size=CUSTOMER_LOOKUP_MAX_BATCH_SIZE,
+        )
+
 
     def process(self, message: OuterWrapper) -> OuterWrapper:
         """
@@ -55,18 +117,8 @@ class MessageProcessor:
         email = message.structured.email_address
         logging.info(f"[{message.message_id}] - Starting customer lookup for email: {email}")
 
-        connection = None
-        cursor = None
         try:
-            connection = psycopg2.connect(self.db_conn_string)
-            cursor = connection.cursor()
-
-            query = sql.SQL("""
-                            SELECT customer_id, company_name, contact_name, country, phone
-                            FROM customers WHERE contact_email = %s
-                            """)
-            cursor.execute(query, (email,))
-            customer_record = cursor.fetchone()
+            customer_record = self.customers.find_by_email(email)
 
             if customer_record:
                 # Unpack the record
@@ -90,22 +142,26 @@ class MessageProcessor:
             error_msg = f"Database query failed: {e}"
             logging.error(f"[{message.message_id}] - {error_msg}")
             message.error.append(error_msg)
-        finally:
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
 
         return message
 
 # --- Global Processor Instance ---
 processor = MessageProcessor()
+# Replies already sent, for answering redelivered events
+idempotency = create_idempotency_store("customer-lookup")
 
 # --- Flask Routes ---
 @app.route('/healthz', methods=['GET'])
 def healthz():
     return "OK", 200
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Cache hit/miss counters, connection pool wait times and suppressed duplicates of this worker."""
+    return jsonify({**processor.customers.stats(), "idempotency": idempotency.stats()}), 200
+
+register_metrics_route(app)
+
 @app.route('/', methods=['POST'])
 def handle_event():
     """
@@ -114,10 +170,16 @@ def handle_event():
     """
     if not request.is_json:
         return jsonify({"error": "Request must be application/json"}), 415
+    EVENTS_RECEIVED.labels(event_type=request.headers.get('Ce-Type', 'unknown-type')).inc()
+
+    # A redelivered event gets the reply recorded the first time, without redoing the work
+    replay = idempotency.replay(request.headers.get('Ce-Subject'))
+    if replay is not None:
+        return replay
 
     try:
-        incoming_payload = request.get_json()
-        incoming_wrapper = OuterWrapper(**incoming_payload)
+        with stage("parse"):
+            incoming_wrapper = decode_wrapper(request.get_data())
         logging.info(f"[{incoming_wrapper.message_id}] - Received event from Broker.")
         original_error_count = len(incoming_wrapper.error)
 
@@ -125,7 +187,8 @@ def handle_event():
         logging.error(f"Failed to parse incoming event payload: {e}")
         return jsonify({"error": "Bad request: payload does not match expected schema"}), 400
 
-    processed_wrapper = processor.process(incoming_wrapper)
+    with stage("process"):
+        processed_wrapper = processor.process(incoming_wrapper)
 
     # Check if the lookup process added any new errors
     if len(processed_wrapper.error) > original_error_count:
@@ -140,16 +203,20 @@ def handle_event():
         "Ce-Specversion": "1.0",
         "Ce-Type": event_type,
         "Ce-Source": "/services/customer-lookup-processor",
-        "Ce-Id": str(uuid.uuid4()),
+        "Ce-Id": idempotency.event_id(processed_wrapper.message_id),
         "Ce-Subject": processed_wrapper.message_id,
     }
 
     # The body of the response becomes the data payload of the new CloudEvent.
-    response_payload = processed_wrapper.model_dump(mode='json')
+    with stage("serialize"):
+        response_body = wrapper_response(processed_wrapper)
+    EVENTS_EMITTED.labels(event_type=event_type).inc()
+
+    idempotency.record(processed_wrapper.message_id, response_body, response_headers)
 
     # Reply directly with the new event payload and headers.
     logging.info(f"[{processed_wrapper.message_id}] - Replying with new event of type '{event_type}'.")
-    return jsonify(response_payload), 200, response_headers
+    return response_body, 200, response_headers
 
 
 if __name__ == '__main__':
@@ -0,0 +1,74 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class LookupBatcher:
+    """
+    Collects concurrent lookups from the request threads of one worker and
+    resolves them together with a single query.
+
+    A background thread takes the first pending lookup, then keeps collecting
+    until the window has passed or the batch is full, and hands the distinct
+    keys to `lookup_many`. Each waiting request gets its own row back (or
+    None), or the query's exception if the batch failed. Lookups arriving
+    while a batch is being queried form the next batch.
+    """
+
+    def __init__(self, lookup_many, window_ms=5.0, max_batch_size=50):
+        self.lookup_many = lookup_many
+        self.window_seconds = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.pending = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.lookups = 0
+        self.largest_batch = 0
+        threading.Thread(target=self._run, name="lookup-batcher", daemon=True).start()
+
+    def lookup(self, key):
+        """Blocks until the batch containing key is resolved and returns its row."""
+        future = Future()
+        self.pending.put((key, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.window_seconds
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._resolve(batch)
+
+    def _resolve(self, batch):
+        keys = list(dict.fromkeys(key for key, _ in batch))
+        with self._stats_lock:
+            self.batches += 1
+            self.lookups += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+        try:
+            rows = self.lookup_many(keys)
+        except Exception as e:
+            logging.error(f"Batched lookup of {len(keys)} keys failed: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for key, future in batch:
+            future.set_result(rows.get(key))
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "lookups": self.lookups,
+                "avg_batch_size": self.lookups / self.batches if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+            }
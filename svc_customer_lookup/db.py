@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+from common.cache import MISSING, TTLCache
+from common.metrics import DB_CONNECTIONS_DISCARDED, DB_POOL_WAIT_SECONDS, DB_QUERY_SECONDS
+from svc_customer_lookup.batcher import LookupBatcher
+
+# The columns the lookup needs, in the order they are unpacked by the processor.
+CUSTOMER_COLUMNS = "customer_id, company_name, contact_name, country, phone"
+CUSTOMER_BY_EMAIL_QUERY = f"SELECT {CUSTOMER_COLUMNS} FROM customers WHERE contact_email = %s"
+# Resolves a whole batch of emails at once; psycopg2 adapts the list to an array.
+CUSTOMERS_BY_EMAILS_QUERY = f"SELECT contact_email, {CUSTOMER_COLUMNS} FROM customers WHERE contact_email = ANY(%s)"
+
+
+class ConnectionPool:
+    """
+    A pool of Postgres connections for one worker process.
+
+    psycopg2's ThreadedConnectionPool raises when it is exhausted, so callers
+    first wait on a semaphore sized like the pool. The time spent waiting is
+    recorded to show when the pool is too small for the load.
+    """
+
+    def __init__(self, conn_string, min_size=1, max_size=5):
+        self.pool = ThreadedConnectionPool(min_size, max_size, conn_string)
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.max_size = max_size
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.discarded = 0
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of the block. A connection
+        that failed with a connection-level error is closed instead of being
+        returned, so the next checkout opens a fresh one.
+        """
+        started = time.monotonic()
+        self.slots.acquire()
+        waited = time.monotonic() - started
+        DB_POOL_WAIT_SECONDS.observe(waited)
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+        conn = None
+        broken = False
+        try:
+            conn = self.pool.getconn()
+            if conn.closed:
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+            # Lookups are read-only, so there is no transaction to keep open.
+            conn.autocommit = True
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if conn is not None:
+                if broken:
+                    DB_CONNECTIONS_DISCARDED.inc()
+                    with self._stats_lock:
+                        self.discarded += 1
+                self.pool.putconn(conn, close=broken)
+            self.slots.release()
+
+    def close(self):
+        self.pool.closeall()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "wait_ms_avg": (self.wait_seconds_total / self.checkouts * 1000.0) if self.checkouts else 0.0,
+                "wait_ms_max": self.wait_seconds_max * 1000.0,
+                "discarded_connections": self.discarded,
+            }
+
+
+class CustomerDirectory:
+    """
+    Looks up customers by contact email, through a TTL/LRU cache in front of
+    the connection pool. Emails without a customer are cached too (for a
+    shorter time), so repeated unknown senders do not hit the database.
+
+    With a batch window, cache misses from concurrent requests are collected
+    and resolved with one `contact_email = ANY(...)` query.
+    """
+
+    def __init__(self, pool: ConnectionPool, cache: TTLCache = None, negative_ttl_seconds=30.0,
+                 batch_window_ms=0.0, max_batch_size=50):
+        self.pool = pool
+        self.cache = cache
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.batcher = None
+        if batch_window_ms > 0 and max_batch_size > 1:
+            self.batcher = LookupBatcher(self._query_many, window_ms=batch_window_ms, max_batch_size=max_batch_size)
+
+    def find_by_email(self, email):
+        """Returns the customer row as a tuple of CUSTOMER_COLUMNS, or None if not found."""
+        if self.cache is not None:
+            cached = self.cache.get(email)
+            if cached is not MISSING:
+                return cached
+
+        record = self.batcher.lookup(email) if self.batcher else self._query(email)
+
+        if self.cache is not None:
+            ttl = self.negative_ttl_seconds if record is None else None
+            self.cache.set(email, record, ttl_seconds=ttl)
+        return record
+
+    def _query(self, email):
+        with DB_QUERY_SECONDS.labels(query="by_email").time():
+            return self._execute(CUSTOMER_BY_EMAIL_QUERY, (email,), lambda cursor: cursor.fetchone())
+
+    def _query_many(self, emails):
+        """Returns a dict of email -> customer row for the emails that exist."""
+        with DB_QUERY_SECONDS.labels(query="by_emails").time():
+            rows = self._execute(CUSTOMERS_BY_EMAILS_QUERY, (list(emails),), lambda cursor: cursor.fetchall())
+        return {row[0]: row[1:] for row in rows}
+
+    def _execute(self, query, params, fetch):
+        # A pooled connection may have been dropped by the server while idle.
+        # That shows up as a connection-level error on first use, so retry
+        # once on a fresh connection before giving up.
+        for attempt in (1, 2):
+            try:
+                with self.pool.connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(query, params)
+                        return fetch(cursor)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if attempt == 2:
+                    raise
+                logging.warning(f"Database connection failed, reconnecting: {e}")
+
+    def stats(self):
+        return {
+            "pool": self.pool.stats(),
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "batching": self.batcher.stats() if self.batcher else None,
+        }
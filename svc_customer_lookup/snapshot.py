@@ -0,0 +1,198 @@
+import logging
+import select
+import sys
+import threading
+import time
+
+import psycopg2
+
+from svc_customer_lookup.db import CUSTOMER_COLUMNS
+
+# Channel used by the notify trigger in db_customer/schema.sql
+NOTIFY_CHANNEL = "customers_changed"
+
+SNAPSHOT_QUERY = f"SELECT contact_email, {CUSTOMER_COLUMNS}, updated_at FROM customers"
+# updated_at is the start time of the writing transaction, so a row committed
+# after a later-started one can land below the watermark; the overlap re-reads
+# those (re-applying a row is harmless).
+DELTA_QUERY = (f"SELECT contact_email, {CUSTOMER_COLUMNS}, updated_at FROM customers "
+               "WHERE updated_at > %s - interval '1 minute' ORDER BY updated_at")
+BY_EMAIL_QUERY = f"SELECT contact_email, {CUSTOMER_COLUMNS}, updated_at FROM customers WHERE contact_email = %s"
+
+
+def normalize_email(email):
+    return email.strip().lower()
+
+
+class CustomerSnapshot:
+    """
+    An in-process copy of the customers table, keyed by normalized email, so
+    lookups never go to the database.
+
+    The table is streamed in at startup through a server-side cursor, so only
+    `fetch_size` rows are in flight at a time. A background thread keeps the
+    copy current: it applies changes announced on the NOTIFY_CHANNEL as they
+    happen, and every `refresh_seconds` it also re-reads rows whose
+    `updated_at` is newer than, or up to a minute older than, the newest one
+    seen by a full or delta read, in case a notification was missed.
+    """
+
+    def __init__(self, conn_string, refresh_seconds=30.0, fetch_size=10000):
+        self.conn_string = conn_string
+        self.refresh_seconds = refresh_seconds
+        self.fetch_size = fetch_size
+        self.index = {}
+        self.watermark = None
+        self._write_lock = threading.Lock()
+        self.loaded_at = None
+        self.load_seconds = 0.0
+        self.memory = None
+        self.notifications = 0
+        self.delta_rows = 0
+
+    def find_by_email(self, email):
+        """Returns the customer row as a tuple of CUSTOMER_COLUMNS, or None if not found."""
+        return self.index.get(normalize_email(email))
+
+    # --- Loading ---
+
+    def load(self):
+        """Streams the whole table into a fresh index and swaps it in."""
+        with psycopg2.connect(self.conn_string) as conn:
+            # A named cursor is a server-side cursor: rows arrive in chunks of itersize.
+            with conn.cursor(name="customer_snapshot") as cursor:
+                cursor.itersize = self.fetch_size
+                cursor.execute(SNAPSHOT_QUERY)
+                self.load_rows(cursor)
+        conn.close()
+
+    def load_rows(self, rows):
+        """
+        Builds a new index from (contact_email, *CUSTOMER_COLUMNS, updated_at)
+        rows and replaces the current one.
+        """
+        started = time.monotonic()
+        index = {}
+        watermark = None
+        shared = {}
+        for row in rows:
+            email, updated_at = row[0], row[-1]
+            if not email:
+                continue
+            customer_id, company_name, contact_name, country, phone = row[1:-1]
+            # Company names and countries repeat a lot; keep one string object per value.
+            index[normalize_email(email)] = (
+                customer_id,
+                shared.setdefault(company_name, company_name),
+                contact_name,
+                shared.setdefault(country, country),
+                phone,
+            )
+            if updated_at is not None and (watermark is None or updated_at > watermark):
+                watermark = updated_at
+        with self._write_lock:
+            self.index = index
+            self.watermark = watermark
+        self.load_seconds = time.monotonic() - started
+        self.loaded_at = time.time()
+        self.memory = self.memory_usage()
+        logging.info(f"Customer snapshot loaded {len(index)} customers in {self.load_seconds:.2f}s "
+                     f"({self.memory['bytes'] / 1024 / 1024:.1f} MiB, {self.memory['bytes_per_row']:.0f} bytes/row).")
+
+    def _apply(self, row):
+        with self._write_lock:
+            self.index[normalize_email(row[0])] = tuple(row[1:-1])
+
+    def _remove(self, email):
+        with self._write_lock:
+            self.index.pop(normalize_email(email), None)
+
+    # --- Incremental refresh ---
+
+    def start_refresh(self):
+        threading.Thread(target=self._refresh_loop, name="customer-snapshot-refresh", daemon=True).start()
+
+    def _refresh_loop(self):
+        backoff = 1.0
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.conn_string)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                logging.info(f"Customer snapshot listening for changes on '{NOTIFY_CHANNEL}'.")
+                # Catch up on anything that changed before LISTEN took effect.
+                self._refresh_delta(conn)
+                backoff = 1.0
+                while True:
+                    ready, _, _ = select.select([conn], [], [], self.refresh_seconds)
+                    if ready:
+                        conn.poll()
+                        while conn.notifies:
+                            self._refresh_email(conn, conn.notifies.pop(0).payload)
+                    else:
+                        self._refresh_delta(conn)
+            except Exception as e:
+                logging.error(f"Customer snapshot refresh failed, retrying in {backoff:.0f}s: {e}")
+                if conn is not None:
+                    conn.close()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+
+    def _refresh_email(self, conn, email):
+        """Re-reads one customer named by a notification; a missing row means it was deleted."""
+        self.notifications += 1
+        with conn.cursor() as cursor:
+            cursor.execute(BY_EMAIL_QUERY, (email,))
+            row = cursor.fetchone()
+        if row:
+            self._apply(row)
+        else:
+            self._remove(email)
+
+    def _refresh_delta(self, conn):
+        if self.watermark is None:
+            return
+        with conn.cursor() as cursor:
+            cursor.execute(DELTA_QUERY, (self.watermark,))
+            rows = cursor.fetchall()
+        for row in rows:
+            self._apply(row)
+        # Only delta reads move the watermark: a notified row can be newer than
+        # rows of transactions that have not committed yet.
+        newest = max((row[-1] for row in rows if row[-1] is not None), default=None)
+        if newest is not None and newest > self.watermark:
+            self.watermark = newest
+        if rows:
+            self.delta_rows += len(rows)
+            logging.info(f"Customer snapshot applied {len(rows)} changed customers.")
+
+    # --- Accounting ---
+
+    def memory_usage(self):
+        """
+        Approximate memory held by the index: the dict itself plus every key,
+        row tuple and value, counting shared objects once.
+        """
+        index = self.index
+        seen = set()
+        total = sys.getsizeof(index)
+        for key, values in index.items():
+            for obj in (key, values, *values):
+                if id(obj) not in seen:
+                    seen.add(id(obj))
+                    total += sys.getsizeof(obj)
+        rows = len(index)
+        return {"rows": rows, "bytes": total, "bytes_per_row": total / rows if rows else 0.0}
+
+    def stats(self):
+        return {
+            "rows": len(self.index),
+            "loaded_at": self.loaded_at,
+            "load_seconds": self.load_seconds,
+            "memory_at_load": self.memory,
+            "watermark": self.watermark.isoformat() if self.watermark else None,
+            "notifications": self.notifications,
+            "delta_rows": self.delta_rows,
+        }
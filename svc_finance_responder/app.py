@@ -1,50 +1,22 @@
 import os
-import json
 import logging
-import queue
-import collections
 from flask import Flask, request, jsonify, render_template, Response
 
+from common.blobstore import blob_store_stats, fetch_content
+from common.broadcast import create_broadcaster
+from common.idempotency import create_idempotency_store
+from common.metrics import EVENTS_RECEIVED, register_metrics_route, stage
+
 # --- Configuration ---
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 APP_PORT = int(os.getenv("PORT", "8080"))
 
-# --- In-Memory Message Announcer for SSE ---
-# This class handles broadcasting messages to all connected UI clients.
-class MessageAnnouncer:
-    def __init__(self):
-        self.listeners = []
-        # Store a history of the last 50 messages for clients that connect later
-        self.history = collections.deque(maxlen=50)
-
-    def listen(self):
-        """Yields historical and then new messages for an SSE stream."""
-        # First, send the history
-        for msg in list(self.history):
-            yield msg
-
-        # Then, listen for new messages
-        q = queue.Queue(maxsize=10)
-        self.listeners.append(q)
-        try:
-            while True:
-                msg = q.get()
-                yield msg
-        finally:
-            self.listeners.remove(q)
-
-    def announce(self, msg):
-        """Adds a message to history and sends to all listeners."""
-        self.history.append(msg)
-        # Iterate backwards to safely remove listeners if queue is full
-        for i in reversed(range(len(self.listeners))):
-            try:
-                self.listeners[i].put_nowait(msg)
-            except queue.Full:
-                del self.listeners[i]
-
-announcer = MessageAnnouncer()
+# --- SSE Broadcasting ---
+# Configured with the SSE_* environment variables, see common/broadcast.py
+announcer = create_broadcaster("finance_message")
+# Messages already relayed, so a redelivered one does not show up twice in the inbox
+idempotency = create_idempotency_store("finance-responder")
 
 # --- Flask Routes ---
 @app.route('/')
@@ -60,7 +32,14 @@ def healthz():
 @app.route('/stream')
 def stream():
     """The SSE stream endpoint for the UI."""
-    return Response(announcer.listen(), mimetype='text/event-stream')
+    return Response(announcer.stream(request.headers.get('Last-Event-ID')), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({"sse": announcer.stats(), "idempotency": idempotency.stats(), "blob_store": blob_store_stats()}), 200
+
+register_metrics_route(app)
 
 @app.route('/', methods=['POST'])
 def handle_event():
@@ -73,21 +52,33 @@ def handle_event():
     # Extract the relevant parts of the event
     event_type = request.headers.get('Ce-Type', 'unknown-type')
     message_id = request.headers.get('Ce-Subject', 'unknown-subject')
-    payload = request.get_json()
+    EVENTS_RECEIVED.labels(event_type=event_type).inc()
+    replay = idempotency.replay(request.headers.get('Ce-Subject'))
+    if replay is not None:
+        return replay
+
+    with stage("parse"):
+        payload = request.get_json()
 
     # The data for the frontend is the event's payload itself
     sse_data = payload
-
-    # Format the message for Server-Sent Events (SSE)
-    # The 'event:' line allows the frontend to have a specific listener
-    sse_msg = f"event: finance_message\ndata: {json.dumps(sse_data)}\n\n"
-
-    # Announce the message to all connected clients
-    announcer.announce(sse_msg)
+    # The inbox shows the full email, so a content passed by reference is fetched back.
+    if payload.get("content_ref") and not payload.get("content"):
+        try:
+            sse_data["content"] = fetch_content(payload["content_ref"])
+        except Exception as e:
+            logging.warning(f"[{message_id}] - Could not fetch the content {payload['content_ref']}: {e}")
+
+    # Announce the message to all connected clients. It is serialized once,
+    # as a 'finance_message' event the frontend has a specific listener for.
+    with stage("serialize"):
+        announcer.publish(sse_data)
     logging.info(f"Relayed finance message '{message_id}' (type: {event_type}) to UI.")
 
     # Acknowledge receipt of the event
-    return jsonify({"status": "event relayed to UI"}), 200
+    response_body = jsonify({"status": "event relayed to UI"})
+    idempotency.record(message_id, response_body, {})
+    return response_body, 200
 
 if __name__ == '__main__':
     logging.info(f"Finance Responder service starting on port {APP_PORT}")
@@ -1,12 +1,22 @@
 import os
-import uuid
 import logging
-import httpx # Import httpx
+import instructor
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from flask import Flask, request, jsonify
-from openai import OpenAI
 from pydantic import ValidationError
 
-from models import OuterWrapper
+from common.cache import MISSING
+from common.blobstore import blob_store_stats
+from common.idempotency import create_idempotency_store
+from common.llm import create_openai_client, resilience_stats
+from common.llm_batcher import create_llm_batcher
+from common.llm_cache import create_response_cache
+from common.llm_telemetry import call_stats
+from common.metrics import EVENTS_EMITTED, EVENTS_RECEIVED, register_metrics_route, stage
+from common.preprocess import content_chunks
+from common.prompts import get_prompt
+from models import HARMS_TO_CHECK, OuterWrapper, build_harm_classification_model
+from models.codec import decode_wrapper, wrapper_response
 
 # --- Configuration ---
 app = Flask(__name__)
@@ -14,9 +24,9 @@ app = Flask(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Set the log level for the libraries
-# We'll see our own custom logging plus the request logging from httpx
+# LLM calls are logged by common/llm_telemetry.py; set LLM_DEBUG=true for httpx's request logging
 logging.getLogger("openai").setLevel(logging.INFO) # Keep this at INFO
-logging.getLogger("httpx").setLevel(logging.DEBUG) # This will log the request
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 APP_PORT = int(os.getenv("PORT", "8080"))
 LLM_API_BASE_URL = os.getenv('LLM_API_BASE_URL')
@@ -26,35 +36,47 @@ LLM_MODEL_NAME = os.getenv('LLM_MODEL_NAME', "not-set")
 if not LLM_API_BASE_URL:
     raise SystemExit("LLM_API_BASE_URL environment variable is not set.")
 
-# This list defines all the harm categories the guardian will check for.
-# It's easily extensible.
-HARMS_TO_CHECK = ["violence", "social_bias", "profanity"]
+# How many harm checks may run against the LLM at the same time.
+# 1 keeps the original behaviour of checking one harm after another.
+GUARDIAN_CONCURRENCY = int(os.getenv('GUARDIAN_CONCURRENCY', "1"))
+# Stop checking the remaining harms as soon as one harm is confirmed.
+GUARDIAN_FAIL_FAST = os.getenv('GUARDIAN_FAIL_FAST', "false").lower() == "true"
 
-# This function will be called for every response received by the httpx client.
-def log_response(response):
-    # This ensures the response is read before we try to log it.
-    response.read()
-    # The 'response.text' contains the full JSON body from the LLM.
-    logging.info(f"LLM Response Body: {response.text}")
+# How the harms are checked:
+# - "per-harm": one LLM call per harm, the model answers Yes/No (default).
+# - "multi-label": a single structured call that classifies all harms at once.
+GUARDIAN_MODE_PER_HARM = "per-harm"
+GUARDIAN_MODE_MULTI_LABEL = "multi-label"
+GUARDIAN_MODE = os.getenv('GUARDIAN_MODE', GUARDIAN_MODE_PER_HARM)
 
+if GUARDIAN_MODE not in (GUARDIAN_MODE_PER_HARM, GUARDIAN_MODE_MULTI_LABEL):
+    raise SystemExit(f"GUARDIAN_MODE must be '{GUARDIAN_MODE_PER_HARM}' or '{GUARDIAN_MODE_MULTI_LABEL}', got '{GUARDIAN_MODE}'.")
 
 # --- Message Processor Class ---
 class MessageProcessor:
-    def __init__(self):
+    def __init__(self, harms=None, concurrency=GUARDIAN_CONCURRENCY, fail_fast=GUARDIAN_FAIL_FAST, mode=GUARDIAN_MODE):
         """Initializes the processor and the LLM client."""
+        self.harms = harms if harms is not None else HARMS_TO_CHECK
+        self.mode = mode
+        self.classification_model = build_harm_classification_model(self.harms)
+        self.fail_fast = fail_fast
+        # A bounded pool shared by all requests handled by this worker, so the
+        # number of in-flight LLM calls never exceeds the configured concurrency.
+        self.executor = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
 
-        # Create a custom httpx client with our logging hook
-        http_client = httpx.Client(
-            event_hooks={"response": [log_response]}
-        )
-
-        # The OpenAI client uses our custom httpx client. No instructor needed here.
-        self.client = OpenAI(
-            api_key=LLM_API_KEY,
-            base_url=LLM_API_BASE_URL,
-            http_client=http_client
-        )
+        # A pooled, instrumented and resilient LLM client (see common/llm.py)
+        client = create_openai_client(LLM_API_KEY, LLM_API_BASE_URL)
+        # Only the multi-label mode needs instructor for its structured response.
+        self.client = instructor.patch(client) if mode == GUARDIAN_MODE_MULTI_LABEL else client
         logging.info(f"LLM client configured for model '{LLM_MODEL_NAME}' at '{LLM_API_BASE_URL}'")
+        logging.info(f"Guardian checks {len(self.harms)} harms in '{mode}' mode with concurrency {concurrency} (fail fast: {fail_fast})")
+        self.cache = create_response_cache("guardian-processor")
+        # Versioned prompts (see common/prompts.py); the response cache is keyed on their version.
+        # Granite Guardian keeps the harm-name-as-system-prompt format it was trained on.
+        self.harm_prompt = get_prompt("guardian.harm", model=LLM_MODEL_NAME)
+        self.multi_label_prompt = get_prompt("guardian.multi-label")
+        # Batches the checks of this message with those of concurrent events (see common/llm_batcher.py)
+        self.batcher = create_llm_batcher("guardian-processor", client, LLM_MODEL_NAME)
 
     def process(self, message: OuterWrapper) -> OuterWrapper:
         """
@@ -63,25 +85,15 @@ class MessageProcessor:
         """
         try:
             logging.info(f"[{message.message_id}] - Starting LLM guardian processing.")
+            # The whole content, nothing stripped or truncated: a long message is checked chunk by chunk.
+            chunks = content_chunks(message)
 
-            for harm in HARMS_TO_CHECK:
-                logging.debug(f"[{message.message_id}] - Checking for harm: {harm}")
-                completion = self.client.chat.completions.create(
-                    model=LLM_MODEL_NAME,
-                    messages=[
-                        {"role": "system", "content": harm},
-                        {"role": "user", "content": message.content},
-                    ],
-                    max_tokens=5, # We only need a single word response
-                    temperature=0.0
-                )
-                response_text = completion.choices[0].message.content.strip().lower()
-                logging.info(f"[{message.message_id}] - Guardian check for '{harm}' returned: '{response_text}'")
-
-                if 'yes' in response_text:
-                    error_msg = f"guardian:detected:{harm}"
-                    logging.warning(f"[{message.message_id}] - Harm detected! Appending error: {error_msg}")
-                    message.error.append(error_msg)
+            if self.mode == GUARDIAN_MODE_MULTI_LABEL:
+                self._check_harms_multi_label(message, chunks)
+            elif self.executor or self.batcher:
+                self._check_harms_concurrently(message, chunks)
+            else:
+                self._check_harms_sequentially(message, chunks)
 
         except Exception as e:
             error_msg = f"Guardian LLM call failed: {e}"
@@ -90,14 +102,148 @@ class MessageProcessor:
 
         return message
 
+    def _check_harms_sequentially(self, message: OuterWrapper, chunks: list[str]):
+        """Checks one harm after another, in the order they are listed, and each in one chunk after another."""
+        for harm in self.harms:
+            if any(self._check_harm(message, harm, chunk) for chunk in chunks):
+                self._record_harm(message, harm)
+                if self.fail_fast:
+                    break
+
+    def _check_harms_concurrently(self, message: OuterWrapper, chunks: list[str]):
+        """
+        Submits all harm checks, of every chunk, to the thread pool, or to the
+        batcher, at once. Detected harms are recorded in the order they are
+        listed, regardless of completion order.
+        """
+        if self.batcher:
+            futures = {self._submit_batched_check(message, harm, chunk): harm
+                       for harm in self.harms for chunk in chunks}
+        else:
+            futures = {self.executor.submit(self._check_harm, message, harm, chunk): harm
+                       for harm in self.harms for chunk in chunks}
+        detected = set()
+        try:
+            for future in as_completed(futures):
+                if future.result():
+                    detected.add(futures[future])
+                    if self.fail_fast:
+                        break
+        finally:
+            # Checks that have not started yet are dropped. Ones already in
+            # flight run to completion, but their result is ignored.
+            for future in futures:
+                future.cancel()
+            for harm in self.harms:
+                if harm in detected:
+                    self._record_harm(message, harm)
+
+    def _check_harms_multi_label(self, message: OuterWrapper, chunks: list[str]):
+        """Classifies the content for all harms with a single structured LLM call per chunk."""
+        # The harm list is part of the template: adding a harm must not reuse old answers.
+        template = self.multi_label_prompt.cache_template(harms=",".join(self.harms))
+        detected = set()
+        for chunk in chunks:
+            def call(chunk=chunk):
+                return self.client.chat.completions.create(
+                    model=LLM_MODEL_NAME,
+                    response_model=self.classification_model,
+                    messages=self.multi_label_prompt.messages(chunk),
+                    temperature=0.0,
+                    extra_headers=self.multi_label_prompt.headers(),
+                ).model_dump()
+
+            def classify(call=call):
+                return self.batcher.submit_call(call).result() if self.batcher else call()
+
+            classification = self.cache.get_or_compute(self.cache.key(LLM_MODEL_NAME, template, chunk), classify)
+            logging.info(f"[{message.message_id}] - Guardian multi-label check returned: {classification}")
+            detected.update(harm for harm in self.harms if classification.get(harm))
+        for harm in self.harms:
+            if harm in detected:
+                self._record_harm(message, harm)
+
+    def _check_harm(self, message: OuterWrapper, harm: str, chunk: str) -> bool:
+        """Asks the LLM whether a chunk of the message content contains the given harm."""
+        logging.debug(f"[{message.message_id}] - Checking for harm: {harm}")
+
+        def ask():
+            completion = self.client.chat.completions.create(
+                model=LLM_MODEL_NAME,
+                messages=self._harm_messages(chunk, harm),
+                max_tokens=5, # We only need a single word response
+                temperature=0.0,
+                extra_headers=self.harm_prompt.headers(),
+            )
+            return completion.choices[0].message.content.strip().lower()
+
+        cache_key = self.cache.key(LLM_MODEL_NAME, self.harm_prompt.cache_template(harm=harm), chunk)
+        response_text = self.cache.get_or_compute(cache_key, ask)
+        return self._harm_answer(message, harm, response_text)
+
+    def _submit_batched_check(self, message: OuterWrapper, harm: str, chunk: str) -> Future:
+        """Like _check_harm, through the batcher. The Future resolves to whether the harm was found."""
+        key = self.cache.key(LLM_MODEL_NAME, self.harm_prompt.cache_template(harm=harm), chunk)
+        checked = Future()
+        cached = self.cache.lookup(key)
+        if cached is not MISSING:
+            checked.set_result(self._harm_answer(message, harm, cached))
+            return checked
+
+        def answered(reply):
+            # Dropped if fail fast has cancelled this check meanwhile
+            if not checked.set_running_or_notify_cancel():
+                return
+            try:
+                response_text = reply.result().strip().lower()
+            except Exception as e:
+                checked.set_exception(e)
+                return
+            self.cache.store(key, response_text)
+            checked.set_result(self._harm_answer(message, harm, response_text))
+
+        self.batcher.submit(self._harm_messages(chunk, harm), max_tokens=5,
+                            extra_headers=self.harm_prompt.headers()).add_done_callback(answered)
+        return checked
+
+    def _harm_messages(self, chunk: str, harm: str):
+        # The content comes before the harm, so the checks of a chunk share their prefix (version 2).
+        return self.harm_prompt.messages(chunk, harm=harm, harm_text=harm.replace("_", " "))
+
+    @staticmethod
+    def _harm_answer(message: OuterWrapper, harm: str, response_text: str) -> bool:
+        logging.info(f"[{message.message_id}] - Guardian check for '{harm}' returned: '{response_text}'")
+        return 'yes' in response_text
+
+    def _record_harm(self, message: OuterWrapper, harm: str):
+        error_msg = f"guardian:detected:{harm}"
+        logging.warning(f"[{message.message_id}] - Harm detected! Appending error: {error_msg}")
+        message.error.append(error_msg)
+
 # --- Global Processor Instance ---
 processor = MessageProcessor()
+# Replies already sent, for answering redelivered events
+idempotency = create_idempotency_store("guardian-processor")
 
 # --- Flask Routes ---
 @app.route('/healthz', methods=['GET'])
 def healthz():
     return "OK", 200
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """LLM response cache, LLM call counters, batches and suppressed duplicates of this worker."""
+    return jsonify({
+        "llm_cache": processor.cache.stats(),
+        "llm_calls": call_stats.stats(),
+        "llm_resilience": resilience_stats(),
+        "llm_batcher": processor.batcher.stats() if processor.batcher else None,
+        "idempotency": idempotency.stats(),
+        "blob_store": blob_store_stats(),
+    }), 200
+
+register_metrics_route(app)
+
 @app.route('/', methods=['POST'])
 def handle_event():
     """
@@ -106,10 +252,16 @@ def handle_event():
     """
     if not request.is_json:
         return jsonify({"error": "Request must be application/json"}), 415
+    EVENTS_RECEIVED.labels(event_type=request.headers.get('Ce-Type', 'unknown-type')).inc()
+
+    # A redelivered event gets the reply recorded the first time, without redoing the work
+    replay = idempotency.replay(request.headers.get('Ce-Subject'))
+    if replay is not None:
+        return replay
 
     try:
-        incoming_payload = request.get_json()
-        incoming_wrapper = OuterWrapper(**incoming_payload)
+        with stage("parse"):
+            incoming_wrapper = decode_wrapper(request.get_data())
         logging.info(f"[{incoming_wrapper.message_id}] - Received event from Broker.")
         # Store the number of errors *before* processing
         original_error_count = len(incoming_wrapper.error)
@@ -118,7 +270,8 @@ def handle_event():
         logging.error(f"Failed to parse incoming event payload: {e}")
         return jsonify({"error": "Bad request: payload does not match expected schema"}), 400
 
-    processed_wrapper = processor.process(incoming_wrapper)
+    with stage("process"):
+        processed_wrapper = processor.process(incoming_wrapper)
 
     # Check if the guardian added any new errors
     if len(processed_wrapper.error) > original_error_count:
@@ -133,16 +286,20 @@ def handle_event():
         "Ce-Specversion": "1.0",
         "Ce-Type": event_type,
         "Ce-Source": "/services/guardian-processor", # Updated source
-        "Ce-Id": str(uuid.uuid4()),
+        "Ce-Id": idempotency.event_id(processed_wrapper.message_id),
         "Ce-Subject": processed_wrapper.message_id,
     }
 
     # The body of the response becomes the data payload of the new CloudEvent.
-    response_payload = processed_wrapper.model_dump(mode='json')
+    with stage("serialize"):
+        response_body = wrapper_response(processed_wrapper)
+    EVENTS_EMITTED.labels(event_type=event_type).inc()
+
+    idempotency.record(processed_wrapper.message_id, response_body, response_headers)
 
     # Reply directly with the new event payload and headers.
     logging.info(f"[{processed_wrapper.message_id}] - Replying with new event of type '{event_type}'.")
-    return jsonify(response_payload), 200, response_headers
+    return response_body, 200, response_headers
 
 
 if __name__ == '__main__':
@@ -1,10 +1,17 @@
 import os
+import json
 import uuid
+import atexit
 import logging
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
 
+from common.blobstore import BLOB_STORE_MIN_BYTES, blob_store
+from common.metrics import BLOB_STORE_OPERATIONS, EVENT_PAYLOAD_BYTES, EVENTS_EMITTED, register_metrics_route, stage
 from models import OuterWrapper
+from svc_intake.forwarder import EventForwarder
 
 # --- Configuration ---
 app = Flask(__name__)
@@ -17,9 +24,44 @@ if not K_SINK:
     logging.error("K_SINK environment variable not set. Cannot send events.")
     raise SystemExit("K_SINK environment variable not set.")
 
+# Keep-alive connections to the sink, shared by all requests of a worker
+INTAKE_SINK_POOL_SIZE = int(os.getenv("INTAKE_SINK_POOL_SIZE", "10"))
+# Events of one batch sent to the sink at the same time
+INTAKE_BATCH_CONCURRENCY = int(os.getenv("INTAKE_BATCH_CONCURRENCY", "8"))
+INTAKE_MAX_BATCH_SIZE = int(os.getenv("INTAKE_MAX_BATCH_SIZE", "1000"))
+# Send a whole batch as one CloudEvents batched-mode request. Only for sinks
+# that accept `application/cloudevents-batch+json`; the Knative Broker does not.
+INTAKE_SINK_BATCH_MODE = os.getenv("INTAKE_SINK_BATCH_MODE", "false").lower() == "true"
+
+# How events reach K_SINK:
+# - "sync": each request waits until the Broker has accepted its event (default).
+# - "async": events are queued and sent by background threads, with retries. Requests
+#   get 202 right away, or 429 while the queue is full.
+FORWARD_MODE_SYNC = "sync"
+FORWARD_MODE_ASYNC = "async"
+INTAKE_FORWARD_MODE = os.getenv("INTAKE_FORWARD_MODE", FORWARD_MODE_SYNC)
+INTAKE_QUEUE_SIZE = int(os.getenv("INTAKE_QUEUE_SIZE", "1000"))
+INTAKE_SENDERS = int(os.getenv("INTAKE_SENDERS", "4"))
+INTAKE_RETRY_MAX_BACKOFF_SECONDS = float(os.getenv("INTAKE_RETRY_MAX_BACKOFF_SECONDS", "30"))
+# Queued events are also appended to this file, and re-sent after a restart. Empty disables it.
+INTAKE_SPILL_PATH = os.getenv("INTAKE_SPILL_PATH", "")
+# How long a stopping worker keeps sending queued events
+INTAKE_DRAIN_SECONDS = float(os.getenv("INTAKE_DRAIN_SECONDS", "10"))
+
+if INTAKE_FORWARD_MODE not in (FORWARD_MODE_SYNC, FORWARD_MODE_ASYNC):
+    raise SystemExit(f"INTAKE_FORWARD_MODE must be '{FORWARD_MODE_SYNC}' or '{FORWARD_MODE_ASYNC}', got '{INTAKE_FORWARD_MODE}'.")
+
 logging.info(f"Events will be sent to: {K_SINK}")
 logging.info(f"Service is listening on port: {APP_PORT}")
 
+# A session reuses its connections, so consecutive events do not each pay for a new TCP connection.
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=INTAKE_SINK_POOL_SIZE))
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=INTAKE_SINK_POOL_SIZE))
+batch_executor = ThreadPoolExecutor(max_workers=INTAKE_BATCH_CONCURRENCY, thread_name_prefix="intake-batch")
+# Large contents are stored once and passed by reference (claim check), see common/blobstore.py
+content_store = blob_store()
+
 # --- CloudEvent Creation ---
 def create_cloudevent(content):
     """
@@ -36,9 +78,18 @@ def create_cloudevent(content):
         metadata={},
         error=[]
     )
+    if content_store is not None and len(content.encode("utf-8")) >= BLOB_STORE_MIN_BYTES:
+        try:
+            wrapper.content_ref = content_store.put(content)
+            wrapper.content = ""
+        except Exception as e:
+            # The message still goes through, with its content in the event.
+            BLOB_STORE_OPERATIONS.labels(op="put", result="error").inc()
+            logging.warning(f"[{message_id}] - Could not store the content in the blob store, sending it inline: {e}")
     # Use model_dump_json() to get a valid JSON string.
     # Pydantic will correctly convert the datetime object to an ISO 8601 string.
     json_payload_string = wrapper.model_dump_json()
+    EVENT_PAYLOAD_BYTES.observe(len(json_payload_string))
 
     headers = {
         "Ce-Specversion": "1.0",
@@ -50,12 +101,84 @@ def create_cloudevent(content):
     }
     return headers, json_payload_string
 
+def validate_content(data):
+    """Returns the error message for an invalid request item, or None."""
+    if not isinstance(data, dict) or "content" not in data:
+        return "JSON payload must include a 'content' key"
+    content = data.get("content")
+    if not isinstance(content, str) or not content:
+        return "'content' must be a non-empty string"
+    return None
+
+def send_event(headers, json_payload_string):
+    """Sends one event to the sink in binary mode. Raises a RequestException on failure."""
+    with stage("forward"):
+        response = session.post(K_SINK, data=json_payload_string, headers=headers, timeout=5.0)
+    response.raise_for_status()
+    EVENTS_EMITTED.labels(event_type=headers["Ce-Type"]).inc()
+    return response
+
+def send_batch(events):
+    """Sends all events to the sink as one CloudEvents batched-mode request."""
+    items = []
+    for headers, json_payload_string in events:
+        attributes = {k[3:].lower(): v for k, v in headers.items() if k.startswith("Ce-")}
+        attributes["datacontenttype"] = "application/json"
+        # The payload is already JSON; splice it in rather than decoding and re-encoding it.
+        items.append(json.dumps(attributes)[:-1] + ', "data": ' + json_payload_string + "}")
+    with stage("forward"):
+        response = session.post(K_SINK, data="[" + ",".join(items) + "]",
+                                headers={"Content-Type": "application/cloudevents-batch+json"}, timeout=30.0)
+    response.raise_for_status()
+    EVENTS_EMITTED.labels(event_type="com.example.triage.intake.new").inc(len(events))
+    return response
+
+def read_batch():
+    """
+    Reads the items of a batch request: a JSON array, or one JSON object per
+    line (NDJSON). Returns the list of items, or raises ValueError.
+    """
+    body = request.get_data()
+    if request.is_json:
+        items = json.loads(body)
+        if not isinstance(items, list):
+            raise ValueError("JSON body must be an array")
+        return items
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+# --- Background Forwarding ---
+forwarder = None
+if INTAKE_FORWARD_MODE == FORWARD_MODE_ASYNC:
+    try:
+        forwarder = EventForwarder(
+            send_event,
+            max_queue_size=INTAKE_QUEUE_SIZE,
+            senders=INTAKE_SENDERS,
+            spill_path=INTAKE_SPILL_PATH or None,
+            max_backoff_seconds=INTAKE_RETRY_MAX_BACKOFF_SECONDS,
+        )
+    except BlockingIOError:
+        raise SystemExit(f"INTAKE_SPILL_PATH '{INTAKE_SPILL_PATH}' is used by another process; give each worker its own file.")
+    logging.info(f"Forwarding events in the background: queue size {INTAKE_QUEUE_SIZE}, {INTAKE_SENDERS} senders, "
+                 f"spill file {INTAKE_SPILL_PATH or 'disabled'}.")
+
+    @atexit.register
+    def drain_forwarder():
+        if not forwarder.drain(INTAKE_DRAIN_SECONDS):
+            logging.warning(f"Stopping with {forwarder.depth()} events not sent to the Broker.")
+
+def queue_full_response():
+    logging.warning("Forward queue is full, rejecting message.")
+    return jsonify({"error": "Too many messages waiting to be forwarded, retry later"}), 429, {"Retry-After": "1"}
+
 # --- Flask Routes ---
 @app.route('/healthz', methods=['GET'])
 def healthz():
     """Simple health check endpoint for Kubernetes probes."""
     return "OK", 200
 
+register_metrics_route(app)
+
 @app.route('/', methods=['POST'])
 def handle_json_request():
     """
@@ -65,7 +188,8 @@ def handle_json_request():
         logging.warning("Bad request: Mimetype is not application/json")
         return jsonify({"error": "Request must be application/json"}), 415
 
-    data = request.get_json()
+    with stage("parse"):
+        data = request.get_json()
 
     if not data or "content" not in data:
         logging.warning("Bad request: Missing 'content' in JSON payload")
@@ -78,14 +202,19 @@ def handle_json_request():
         return jsonify({"error": "'content' must be a non-empty string"}), 400
 
     logging.info("Received message content, creating event.")
-    headers, json_payload_string = create_cloudevent(content)
+    with stage("serialize"):
+        headers, json_payload_string = create_cloudevent(content)
+
+    if forwarder is not None:
+        if not forwarder.submit(headers, json_payload_string):
+            return queue_full_response()
+        logging.info(f"Queued event {headers['Ce-Id']} for the Broker.")
+        return jsonify({"status": "event queued", "eventId": headers['Ce-Id']}), 202
 
     try:
         logging.info(f"Sending event {headers['Ce-Id']} to Broker.")
-        # Use the 'data' parameter for the pre-serialized JSON string.
-        # Do not use the 'json' parameter.
-        response = requests.post(K_SINK, data=json_payload_string, headers=headers, timeout=5.0)
-        response.raise_for_status()
+        # The payload is sent pre-serialized as 'data', not as 'json'.
+        response = send_event(headers, json_payload_string)
 
         logging.info(f"Event accepted by Broker with status code: {response.status_code}")
         return jsonify({"status": "event accepted", "eventId": headers['Ce-Id']}), 202
@@ -94,6 +223,69 @@ def handle_json_request():
         logging.error(f"Failed to send event to Broker: {e}")
         return jsonify({"error": "Failed to forward event to the eventing system"}), 503
 
+@app.route('/batch', methods=['POST'])
+def handle_batch_request():
+    """
+    Handles a batch of messages, as a JSON array or as NDJSON (one
+    `{"content": ...}` object per line), and sends one event per message.
+    Replies with the outcome of every item: 202 if all were accepted, 207 if
+    only some were, and otherwise the status all items share (400, 429 or 503).
+    """
+    try:
+        with stage("parse"):
+            items = read_batch()
+    except ValueError as e:
+        logging.warning(f"Bad batch request: {e}")
+        return jsonify({"error": f"Body must be a JSON array or NDJSON: {e}"}), 400
+
+    if not items:
+        return jsonify({"error": "Batch must contain at least one item"}), 400
+    if len(items) > INTAKE_MAX_BATCH_SIZE:
+        return jsonify({"error": f"Batch must not contain more than {INTAKE_MAX_BATCH_SIZE} items"}), 413
+
+    results = [None] * len(items)
+    events = []
+    for index, data in enumerate(items):
+        error = validate_content(data)
+        if error:
+            results[index] = {"index": index, "status": 400, "error": error}
+            continue
+        with stage("serialize"):
+            events.append((index, create_cloudevent(data["content"])))
+    logging.info(f"Received batch of {len(items)} messages, sending {len(events)} events.")
+
+    if forwarder is not None:
+        outcomes = [None if forwarder.submit(*event) else "full" for _, event in events]
+    elif INTAKE_SINK_BATCH_MODE and events:
+        try:
+            send_batch([event for _, event in events])
+            outcomes = [None] * len(events)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to send batch of {len(events)} events to Broker: {e}")
+            outcomes = [e] * len(events)
+    else:
+        def send(event):
+            try:
+                send_event(*event)
+            except requests.exceptions.RequestException as e:
+                logging.error(f"Failed to send event {event[0]['Ce-Id']} to Broker: {e}")
+                return e
+        outcomes = list(batch_executor.map(send, [event for _, event in events]))
+
+    for (index, (headers, _)), error in zip(events, outcomes):
+        if error is None:
+            results[index] = {"index": index, "status": 202, "eventId": headers["Ce-Id"]}
+        elif error == "full":
+            results[index] = {"index": index, "status": 429, "error": "Too many messages waiting to be forwarded, retry later"}
+        else:
+            results[index] = {"index": index, "status": 503, "error": "Failed to forward event to the eventing system"}
+
+    accepted = sum(1 for result in results if result["status"] == 202)
+    statuses = {result["status"] for result in results}
+    status = statuses.pop() if len(statuses) == 1 else 207
+    logging.info(f"Batch done: {accepted}/{len(results)} events accepted.")
+    return jsonify({"accepted": accepted, "failed": len(results) - accepted, "items": results}), status
+
 # --- Main Entry Point ---
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=APP_PORT, debug=True)
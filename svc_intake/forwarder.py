@@ -0,0 +1,208 @@
+import fcntl
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+import requests
+
+from common.metrics import FORWARD_DROPPED, FORWARD_QUEUE_DEPTH, FORWARD_RETRIES
+
+
+class SpillLog:
+    """
+    An append-only file of the events accepted but not yet delivered, so they
+    survive a restart of the worker. Every accepted event is appended to
+    `path`, and its id is appended to `path.acks` once it has been delivered.
+    Both files are truncated whenever nothing is pending. Under steady load
+    something usually is, so every `compact_every` acks the log is compacted:
+    the events still pending are written to a new file that replaces `path`,
+    and the acks are emptied. Neither file grows much beyond the pending
+    events and `compact_every` acks.
+
+    Lines are flushed to the OS, not fsynced: a crashed process loses nothing,
+    a crashed node may lose the last events.
+    """
+
+    def __init__(self, path, compact_every=1000):
+        self.path = path
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.events = self._open_locked(path)
+        self.acks = open(path + ".acks", "a+")
+        self.pending_count = 0
+        self.acks_written = 0
+
+    @staticmethod
+    def _open_locked(path):
+        events = open(path, "a+")
+        # Only one process may own the log; a second worker pointed at the same path gets an error.
+        fcntl.flock(events, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return events
+
+    def _pending_lines(self):
+        """The logged lines of the events that were not acknowledged, in order. Call with the lock held."""
+        self.acks.seek(0)
+        acked = {line.strip() for line in self.acks if line.strip()}
+        self.events.seek(0)
+        lines = []
+        for line in self.events:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            if record["id"] not in acked:
+                lines.append(line if line.endswith("\n") else line + "\n")
+        return lines
+
+    def pending(self):
+        """Returns the (headers, payload) of every logged event that was not acknowledged, in order."""
+        with self.lock:
+            records = [json.loads(line) for line in self._pending_lines()]
+            self.pending_count = len(records)
+            return [(record["headers"], record["payload"]) for record in records]
+
+    def append(self, headers, payload):
+        line = json.dumps({"id": headers["Ce-Id"], "headers": headers, "payload": payload})
+        with self.lock:
+            self.events.write(line + "\n")
+            self.events.flush()
+            self.pending_count += 1
+
+    def ack(self, event_id):
+        with self.lock:
+            self.acks.write(event_id + "\n")
+            self.acks.flush()
+            self.pending_count -= 1
+            self.acks_written += 1
+            if self.pending_count == 0:
+                self.events.truncate(0)
+                self.acks.truncate(0)
+                self.acks_written = 0
+            elif self.acks_written >= self.compact_every:
+                self._compact()
+
+    def _compact(self):
+        """Replaces the log with the events still pending and empties the acks. Call with the lock held."""
+        lines = self._pending_lines()
+        temporary = f"{self.path}.compact"
+        # Locked before it takes the log's name, so no other process can claim the new file.
+        compacted = self._open_locked(temporary)
+        compacted.truncate(0)
+        compacted.writelines(lines)
+        compacted.flush()
+        os.replace(temporary, self.path)
+        # A crash before this point leaves acks for events that are gone, which is harmless.
+        self.events.close()
+        self.events = compacted
+        self.acks.truncate(0)
+        self.acks_written = 0
+        self.pending_count = len(lines)
+
+
+class EventForwarder:
+    """
+    Accepts events into a bounded queue and delivers them to the sink from
+    background sender threads, so the client does not wait for the broker.
+
+    A failed delivery, whatever the error, is retried with exponential backoff
+    and jitter until it succeeds, so a broker outage delays events instead of
+    dropping them. Only a rejection that cannot succeed later (a 4xx other
+    than 408 and 429) drops the event. When the queue is full, `submit`
+    returns False and the caller should push back on its client.
+    """
+
+    def __init__(self, send, max_queue_size=1000, senders=4, spill_path=None,
+                 initial_backoff_seconds=0.5, max_backoff_seconds=30.0):
+        self.send = send
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.initial_backoff_seconds = initial_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.spill = SpillLog(spill_path) if spill_path else None
+
+        for i in range(senders):
+            threading.Thread(target=self._send_loop, name=f"intake-forwarder-{i}", daemon=True).start()
+        if self.spill:
+            recovered = self.spill.pending()
+            if recovered:
+                logging.info(f"Re-sending {len(recovered)} events left in '{spill_path}' by a previous run.")
+                # Recovered events may exceed the queue size; feed them in as the senders make room.
+                threading.Thread(target=self._requeue, args=(recovered,), daemon=True).start()
+
+    def submit(self, headers, payload):
+        """Queues an event for delivery. Returns False, without queueing it, if the queue is full."""
+        # Checked before spilling, so a rejected event is never written to the log.
+        if self.queue.full():
+            return False
+        if self.spill:
+            self.spill.append(headers, payload)
+        try:
+            self.queue.put_nowait((headers, payload))
+        except queue.Full:
+            # Another request took the last slot. The client is told to retry, so forget the spilled copy.
+            if self.spill:
+                self.spill.ack(headers["Ce-Id"])
+            return False
+        FORWARD_QUEUE_DEPTH.inc()
+        return True
+
+    def _requeue(self, events):
+        for event in events:
+            self.queue.put(event)
+            FORWARD_QUEUE_DEPTH.inc()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def drain(self, timeout_seconds):
+        """Waits until every queued event was delivered, or the timeout expired. Returns True if drained."""
+        deadline = time.monotonic() + timeout_seconds
+        while time.monotonic() < deadline:
+            # Counts events that are queued or still being sent
+            if self.queue.unfinished_tasks == 0:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def _send_loop(self):
+        while True:
+            event = self.queue.get()
+            FORWARD_QUEUE_DEPTH.dec()
+            try:
+                self._deliver(*event)
+            except Exception as e:
+                # A sender thread that dies leaves the queue to the others, or to no one.
+                logging.error(f"Unexpected error while forwarding event {event[0].get('Ce-Id')}: {e!r}")
+            finally:
+                self.queue.task_done()
+
+    def _deliver(self, headers, payload):
+        backoff = self.initial_backoff_seconds
+        while True:
+            try:
+                self.send(headers, payload)
+                break
+            except requests.exceptions.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status is not None and 400 <= status < 500 and status not in (408, 429):
+                    logging.error(f"Broker rejected event {headers['Ce-Id']} with status {status}, dropping it: {e}")
+                    FORWARD_DROPPED.inc()
+                    break
+                error = e
+            except requests.exceptions.RequestException as e:
+                error = e
+            except Exception as e:
+                # Not a network error, but the event is not delivered either: retry it like one.
+                logging.error(f"Unexpected error while sending event {headers['Ce-Id']} to Broker: {e!r}")
+                error = e
+            FORWARD_RETRIES.inc()
+            delay = random.uniform(backoff / 2, backoff)
+            logging.warning(f"Failed to send event {headers['Ce-Id']} to Broker, retrying in {delay:.1f}s: {error}")
+            time.sleep(delay)
+            backoff = min(backoff * 2, self.max_backoff_seconds)
+        if self.spill:
+            self.spill.ack(headers["Ce-Id"])
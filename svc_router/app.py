@@ -1,24 +1,40 @@
 import os
-import uuid
+import time
+import atexit
 import logging
+import threading
 import instructor
-import httpx # Import httpx
+from collections import Counter
 from flask import Flask, request, jsonify
-from openai import OpenAI
 from pydantic import ValidationError
 
 # Assuming your models are in a shared 'models.py' file
 # This service needs OuterWrapper, SelectedRoute, and the Route enum
+from common.blobstore import blob_store_stats
+from common.idempotency import create_idempotency_store
+from common.llm import create_openai_client, resilience_stats
+from common.llm_batcher import LLM_BATCH_MODE_COMPLETIONS, create_llm_batcher
+from common.llm_cache import create_response_cache
+from common.llm_telemetry import call_stats
+from common.metrics import (
+    EVENTS_EMITTED, EVENTS_RECEIVED, ROUTER_DECISIONS, SEMANTIC_CACHE_LOOKUPS, SEMANTIC_CACHE_SAVED_SECONDS,
+    register_metrics_route, stage,
+)
+from common.preprocess import prompt_content
+from common.prompts import get_prompt
+from common.semantic_cache import SemanticCache
 from models import OuterWrapper, SelectedRoute, Route
+from models.codec import decode_wrapper, wrapper_response
+from svc_router.preclassifier import RulePreclassifier
 
 # --- Configuration ---
 app = Flask(__name__)
 # The main application logger
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Set the log level for libraries for detailed request/response info
+# LLM calls are logged by common/llm_telemetry.py; set LLM_DEBUG=true for httpx's request logging
 logging.getLogger("openai").setLevel(logging.INFO)
-logging.getLogger("httpx").setLevel(logging.DEBUG) # This will log the raw LLM request
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 APP_PORT = int(os.getenv("PORT", "8080"))
 LLM_API_BASE_URL = os.getenv('LLM_API_BASE_URL')
@@ -28,24 +44,62 @@ LLM_MODEL_NAME = os.getenv('LLM_MODEL_NAME', "not-set")
 if not LLM_API_BASE_URL:
     raise SystemExit("LLM_API_BASE_URL environment variable is not set.")
 
-# This function will be called for every response received by the httpx client.
-def log_response(response):
-    response.read()
-    logging.info(f"LLM Response Body: {response.text}")
+# A local classification tier in front of the LLM:
+# - "none": every message is classified by the LLM (default).
+# - "rules": keyword rules (svc_router/preclassifier.py) route the messages they
+#   are confident about; the others fall through to the LLM.
+ROUTER_PRECLASSIFIER_NONE = "none"
+ROUTER_PRECLASSIFIER_RULES = "rules"
+ROUTER_PRECLASSIFIER = os.getenv("ROUTER_PRECLASSIFIER", ROUTER_PRECLASSIFIER_NONE)
+# The confidence (0-1) the rules need to skip the LLM
+ROUTER_PRECLASSIFIER_THRESHOLD = float(os.getenv("ROUTER_PRECLASSIFIER_THRESHOLD", "0.8"))
+
+if ROUTER_PRECLASSIFIER not in (ROUTER_PRECLASSIFIER_NONE, ROUTER_PRECLASSIFIER_RULES):
+    raise SystemExit(f"ROUTER_PRECLASSIFIER must be '{ROUTER_PRECLASSIFIER_NONE}' or '{ROUTER_PRECLASSIFIER_RULES}', got '{ROUTER_PRECLASSIFIER}'.")
+
+# --- Semantic cache ---
+# Reuse the route of an earlier message whose embedding is similar enough,
+# e.g. a paraphrase of "reset my password". Embeddings come from the
+# embeddings API of the same OpenAI-compatible server.
+ROUTER_SEMANTIC_CACHE = os.getenv("ROUTER_SEMANTIC_CACHE", "false").lower() == "true"
+ROUTER_EMBEDDING_MODEL = os.getenv("ROUTER_EMBEDDING_MODEL", "nomic-embed-text")
+ROUTER_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("ROUTER_SEMANTIC_CACHE_THRESHOLD", "0.92"))
+ROUTER_SEMANTIC_CACHE_SIZE = int(os.getenv("ROUTER_SEMANTIC_CACHE_SIZE", "5000"))
+# Loaded on startup and written back periodically and on shutdown; empty to keep it in memory only
+ROUTER_SEMANTIC_CACHE_PATH = os.getenv("ROUTER_SEMANTIC_CACHE_PATH", "/tmp/router-semantic-cache.npz")
 
 # --- Message Processor Class ---
 class MessageProcessor:
     def __init__(self):
         """Initializes the processor and the LLM client."""
-        http_client = httpx.Client(event_hooks={"response": [log_response]})
-
-        # Patch the OpenAI client with instructor
-        self.client = instructor.patch(OpenAI(
-            api_key=LLM_API_KEY,
-            base_url=LLM_API_BASE_URL,
-            http_client=http_client
-        ))
+        # A pooled, instrumented and resilient LLM client (see common/llm.py), patched with instructor
+        self.client = instructor.patch(create_openai_client(LLM_API_KEY, LLM_API_BASE_URL))
         logging.info(f"LLM client configured for model '{LLM_MODEL_NAME}' at '{LLM_API_BASE_URL}'")
+        self.cache = create_response_cache("router")
+        # Versioned prompts (see common/prompts.py); the response cache is keyed on their version.
+        self.prompt = get_prompt("router.classify")
+        self.json_prompt = get_prompt("router.classify-json")
+        # Batches the LLM calls of concurrent events (see common/llm_batcher.py)
+        self.batcher = create_llm_batcher("router", self.client, LLM_MODEL_NAME)
+
+        self.preclassifier = None
+        if ROUTER_PRECLASSIFIER == ROUTER_PRECLASSIFIER_RULES:
+            self.preclassifier = RulePreclassifier(ROUTER_PRECLASSIFIER_THRESHOLD)
+            logging.info(f"Keyword pre-classifier enabled with threshold {ROUTER_PRECLASSIFIER_THRESHOLD}")
+        self.semantic_cache = None
+        # Like the response cache key: a route computed by another model or prompt version is not reused.
+        self.semantic_namespace = "|".join((ROUTER_EMBEDDING_MODEL, LLM_MODEL_NAME, self.prompt.cache_template()))
+        if ROUTER_SEMANTIC_CACHE:
+            self.semantic_cache = SemanticCache(
+                max_size=ROUTER_SEMANTIC_CACHE_SIZE,
+                threshold=ROUTER_SEMANTIC_CACHE_THRESHOLD,
+                path=ROUTER_SEMANTIC_CACHE_PATH or None,
+            )
+            atexit.register(self.semantic_cache.save)
+            logging.info(f"Semantic cache enabled with model '{ROUTER_EMBEDDING_MODEL}' and threshold {ROUTER_SEMANTIC_CACHE_THRESHOLD}")
+        # Messages classified by each tier, for /stats
+        self.tier_counts = Counter()
+        self.tier_lock = threading.Lock()
 
     def process(self, message: OuterWrapper) -> OuterWrapper:
         """
@@ -55,26 +109,23 @@ class MessageProcessor:
         try:
             logging.info(f"[{message.message_id}] - Starting LLM routing classification.")
 
-            # Use instructor to get a structured response
-            selection = self.client.chat.completions.create(
-                model=LLM_MODEL_NAME,
-                response_model=SelectedRoute,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """You are an AI-powered message classifier for an enterprise support system. Your task is to analyze email messages and determine the most appropriate team for handling them:
-- **Support**: Issues related to technical support, product usage, and troubleshooting.
-- **Finance**: Questions about billing, invoices, receipts, payments, refunds, or financial disputes.
-- **Website**: Issues related to website functionality, login problems, password reset, account access, or technical errors on the website.
-- **Unknown**: If the message does not fit into any of the above categories or lacks sufficient context to classify accurately."""
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Classify the following email message and determine the appropriate routing category.\n\nMESSAGE:\n{message.content}",
-                    },
-                ],
-                temperature=0.0
-            )
+            content = prompt_content(message)
+            selection = self.preclassifier.classify(content) if self.preclassifier else None
+            if selection:
+                self._count_tier("rules")
+                logging.info(f"[{message.message_id}] - Pre-classified without the LLM. {selection.reason}")
+            else:
+                # The tier that computed the route; none if the response cache had it
+                tiers = []
+
+                def classify():
+                    computed, tier = self._classify_uncached(message, content)
+                    tiers.append(tier)
+                    return computed.model_dump(mode='json')
+
+                cache_key = self.cache.key(LLM_MODEL_NAME, self.prompt.cache_template(), content)
+                selection = SelectedRoute.model_validate(self.cache.get_or_compute(cache_key, classify))
+                self._count_tier(tiers[0] if tiers else "cache")
 
             logging.info(f"[{message.message_id}] - Successfully classified route: {selection.route.value}")
             message.route = selection.route
@@ -87,14 +138,94 @@ class MessageProcessor:
 
         return message
 
+    def _count_tier(self, tier: str):
+        ROUTER_DECISIONS.labels(tier=tier).inc()
+        with self.tier_lock:
+            self.tier_counts[tier] += 1
+
+    def tier_stats(self) -> dict:
+        """Messages classified by each tier, and the share of each."""
+        with self.tier_lock:
+            counts = dict(self.tier_counts)
+        total = sum(counts.values())
+        return {
+            "counts": counts,
+            "ratios": {tier: count / total for tier, count in counts.items()} if total else {},
+        }
+
+    def _classify_uncached(self, message: OuterWrapper, content: str):
+        """Returns (SelectedRoute, tier) from the semantic cache if enabled and similar enough, otherwise from the LLM."""
+        embedding = None
+        if self.semantic_cache:
+            started = time.perf_counter()
+            try:
+                embedding = self.client.embeddings.create(model=ROUTER_EMBEDDING_MODEL, input=content).data[0].embedding
+            except Exception as e:
+                # The cache is an optimization: without an embedding, ask the LLM.
+                logging.warning(f"[{message.message_id}] - Embedding failed, skipping the semantic cache: {e}")
+            if embedding is not None:
+                hit = self.semantic_cache.lookup(embedding, self.semantic_namespace)
+                SEMANTIC_CACHE_LOOKUPS.labels(result="hit" if hit else "miss").inc()
+                if hit:
+                    value, similarity, cost_seconds = hit
+                    saved_seconds = max(0.0, cost_seconds - (time.perf_counter() - started))
+                    self.semantic_cache.record_saving(saved_seconds)
+                    SEMANTIC_CACHE_SAVED_SECONDS.inc(saved_seconds)
+                    logging.info(f"[{message.message_id}] - Semantic cache hit (similarity {similarity:.3f}).")
+                    return SelectedRoute.model_validate(value), "semantic"
+
+        started = time.perf_counter()
+        selection = self._classify(content)
+        if embedding is not None:
+            self.semantic_cache.add(embedding, selection.model_dump(mode='json'), cost_seconds=time.perf_counter() - started,
+                                    namespace=self.semantic_namespace)
+        return selection, "llm"
+
+    def _classify(self, content: str) -> SelectedRoute:
+        if self.batcher and self.batcher.mode == LLM_BATCH_MODE_COMPLETIONS:
+            reply = self.batcher.submit(self.json_prompt.messages(content), max_tokens=200,
+                                        extra_headers=self.json_prompt.headers()).result()
+            # A reply that is not a valid route fails like any other LLM call.
+            return SelectedRoute.model_validate_json(reply[reply.find("{"):reply.rfind("}") + 1])
+
+        def call():
+            # Use instructor to get a structured response
+            return self.client.chat.completions.create(
+                model=LLM_MODEL_NAME,
+                response_model=SelectedRoute,
+                messages=self.prompt.messages(content),
+                temperature=0.0,
+                extra_headers=self.prompt.headers(),
+            )
+
+        return self.batcher.submit_call(call).result() if self.batcher else call()
+
 # --- Global Processor Instance ---
 processor = MessageProcessor()
+# Replies already sent, for answering redelivered events
+idempotency = create_idempotency_store("router")
 
 # --- Flask Routes ---
 @app.route('/healthz', methods=['GET'])
 def healthz():
     return "OK", 200
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """LLM response cache, LLM call counters, classification tiers, batches and suppressed duplicates of this worker."""
+    return jsonify({
+        "llm_cache": processor.cache.stats(),
+        "llm_calls": call_stats.stats(),
+        "llm_resilience": resilience_stats(),
+        "tiers": processor.tier_stats(),
+        "llm_batcher": processor.batcher.stats() if processor.batcher else None,
+        "semantic_cache": processor.semantic_cache.stats() if processor.semantic_cache else None,
+        "idempotency": idempotency.stats(),
+        "blob_store": blob_store_stats(),
+    }), 200
+
+register_metrics_route(app)
+
 @app.route('/', methods=['POST'])
 def handle_event():
     """
@@ -103,17 +234,24 @@ def handle_event():
     """
     if not request.is_json:
         return jsonify({"error": "Request must be application/json"}), 415
+    EVENTS_RECEIVED.labels(event_type=request.headers.get('Ce-Type', 'unknown-type')).inc()
+
+    # A redelivered event gets the reply recorded the first time, without redoing the work
+    replay = idempotency.replay(request.headers.get('Ce-Subject'))
+    if replay is not None:
+        return replay
 
     try:
-        incoming_payload = request.get_json()
-        incoming_wrapper = OuterWrapper(**incoming_payload)
+        with stage("parse"):
+            incoming_wrapper = decode_wrapper(request.get_data())
         logging.info(f"[{incoming_wrapper.message_id}] - Received event from Broker.")
 
     except (ValidationError, TypeError) as e:
         logging.error(f"Failed to parse incoming event payload: {e}")
         return jsonify({"error": "Bad request: payload does not match expected schema"}), 400
 
-    processed_wrapper = processor.process(incoming_wrapper)
+    with stage("process"):
+        processed_wrapper = processor.process(incoming_wrapper)
 
     # Determine the outgoing event type based on the classification
     if processed_wrapper.route == Route.support:
@@ -131,16 +269,20 @@ def handle_event():
         "Ce-Specversion": "1.0",
         "Ce-Type": event_type,
         "Ce-Source": "/services/router-processor",
-        "Ce-Id": str(uuid.uuid4()),
+        "Ce-Id": idempotency.event_id(processed_wrapper.message_id),
         "Ce-Subject": processed_wrapper.message_id,
     }
 
     # The body of the response becomes the data payload of the new CloudEvent.
-    response_payload = processed_wrapper.model_dump(mode='json')
+    with stage("serialize"):
+        response_body = wrapper_response(processed_wrapper)
+    EVENTS_EMITTED.labels(event_type=event_type).inc()
+
+    idempotency.record(processed_wrapper.message_id, response_body, response_headers)
 
     # Reply directly with the new event payload and headers.
     logging.info(f"[{processed_wrapper.message_id}] - Replying with new event of type '{event_type}'.")
-    return jsonify(response_payload), 200, response_headers
+    return response_body, 200, response_headers
 
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+import re
+
+from models import Route, SelectedRoute
+
+# Keyword rules per route, as (pattern, weight). A pattern is a regular
+# expression matched case-insensitively on word boundaries. Strong signals
+# weigh 2 or 3, words that also appear in other kinds of email weigh 1.
+RULES = {
+    Route.finance: [
+        (r"invoices?", 3),
+        (r"refund(s|ed)?", 3),
+        (r"receipts?", 3),
+        (r"(double|twice|over)[ -]?charged|charged (twice|two times)", 3),
+        (r"billing|billed", 2),
+        (r"payments?|paid", 2),
+        (r"credit card|bank transfer|wire transfer", 2),
+        (r"charged?|charges", 1),
+        (r"vat|tax", 1),
+        (r"subscription", 1),
+    ],
+    Route.website: [
+        (r"(reset|forgot|forgotten|change) (my |the )?password|password reset", 3),
+        (r"locked out", 3),
+        (r"(can ?not|can't|cannot|unable to) (log ?in|sign ?in|access my account)", 3),
+        (r"log ?in|sign ?in|login page", 2),
+        (r"website|web site|web page|webpage", 2),
+        (r"404|500 error|broken link|page (does not|doesn't|won't) load", 2),
+        (r"account", 1),
+        (r"browser", 1),
+    ],
+    Route.support: [
+        (r"(does not|doesn't|won't|will not) (turn on|start|power on|connect|sync)", 3),
+        (r"troubleshoot(ing)?", 3),
+        (r"firmware|driver|install(ation|ed|ing)?", 2),
+        (r"crash(es|ed|ing)?|freez(es|ing)|keeps restarting", 2),
+        (r"how (do|can) i", 2),
+        (r"set ?up|configure|configuration", 1),
+        (r"not working|stopped working|broken", 1),
+        (r"device|product|update", 1),
+    ],
+}
+
+# Added to the total score, so a single weak keyword is not a confident match
+PRIOR_WEIGHT = 1.0
+
+
+class RulePreclassifier:
+    """
+    A keyword tier in front of the LLM. Each route scores the sum of the
+    weights of its patterns found in the message; the confidence of the best
+    route is its share of all scores (plus PRIOR_WEIGHT). Only a confidence at
+    or above the threshold yields a route; other messages go to the LLM.
+    """
+
+    def __init__(self, threshold, rules=None):
+        self.threshold = threshold
+        self.rules = {
+            route: [(re.compile(rf"\b(?:{pattern})\b", re.IGNORECASE), weight) for pattern, weight in patterns]
+            for route, patterns in (rules or RULES).items()
+        }
+
+    def score(self, text: str):
+        """Returns (route, confidence, matched keywords) of the best scoring route, or (None, 0.0, [])."""
+        scores, matches = {}, {}
+        for route, patterns in self.rules.items():
+            for pattern, weight in patterns:
+                match = pattern.search(text)
+                if match:
+                    scores[route] = scores.get(route, 0) + weight
+                    matches.setdefault(route, []).append(match.group(0).lower())
+        if not scores:
+            return None, 0.0, []
+        route = max(scores, key=scores.get)
+        return route, scores[route] / (sum(scores.values()) + PRIOR_WEIGHT), matches[route]
+
+    def classify(self, text: str):
+        """Returns a SelectedRoute if the rules are confident about the message, otherwise None."""
+        route, confidence, matched = self.score(text)
+        if route is None or confidence < self.threshold:
+            return None
+        return SelectedRoute(
+            route=route,
+            reason=f"Keyword rules ({confidence:.2f}): {', '.join(matched)}",
+            escalation_required=False,
+        )
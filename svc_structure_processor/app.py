@@ -1,13 +1,26 @@
 import os
-import uuid
+import time
 import logging
 import instructor
-import httpx # Import httpx
 from flask import Flask, request, jsonify
-from openai import OpenAI
+from instructor.exceptions import IncompleteOutputException
+from instructor.function_calls import openai_schema
+from openai import APITimeoutError
 from pydantic import ValidationError
+from pydantic_core import from_json
 
+from common.blobstore import blob_store_stats
+from common.idempotency import create_idempotency_store
+from common.llm import create_openai_client, resilience_stats
+from common.llm_cache import create_response_cache
+from common.llm_telemetry import call_stats
+from common.metrics import (
+    EVENTS_EMITTED, EVENTS_RECEIVED, LLM_CUTOFFS, LLM_FIRST_FIELD_SECONDS, register_metrics_route, stage,
+)
+from common.preprocess import prompt_content
+from common.prompts import get_prompt
 from models import OuterWrapper, StructuredObject
+from models.codec import decode_wrapper, wrapper_response
 
 # --- Configuration ---
 app = Flask(__name__)
@@ -15,9 +28,9 @@ app = Flask(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Set the log level for the libraries
-# We'll see our own custom logging plus the request logging from httpx
+# LLM calls are logged by common/llm_telemetry.py; set LLM_DEBUG=true for httpx's request logging
 logging.getLogger("openai").setLevel(logging.INFO) # Keep this at INFO
-logging.getLogger("httpx").setLevel(logging.DEBUG) # This will log the request
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 APP_PORT = int(os.getenv("PORT", "8080"))
 LLM_API_BASE_URL = os.getenv('LLM_API_BASE_URL')
@@ -27,30 +40,76 @@ LLM_MODEL_NAME = os.getenv('LLM_MODEL_NAME', "not-set")
 if not LLM_API_BASE_URL:
     raise SystemExit("LLM_API_BASE_URL environment variable is not set.")
 
-# This function will be called for every response received by the httpx client.
-def log_response(response):
-    # This ensures the response is read before we try to log it.
-    response.read()
-    # The 'response.text' contains the full JSON body from the LLM.
-    logging.info(f"LLM Response Body: {response.text}")
+
+def schema_token_budget(model) -> int:
+    """
+    A max_tokens budget for one tool call filling `model`: room for a sentence
+    in every string field, a few tokens for every other value, and the JSON
+    keys and punctuation around them.
+    """
+    budget = 16
+    for name, field in model.model_fields.items():
+        budget += 8 + len(name) // 4
+        budget += 64 if str in getattr(field.annotation, "__args__", (field.annotation,)) else 4
+    return budget
+
+
+# --- Generation limits ---
+# A slow or runaway generation is cut off instead of holding the worker.
+# The timeout bounds the whole extraction: the OpenAI client does not retry it.
+STRUCTURE_TIMEOUT_SECONDS = float(os.getenv("STRUCTURE_TIMEOUT_SECONDS", "30"))
+STRUCTURE_MAX_TOKENS = int(os.getenv("STRUCTURE_MAX_TOKENS", "0")) or schema_token_budget(StructuredObject)
+# Stream the tool call and parse fields as they arrive (see README)
+STRUCTURE_STREAMING = os.getenv("STRUCTURE_STREAMING", "false").lower() == "true"
+# A cut-off streamed extraction is still used if these fields were complete
+ESSENTIAL_FIELDS = ("reason", "escalate", "email_address")
+
+STRUCTURE_TOOL = openai_schema(StructuredObject).openai_schema
+
+class ExtractionCutOff(Exception):
+    """
+    The extraction was stopped by the timeout or the token budget. `partial`
+    is the StructuredObject built from the fields completed until then, or
+    None if it lacks an essential field.
+    """
+
+    def __init__(self, reason: str, partial: StructuredObject = None):
+        super().__init__(f"structure-processor:cut-off:{reason}")
+        self.reason = reason
+        self.partial = partial
+
+
+def completed_fields(fields: dict) -> StructuredObject:
+    """
+    The StructuredObject of a cut-off stream's parsed fields, or None. The
+    last field the stream started may be truncated, so it is left out; the
+    other missing fields are set to None.
+    """
+    started = [name for name in StructuredObject.model_fields if name in fields]
+    complete = set(started[:-1])
+    if not all(name in complete for name in ESSENTIAL_FIELDS):
+        return None
+    try:
+        return StructuredObject.model_validate(
+            {name: fields[name] if name in complete else None for name in StructuredObject.model_fields}
+        )
+    except ValidationError:
+        return None
+
 
 # --- Message Processor Class ---
 class MessageProcessor:
     def __init__(self):
         """Initializes the processor and the LLM client."""
 
-        # Create a custom httpx client with our logging hook
-        http_client = httpx.Client(
-            event_hooks={"response": [log_response]}
-        )
-
-        # Pass the custom client to OpenAI
-        self.client = instructor.patch(OpenAI(
-            api_key=LLM_API_KEY,
-            base_url=LLM_API_BASE_URL,
-            http_client=http_client # Use our custom client
-        ))
+        # A pooled, instrumented and resilient LLM client (see common/llm.py). Without the
+        # client's retries, so an extraction never takes more than STRUCTURE_TIMEOUT_SECONDS.
+        client = create_openai_client(LLM_API_KEY, LLM_API_BASE_URL).with_options(max_retries=0)
+        self.client = instructor.patch(client)
         logging.info(f"LLM client configured for model '{LLM_MODEL_NAME}' at '{LLM_API_BASE_URL}'")
+        self.cache = create_response_cache("structure-processor")
+        # Versioned prompt (see common/prompts.py); the response cache is keyed on its version.
+        self.prompt = get_prompt("structure.extract")
 
     def process(self, message: OuterWrapper) -> OuterWrapper:
         """
@@ -59,30 +118,118 @@ class MessageProcessor:
         """
         try:
             logging.info(f"[{message.message_id}] - Starting LLM structure processing.")
-            analysis = self.client.chat.completions.create(
-                model=LLM_MODEL_NAME,
-                response_model=StructuredObject,
-                messages=[
-                    {"role": "system", "content": "You are a world-class text analysis expert. Extract the information precisely into the provided JSON format. The message is a customer support email."},
-                    {"role": "user", "content": message.content},
-                ],
+            content = prompt_content(message)
+            cache_key = self.cache.key(LLM_MODEL_NAME, self.prompt.cache_template(), content)
+            analysis = StructuredObject.model_validate(
+                self.cache.get_or_compute(cache_key, lambda: self._extract(content).model_dump(mode='json'))
             )
             logging.info(f"[{message.message_id}] - Successfully extracted structure: {analysis.model_dump_json(indent=2)}")
             message.structured = analysis
+        except ExtractionCutOff as e:
+            # Neither cached nor recorded for redeliveries (see handle_event):
+            # the next delivery of the message gets a full attempt.
+            LLM_CUTOFFS.labels(reason=e.reason, partial_used=str(e.partial is not None).lower()).inc()
+            if e.partial is not None:
+                logging.warning(f"[{message.message_id}] - Extraction cut off ({e.reason}), using the fields completed so far.")
+                message.structured = e.partial
+                message.metadata["structure_partial"] = e.reason
+            else:
+                logging.error(f"[{message.message_id}] - Extraction cut off ({e.reason}) before the essential fields.")
+                message.error.append(str(e))
         except Exception as e:
             error_msg = f"LLM call failed: {e}"
             logging.error(f"[{message.message_id}] - {error_msg}")
             message.error.append(error_msg)
         return message
 
+    def _extract(self, content: str) -> StructuredObject:
+        if STRUCTURE_STREAMING:
+            return self._extract_streaming(content)
+        try:
+            return self.client.chat.completions.create(
+                model=LLM_MODEL_NAME,
+                response_model=StructuredObject,
+                messages=self.prompt.messages(content),
+                max_tokens=STRUCTURE_MAX_TOKENS,
+                timeout=STRUCTURE_TIMEOUT_SECONDS,
+                extra_headers=self.prompt.headers(),
+            )
+        except APITimeoutError:
+            raise ExtractionCutOff("timeout")
+        except IncompleteOutputException:
+            raise ExtractionCutOff("max-tokens")
+
+    def _extract_streaming(self, content: str) -> StructuredObject:
+        """
+        Streams the tool call and parses its arguments after every chunk,
+        completing a truncated string at the end. Without a response_model,
+        the patched client returns the raw stream, so a cut-off can close the
+        HTTP response.
+        """
+        started = time.perf_counter()
+        deadline = started + STRUCTURE_TIMEOUT_SECONDS
+        stream = self.client.chat.completions.create(
+            model=LLM_MODEL_NAME,
+            messages=self.prompt.messages(content),
+            tools=[{"type": "function", "function": STRUCTURE_TOOL}],
+            tool_choice={"type": "function", "function": {"name": STRUCTURE_TOOL["name"]}},
+            stream=True,
+            stream_options={"include_usage": True},
+            max_tokens=STRUCTURE_MAX_TOKENS,
+            timeout=STRUCTURE_TIMEOUT_SECONDS,
+            extra_headers=self.prompt.headers(),
+        )
+        arguments, fields, finish_reason, first_field_seconds = "", {}, None, None
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                if choice.delta.tool_calls and choice.delta.tool_calls[0].function.arguments:
+                    arguments += choice.delta.tool_calls[0].function.arguments
+                    fields = from_json(arguments, allow_partial="trailing-strings") or {}
+                now = time.perf_counter()
+                if first_field_seconds is None and fields:
+                    first_field_seconds = now - started
+                    LLM_FIRST_FIELD_SECONDS.observe(first_field_seconds)
+                if now > deadline:
+                    raise ExtractionCutOff("timeout", completed_fields(fields))
+        except APITimeoutError:
+            raise ExtractionCutOff("timeout", completed_fields(fields))
+        finally:
+            stream.close()
+
+        if finish_reason == "length":
+            raise ExtractionCutOff("max-tokens", completed_fields(fields))
+        total_seconds = time.perf_counter() - started
+        logging.info(f"Streamed extraction: first field after {(first_field_seconds or total_seconds) * 1000:.0f} ms, "
+                     f"complete after {total_seconds * 1000:.0f} ms.")
+        return StructuredObject.model_validate_json(arguments)
+
 # --- Global Processor Instance ---
 processor = MessageProcessor()
+# Replies already sent, for answering redelivered events
+idempotency = create_idempotency_store("structure-processor")
 
 # --- Flask Routes ---
 @app.route('/healthz', methods=['GET'])
 def healthz():
     return "OK", 200
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """LLM response cache, LLM call counters and suppressed duplicates of this worker."""
+    return jsonify({
+        "llm_cache": processor.cache.stats(),
+        "llm_calls": call_stats.stats(),
+        "llm_resilience": resilience_stats(),
+        "idempotency": idempotency.stats(),
+        "blob_store": blob_store_stats(),
+    }), 200
+
+register_metrics_route(app)
+
 @app.route('/', methods=['POST'])
 def handle_event():
     """
@@ -92,10 +239,16 @@ def handle_event():
     """
     if not request.is_json:
         return jsonify({"error": "Request must be application/json"}), 415
+    EVENTS_RECEIVED.labels(event_type=request.headers.get('Ce-Type', 'unknown-type')).inc()
+
+    # A redelivered event gets the reply recorded the first time, without redoing the work
+    replay = idempotency.replay(request.headers.get('Ce-Subject'))
+    if replay is not None:
+        return replay
 
     try:
-        incoming_payload = request.get_json()
-        incoming_wrapper = OuterWrapper(**incoming_payload)
+        with stage("parse"):
+            incoming_wrapper = decode_wrapper(request.get_data())
         logging.info(f"[{incoming_wrapper.message_id}] - Received event from Broker.")
 
     except (ValidationError, TypeError) as e:
@@ -103,7 +256,8 @@ def handle_event():
         return jsonify({"error": "Bad request: payload does not match expected schema"}), 400
 
     # Process the message to produce the data for the new event
-    processed_wrapper = processor.process(incoming_wrapper)
+    with stage("process"):
+        processed_wrapper = processor.process(incoming_wrapper)
 
     # Determine the type of the event we are replying with
     if processed_wrapper.structured:
@@ -118,20 +272,25 @@ def handle_event():
         "Ce-Specversion": "1.0",
         "Ce-Type": event_type,
         "Ce-Source": "/services/structure-processor",
-        "Ce-Id": str(uuid.uuid4()),
+        "Ce-Id": idempotency.event_id(processed_wrapper.message_id),
         "Ce-Subject": processed_wrapper.message_id,
     }
 
     # The body of the response becomes the data payload of the new CloudEvent.
-    # We use model_dump(mode='json') to get a dict with JSON-compatible types.
-    # This correctly serializes datetime objects to ISO 8601 strings.
-    response_payload = processed_wrapper.model_dump(mode='json')
+    # pydantic serializes it straight to JSON bytes (datetime objects become
+    # ISO 8601 strings), without an intermediate dict.
+    with stage("serialize"):
+        response_body = wrapper_response(processed_wrapper)
+    EVENTS_EMITTED.labels(event_type=event_type).inc()
+
+    # Cut-off and failed extractions are not recorded, so a redelivery retries them
+    if processed_wrapper.structured and "structure_partial" not in processed_wrapper.metadata:
+        idempotency.record(processed_wrapper.message_id, response_body, response_headers)
 
     # By returning a payload and headers, we are sending a new event back
     # to the Knative component (e.g., Broker) that sent the original request.
-    # jsonify will handle serializing the payload and setting the Content-Type.
     logging.info(f"[{processed_wrapper.message_id}] - Replying with new event of type '{event_type}'.")
-    return jsonify(response_payload), 200, response_headers
+    return response_body, 200, response_headers
 
 
 if __name__ == '__main__':
@@ -1,43 +1,19 @@
 import os
-import json
 import logging
-import queue
-import collections
 from flask import Flask, request, jsonify, render_template, Response
 
+from common.blobstore import fetch_content
+from common.broadcast import create_broadcaster
+from common.metrics import EVENTS_RECEIVED, register_metrics_route, stage
+
 # --- Configuration ---
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 APP_PORT = int(os.getenv("PORT", "8080"))
 
-# --- In-Memory Message Announcer for SSE (Replaces Flask-SSE/Redis) ---
-# This class handles broadcasting messages to all connected UI clients.
-class MessageAnnouncer:
-    def __init__(self):
-        self.listeners = []
-        self.history = collections.deque(maxlen=50)
-
-    def listen(self):
-        for msg in list(self.history):
-            yield msg
-        q = queue.Queue(maxsize=10)
-        self.listeners.append(q)
-        try:
-            while True:
-                msg = q.get()
-                yield msg
-        finally:
-            self.listeners.remove(q)
-
-    def announce(self, msg):
-        self.history.append(msg)
-        for i in reversed(range(len(self.listeners))):
-            try:
-                self.listeners[i].put_nowait(msg)
-            except queue.Full:
-                del self.listeners[i]
-
-announcer = MessageAnnouncer()
+# --- SSE Broadcasting ---
+# Configured with the SSE_* environment variables, see common/broadcast.py
+announcer = create_broadcaster("triage_event")
 
 # --- Flask Routes ---
 @app.route('/')
@@ -50,7 +26,14 @@ def healthz():
 
 @app.route('/stream')
 def stream():
-    return Response(announcer.listen(), mimetype='text/event-stream')
+    return Response(announcer.stream(request.headers.get('Last-Event-ID')), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(announcer.stats()), 200
+
+register_metrics_route(app)
 
 @app.route('/', methods=['POST'])
 def handle_event():
@@ -59,27 +42,38 @@ def handle_event():
     """
     if not request.is_json:
         return jsonify({"error": "Request must be application/json"}), 415
+    EVENTS_RECEIVED.labels(event_type=request.headers.get('Ce-Type', 'unknown-type')).inc()
+
+    with stage("parse"):
+        payload = request.get_json()
+
+    # The messageId for correlation is still the subject
+    message_id = request.headers.get('Ce-Subject', 'unknown-subject')
+
+    # Claim check: show the content instead of its reference, or the reference if it can't be fetched
+    if isinstance(payload, dict) and payload.get("content_ref") and not payload.get("content"):
+        try:
+            payload["content"] = fetch_content(payload["content_ref"])
+        except Exception as e:
+            logging.warning(f"[{message_id}] - Could not fetch the content {payload['content_ref']}: {e}")
 
     cloud_event = {
         "type": request.headers.get('Ce-Type', 'unknown-type'),
         "source": request.headers.get('Ce-Source', 'unknown-source'),
         "id": request.headers.get('Ce-Id', 'unknown-id'),
         "specversion": request.headers.get('Ce-Specversion', 'unknown'),
-        "payload": request.get_json()
+        "payload": payload
     }
 
-    # The messageId for correlation is still the subject
-    message_id = request.headers.get('Ce-Subject', 'unknown-subject')
-
     # Create a structured message for the frontend
     sse_data = {
         "messageId": message_id,
         "cloudEvent": cloud_event
     }
 
-    sse_msg = f"event: triage_event\ndata: {json.dumps(sse_data)}\n\n"
-
-    announcer.announce(sse_msg)
+    # Serialized once here, whatever the number of connected clients
+    with stage("serialize"):
+        announcer.publish(sse_data)
     logging.info(f"Relayed event '{cloud_event['type']}' from '{cloud_event['source']}' for message '{message_id}' to UI.")
 
     return jsonify({"status": "event relayed to UI"}), 200